@@ -2,47 +2,151 @@ import datetime
 
 from langchain_core.runnables import RunnableConfig
 from langgraph.prebuilt import create_react_agent
-from langgraph.checkpoint.memory import MemorySaver
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from conversation_store import get_checkpointer
+from history import SUMMARY_ID, compaction_hook
+from turn_scheduler import llm_rate_limiter
+from tracing import tracer
 
 
 class LLMAgent:
-    def __init__(self, model, tools, user_id):
+    def __init__(self, model, tools, user_id, light_model=None):
         self._model = model.bind_functions(tools)
-        self._agent = create_react_agent(
-            model,
-            tools=tools,
-            checkpointer=MemorySaver())
+        self._tools = tools
+        # Маршруты моделей: простые ходы и сводки истории идут в дешевую модель
+        self._models = {'main': model, 'light': light_model or model}
+        self._summary_model = light_model or model
+        self._checkpointer = get_checkpointer()
+        # Графы по имени модели собираются при первом ходе по маршруту, история у них общая
+        self._agents = {}
         self._user_id = user_id
         self._config: RunnableConfig = {
             "configurable": {"thread_id": self._user_id}}
 
-    async def ainvoke(self, message):
+    def _agent(self, route: str = 'main'):
+        model = self._models.get(route, self._models['main'])
+        agent = self._agents.get(model.model)
+        if agent is None:
+            agent = self._agents[model.model] = create_react_agent(
+                model,
+                tools=self._tools,
+                prompt=self._with_system_prompt,
+                pre_model_hook=self._compact_history,
+                checkpointer=self._checkpointer)
+        return agent
+
+    @staticmethod
+    def _system_prompt():
         today = datetime.datetime.now()
 
         system_prompt = (
             f"Текущая дата: {today}. Ты - ассистент для работы с Google Calendar. "
             "Доступные инструменты:"
-            "1. view_google_events - для просмотра событий (аргументы: time_min, time_max)"
-            "2. create_google_event - для создания событий (аргументы: summary, start_datetime, end_datetime)"
+            "1. view_google_events - для просмотра событий (аргументы: time_min, time_max, "
+            "page_token - если в прошлом ответе было сказано, что есть продолжение)"
+            "2. create_google_event - для создания событий (аргументы: summary, start_datetime, end_datetime, "
+            "необязательно calendar - название календаря, если пользователь назвал не основной)"
             "3. update_google_event - для обновления событий (аргументы: event_id, summary, start_datetime и др.)"
             "4. delete_google_event - для удаления событий (аргументы: event_id)"
-            "5. find_google_event - для получения id события (аргументы: summary, date)"
+            "5. find_google_event - для получения id события по названию, даже неточному "
+            "(аргументы: summary, необязательно date или диапазон date_from, date_to). "
+            "Возвращает список подходящих событий, лучшее совпадение первое. "
+            "6. bulk_create_google_events - для создания нескольких событий за один вызов "
+            "(аргументы: events - список объектов с полями как у create_google_event)"
+            "7. bulk_update_google_events - для обновления нескольких событий за один вызов "
+            "(аргументы: updates - список объектов с полями как у update_google_event)"
+            "8. bulk_delete_google_events - для удаления нескольких событий за один вызов "
+            "(аргументы: event_ids - список id)"
+            "9. find_free_slots - для поиска свободного времени под встречу (аргументы: date_from, date_to, "
+            "необязательно duration_minutes, attendees - email участников, work_start, work_end, buffer_minutes, "
+            "include_weekends). Если просят найти время или окно, используй его, а не view_google_events. "
+            "Если нужно изменить больше одного события, используй bulk-инструменты вместо нескольких вызовов. "
             "Все даты должны быть в формате ISO 8601."
             "Отвечай кратко, используй инструменты для выполнения действий."
         )
+        return system_prompt
+
+    def _with_system_prompt(self, state):
+        # Системный промпт подставляется на каждом шаге и не попадает в память
+        # агента, иначе при переиспользовании сессии он копится в истории
+        system_prompt = self._system_prompt()
+        messages = state["messages"]
+        if messages and messages[0].id == SUMMARY_ID:
+            system_prompt += f" Краткое содержание предыдущего разговора: {messages[0].content}"
+            messages = messages[1:]
+        return [SystemMessage(content=system_prompt)] + messages
+
+    async def _compact_history(self, state):
+        # Хук вызывается перед каждым обращением к модели, здесь же ждем разрешения на вызов
+        with tracer.span('agent.rate_limit'):
+            await llm_rate_limiter.acquire()
+        # Старые ходы сворачиваются в сводку, чтобы промпт не рос бесконечно
+        with tracer.span('agent.compaction'):
+            return await compaction_hook(self._summary_model, state)
 
+    async def ainvoke(self, message, route: str = 'main'):
         # Формируем сообщения для агента
         messages = [
-            SystemMessage(content=system_prompt),
             HumanMessage(content=message)
         ]
 
         # Вызываем агента
-        agent_response = await self._agent.ainvoke(
+        agent_response = await self._agent(route).ainvoke(
             {"messages": messages},
             config=self._config
         )
 
+        # Храним только последние чекпоинты диалога
+        await self._checkpointer.prune(self._user_id)
+
         return agent_response['messages'][-1].content
 
+    async def remember(self, message, answer):
+        """Дописывает в историю ход, на который ответили без агента (быстрый путь),
+        чтобы следующие реплики пользователя ("а остальные?") были понятны модели"""
+        await self._agent().aupdate_state(
+            self._config,
+            {"messages": [HumanMessage(content=message), AIMessage(content=answer)]},
+            as_node="agent"
+        )
+        await self._checkpointer.prune(self._user_id)
+
+    async def astream(self, message, route: str = 'main'):
+        """Выполняет ход агента, отдавая прогресс по мере появления.
+
+        Генерирует пары (вид, значение):
+        ("tool", имя инструмента) - агент вызывает инструмент;
+        ("token", текст) - очередной кусок ответа модели;
+        ("reset", None) - модель закончила шаг вызовом инструмента, накопленный текст не финальный;
+        ("answer", текст) - итоговый ответ, всегда последний.
+        """
+        messages = [
+            HumanMessage(content=message)
+        ]
+
+        agent = self._agent(route)
+        async for event in agent.astream_events(
+                {"messages": messages},
+                config=self._config,
+                version="v2"):
+            kind = event["event"]
+            # Модель вызывается и для сводки истории, ее токены пользователю не нужны
+            from_agent = event.get("metadata", {}).get("langgraph_node") == "agent"
+
+            if kind == "on_tool_start":
+                yield "tool", event["name"]
+            elif kind == "on_chat_model_stream" and from_agent:
+                content = event["data"]["chunk"].content
+                if content:
+                    yield "token", content
+            elif kind == "on_chat_model_end" and from_agent:
+                if getattr(event["data"].get("output"), "tool_calls", None):
+                    yield "reset", None
+
+        state = await agent.aget_state(self._config)
+
+        # Храним только последние чекпоинты диалога
+        await self._checkpointer.prune(self._user_id)
+
+        yield "answer", state.values["messages"][-1].content
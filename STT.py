@@ -1,48 +1,273 @@
 import os
 import json
+import time
+import asyncio
+import logging
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from vosk import KaldiRecognizer, Model
-from pydub import AudioSegment
 
+from config import VOSK_MODEL_PATH, STT_WORKERS, STT_QUEUE_SIZE, STT_QUEUE_TIMEOUT, STT_JOB_TIMEOUT
 
-model = Model("models/vosk/model")
 
+logger = logging.getLogger('STT')
 
-async def convert_ogg_to_wav(input_path: str, output_path: str):
-    """Конвертация OGG в WAV формата 16kHz mono"""
-    audio = AudioSegment.from_ogg(input_path)
-    audio = audio.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-    audio.export(output_path, format="wav")
+# 4000 кадров по 2 байта, как раньше при чтении WAV
+PCM_CHUNK_SIZE = 8000
+STREAM_CHUNK_SIZE = 16 * 1024
+# Сколько родитель ждет сверх таймаута задачи, прежде чем перестать ждать рабочий процесс
+JOB_TIMEOUT_GRACE = 10
+# Сколько последних байт stderr ffmpeg хранится для текста ошибки
+STDERR_TAIL = 4096
 
+# Модель и распознаватель живут в каждом рабочем процессе отдельно
+_worker_model = None
+_worker_recognizer = None
 
-async def recognize_speech(audio_path: str) -> str:
-    """Распознавание речи с помощью Vosk"""
-    rec = KaldiRecognizer(model, 16000)
-    rec.SetWords(True)
 
-    result = []
-    # Используем wave для корректной обработки WAV
-    import wave
-    with wave.open(audio_path, "rb") as wf:
-        # Проверяем параметры аудио
-        if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
-            raise ValueError("Аудиофайл должен быть в формате WAV: моно, 16 бит, без сжатия.")
+class STTBusyError(Exception):
+    """Очередь распознавания переполнена"""
+
+
+def _init_worker(model_path: str):
+    """Загружает модель один раз при старте рабочего процесса"""
+    global _worker_model, _worker_recognizer
+    _worker_model = Model(model_path)
+    _worker_recognizer = KaldiRecognizer(_worker_model, 16000)
+    _worker_recognizer.SetWords(True)
+
+
+def _ping():
+    return os.getpid()
+
+
+def _decoder(source):
+    """Запускает ffmpeg, который отдает 16kHz mono PCM в stdout по мере декодирования"""
+    from_file = isinstance(source, str)
+    return subprocess.Popen(
+        ['ffmpeg', '-loglevel', 'error', '-i', source if from_file else 'pipe:0',
+         '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', '16000', 'pipe:1'],
+        stdin=subprocess.DEVNULL if from_file else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+
+def _feed(stdin, source, errors: list):
+    """Передает OGG из памяти в ffmpeg из отдельного потока, чтобы не блокировать чтение PCM"""
+    try:
+        source = memoryview(source)
+        for offset in range(0, len(source), STREAM_CHUNK_SIZE):
+            stdin.write(source[offset:offset + STREAM_CHUNK_SIZE])
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
 
+
+def _drain(stream, tail: bytearray):
+    """Читает stderr ffmpeg, пока тот работает: иначе полный буфер канала остановит декодирование"""
+    for line in iter(stream.readline, b''):
+        tail.extend(line)
+        del tail[:-STDERR_TAIL]
+    stream.close()
+
+
+def _recognize_stream(source, timeout: float = STT_JOB_TIMEOUT):
+    """Потоково распознает аудио в рабочем процессе.
+
+    source - путь к файлу или байты OGG/Opus. PCM читается из ffmpeg
+    кусками и сразу уходит в распознаватель, поэтому декодирование и
+    распознавание идут параллельно, а память не зависит от длины записи.
+    Если задача не уложилась в timeout секунд, ffmpeg останавливается.
+    Возвращает текст, время декодирования и длительность аудио в секундах.
+    """
+    started = time.perf_counter()
+    rec = _worker_recognizer
+
+    process = _decoder(source)
+    feeder = None
+    feed_errors = []
+    if process.stdin is not None:
+        feeder = threading.Thread(target=_feed, args=(process.stdin, source, feed_errors), daemon=True)
+        feeder.start()
+    stderr_tail = bytearray()
+    drainer = threading.Thread(target=_drain, args=(process.stderr, stderr_tail), daemon=True)
+    drainer.start()
+    # После kill stdout закрывается, и цикл чтения ниже заканчивается
+    killer = threading.Timer(timeout, process.kill)
+    killer.start()
+
+    result = []
+    pcm_bytes = 0
+    try:
         while True:
-            data = wf.readframes(4000)
+            data = process.stdout.read(PCM_CHUNK_SIZE)
             if len(data) == 0:
                 break
+            pcm_bytes += len(data)
             if rec.AcceptWaveform(data):
                 result.append(rec.Result())
+    except BaseException:
+        rec.Reset()
+        raise
+    finally:
+        process.stdout.close()
+        if feeder is not None:
+            feeder.join()
+        returncode = process.wait()
+        timed_out = killer.finished.is_set() and returncode != 0
+        killer.cancel()
+        drainer.join()
 
+    # FinalResult сбрасывает распознаватель, его можно использовать для следующей задачи
     result.append(rec.FinalResult())
 
+    if timed_out:
+        raise TimeoutError("Голосовое сообщение распознавалось слишком долго")
+    if feed_errors:
+        raise feed_errors[0]
+    if returncode != 0:
+        raise ValueError(f"Не удалось декодировать аудио: {stderr_tail.decode(errors='replace').strip()}")
+
     # Собираем все результаты
     texts = []
     for res in result:
         if res:
             jres = json.loads(res)
-            if 'text' in jres:
+            if jres.get('text'):
                 texts.append(jres['text'])
 
-    return " ".join(texts)
+    # 16 бит, моно, 16000 Гц
+    audio_duration = pcm_bytes / (2 * 16000)
+    return " ".join(texts), time.perf_counter() - started, audio_duration
+
+
+class STTEngine:
+    """Пул процессов для распознавания речи с ограниченной очередью"""
+
+    def __init__(self, model_path: str = VOSK_MODEL_PATH, workers: int = STT_WORKERS,
+                 queue_size: int = STT_QUEUE_SIZE, queue_timeout: float = STT_QUEUE_TIMEOUT,
+                 job_timeout: float = STT_JOB_TIMEOUT):
+        self._model_path = model_path
+        self._job_timeout = job_timeout
+        self._total = (workers, queue_size)
+        self._workers = workers
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._pool = None
+        self._slots = None
+
+        # Метрики
+        self.queued = 0
+        self.running = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.last_decode_time = 0.0
+        self.total_decode_time = 0.0
+        self.total_audio_duration = 0.0
+
+    def share(self, shares: int):
+        """Делит процессы распознавания и очередь между shares воркерами.
+
+        У каждого воркера бота свой пул, поэтому без деления на машине
+        поднялось бы STT_WORKERS процессов с моделью на каждый воркер.
+        """
+        if self._pool is not None:
+            raise RuntimeError("STT engine is already started")
+        workers, queue_size = self._total
+        self._workers = max(1, workers // shares)
+        self._queue_size = max(1, queue_size // shares)
+
+    def start(self):
+        """Поднимает рабочие процессы и сразу загружает в них модель"""
+        if self._pool is not None:
+            return
+        self._pool = ProcessPoolExecutor(
+            max_workers=self._workers,
+            initializer=_init_worker,
+            initargs=(self._model_path,)
+        )
+        for _ in range(self._workers):
+            self._pool.submit(_ping)
+        logger.info(f"STT engine started with {self._workers} workers")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def recognize(self, source) -> str:
+        self.start()
+        if self._slots is None:
+            # Одновременно в пуле не больше workers + queue_size задач
+            self._slots = asyncio.Semaphore(self._workers + self._queue_size)
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise STTBusyError("Сейчас слишком много голосовых сообщений, попробуйте чуть позже")
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._pool, _recognize_stream, source, self._job_timeout)
+        except BaseException:
+            self._job_done(None)
+            raise
+        # Место в пуле освобождается, когда процесс действительно закончил задачу
+        future.add_done_callback(self._job_done)
+        # Процесс сам останавливает ffmpeg по таймауту, здесь - страховка на случай зависания распознавателя
+        text, decode_time, audio_duration = await asyncio.wait_for(
+            asyncio.shield(future), self._job_timeout + JOB_TIMEOUT_GRACE)
+
+        self.jobs += 1
+        self.last_decode_time = decode_time
+        self.total_decode_time += decode_time
+        self.total_audio_duration += audio_duration
+        logger.info(f"STT job decoded {audio_duration:.1f}s of audio in {decode_time:.2f}s, "
+                    f"queue depth {self.queue_depth}")
+        return text
+
+    def _job_done(self, future):
+        self.running -= 1
+        self._slots.release()
+        if future is not None and not future.cancelled():
+            future.exception()
+
+    @property
+    def queue_depth(self) -> int:
+        """Задачи, ожидающие свободного процесса"""
+        return self.queued + max(0, self.running - self._workers)
+
+    def stats(self) -> dict:
+        return {
+            'workers': self._workers,
+            'queue_depth': self.queue_depth,
+            'running': self.running,
+            'jobs': self.jobs,
+            'rejected': self.rejected,
+            'last_decode_time': self.last_decode_time,
+            'avg_decode_time': self.total_decode_time / self.jobs if self.jobs else 0.0,
+            # Отношение времени декодирования к длительности аудио
+            'real_time_factor': (self.total_decode_time / self.total_audio_duration
+                                 if self.total_audio_duration else 0.0),
+        }
+
+
+stt_engine = STTEngine()
+
 
+async def recognize_speech(source) -> str:
+    """Распознавание речи с помощью Vosk (путь к файлу или байты OGG)"""
+    return await stt_engine.recognize(source)
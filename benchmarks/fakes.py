@@ -0,0 +1,544 @@
+"""Локальные заменители Telegram, GigaChat и Google Calendar для замеров без сети"""
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import httplib2
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import SendMessage, EditMessageText, SendChatAction, GetFile
+from aiogram.types import Message, File
+from googleapiclient.errors import HttpError
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from history import SUMMARY_PROMPT
+
+
+TZ = datetime.timezone(datetime.timedelta(hours=3))
+
+# Так начинаются или помечаются ответы об ошибках: у инструментов "ERROR"/"Ошибка",
+# у обработчиков - еще и значки перед текстом
+ERROR_MARKERS = re.compile(r'ERROR|Ошибка|⚠️|❌')
+
+
+# Telegram
+
+class FakeTelegramSession(BaseSession):
+    """Сессия бота, которая ничего не отправляет, а записывает исходящие вызовы.
+
+    Сервер помечен как локальный, поэтому файлы голосовых берутся по пути
+    из files (file_id -> путь к клипу), как у локального Bot API.
+    """
+
+    def __init__(self, latency: float = 0.0, files: dict = None):
+        super().__init__(api=TelegramAPIServer.from_base('http://fake-telegram', is_local=True))
+        self.latency = latency
+        self.files = files or {}
+        self.calls = []
+        # (chat_id, message_id) -> последний текст сообщения с учетом правок
+        self.texts = {}
+        self._message_ids = itertools.count(1)
+
+    def _message(self, bot, chat_id, text, message_id=None):
+        return Message.model_validate({
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+        }, context={'bot': bot})
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append((time.monotonic(), type(method).__name__, getattr(method, 'chat_id', None)))
+
+        if isinstance(method, SendMessage):
+            message = self._message(bot, method.chat_id, method.text)
+            self.texts[(method.chat_id, message.message_id)] = method.text
+            return message
+        if isinstance(method, EditMessageText):
+            self.texts[(method.chat_id, method.message_id)] = method.text
+            return self._message(bot, method.chat_id, method.text, method.message_id)
+        if isinstance(method, SendChatAction):
+            return True
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_path=self.files[method.file_id])
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise NotImplementedError("Fake Telegram session does not serve files by URL")
+        yield b''
+
+    async def close(self):
+        pass
+
+    def count(self, name: str) -> int:
+        return sum(1 for call in self.calls if call[1] == name)
+
+    def error_replies(self) -> list:
+        """Итоговые тексты сообщений бота, сообщающих об ошибке"""
+        return [text for text in self.texts.values() if ERROR_MARKERS.search(text)]
+
+
+# GigaChat
+
+def _fill(value, context: dict):
+    if isinstance(value, str):
+        return value.format(**context)
+    if isinstance(value, dict):
+        return {key: _fill(item, context) for key, item in value.items()}
+    return value
+
+
+# План: (регулярное выражение по запросу, шаги). Шаг - либо список вызовов
+# инструментов (имя, аргументы), либо итоговый текст. В аргументах доступны
+# {today}, {tomorrow}, {week} и {id} - первый id из ответа предыдущего инструмента
+DEFAULT_PLANS = [
+    (r'чем я занят|что по планам|расскажи', [
+        [('view_google_events', {'time_min': '{today}', 'time_max': '{week}'})],
+        "На этой неделе у вас несколько встреч, самые важные - планерки по утрам.",
+    ]),
+    (r'найди.*(час|время|окно)|свободн', [
+        [('find_free_slots', {'date_from': '{today}', 'date_to': '{week}', 'duration_minutes': 60,
+                              'attendees': ['colleague@example.com']})],
+        "Нашел несколько свободных окон, ближайшее - завтра утром.",
+    ]),
+    (r'перенеси|сдвинь', [
+        [('find_google_event', {'summary': 'Планерка'})],
+        [('update_google_event', {'event_id': '{id}', 'start_datetime': '{tomorrow}T12:00:00+03:00',
+                                  'end_datetime': '{tomorrow}T12:30:00+03:00'})],
+        "Перенес планерку на завтра, 12:00.",
+    ]),
+    (r'создай|добавь|запланируй', [
+        [('create_google_event', {'summary': 'Встреча с подрядчиком', 'start_datetime': '{tomorrow}T15:00:00+03:00',
+                                  'end_datetime': '{tomorrow}T16:00:00+03:00'})],
+        "Готово, встреча с подрядчиком создана на завтра в 15:00.",
+    ]),
+    (r'удали|отмени', [
+        [('find_google_event', {'summary': 'Обед'})],
+        [('delete_google_event', {'event_id': '{id}'})],
+        "Удалил.",
+    ]),
+    (r'', [
+        "Я помогу с календарем: могу показать, создать, перенести или удалить события.",
+    ]),
+]
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Модель, которая вместо генерации следует заранее заданным планам вызовов инструментов"""
+
+    model: str = 'scripted'
+    latency: float = 0.5
+    jitter: float = 0.1
+    token_delay: float = 0.01
+    plans: list = DEFAULT_PLANS
+    seed: int = 0
+    calls: int = 0
+    # Результаты инструментов с ошибкой, которые модель получила в ответ на свои вызовы
+    tool_errors: list = []
+
+    @property
+    def _llm_type(self) -> str:
+        return 'scripted'
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def bind_functions(self, functions, **kwargs):
+        return self
+
+    def _delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def _next_message(self, messages) -> AIMessage:
+        self.calls += 1
+        if messages and messages[0].content == SUMMARY_PROMPT:
+            return AIMessage(content="Пользователь просматривал и менял события в календаре.")
+
+        # Результаты инструментов предыдущего шага идут в конце, после вызвавшего их сообщения
+        for message in reversed(messages):
+            if not isinstance(message, ToolMessage):
+                break
+            if ERROR_MARKERS.search(str(message.content)):
+                self.tool_errors.append(f'{message.name}: {message.content}')
+
+        last_human = max((index for index, message in enumerate(messages) if isinstance(message, HumanMessage)),
+                         default=0)
+        request = str(messages[last_human].content).lower() if messages else ''
+        step = sum(1 for message in messages[last_human:] if isinstance(message, AIMessage))
+
+        steps = next(steps for pattern, steps in self.plans if re.search(pattern, request))
+        if step >= len(steps):
+            return AIMessage(content=steps[-1] if isinstance(steps[-1], str) else "Готово.")
+        if isinstance(steps[step], str):
+            return AIMessage(content=steps[step])
+
+        previous = next((str(message.content) for message in reversed(messages) if isinstance(message, ToolMessage)), '')
+        found = re.search(r'id=([^:\s]+)', previous)
+        today = datetime.datetime.now(TZ).date()
+        context = {
+            'today': today.isoformat(),
+            'tomorrow': (today + datetime.timedelta(days=1)).isoformat(),
+            'week': (today + datetime.timedelta(days=7)).isoformat(),
+            'id': found.group(1) if found else 'missing',
+        }
+        tool_calls = [{'name': name, 'args': _fill(args, context), 'id': f'call_{self.calls}_{index}'}
+                      for index, (name, args) in enumerate(steps[step])]
+        return AIMessage(content='', tool_calls=tool_calls)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._delay())
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._delay())
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # Задержка до первого токена, потом текст идет по словам
+        await asyncio.sleep(self._delay())
+        message = self._next_message(messages)
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content='', tool_call_chunks=[
+                {'name': call['name'], 'args': json.dumps(call['args'], ensure_ascii=False),
+                 'id': call['id'], 'index': index}
+                for index, call in enumerate(message.tool_calls)
+            ]))
+            return
+        for word in re.findall(r'\S+\s*', message.content):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(word, chunk=chunk)
+            yield chunk
+
+
+# Google Calendar
+
+WORK_TITLES = ['Созвон с Петей', '1:1 с Машей', 'Ревью дизайна', 'Встреча с клиентом', 'Демо спринта',
+               'Собеседование', 'Обед', 'Обсуждение бюджета', 'Звонок юристу', 'Синк с маркетингом']
+WEEKEND_TITLES = ['Спортзал', 'Встреча с друзьями', 'Стоматолог', 'Театр', 'Поездка за город']
+# Названия дополнительных календарей пользователя
+EXTRA_CALENDARS = ['Работа', 'Семья', 'Спорт', 'Дни рождения', 'Команда', 'Праздники']
+
+
+def _http_error(status: int, reason: str) -> HttpError:
+    return HttpError(httplib2.Response({'status': status}), reason.encode())
+
+
+class FakeCalendar:
+    """Календари пользователей в памяти, отвечающие как Calendar API v3.
+
+    Поддерживает то, чем пользуется бот: events.list (в том числе
+    инкрементально по syncToken), get, insert, patch с If-Match, delete,
+    batch-запросы, каналы events.watch (уведомления доставляет FakePushSource),
+    calendarList и freebusy.query. У каждого пользователя calendars
+    календарей: основной и дополнительные со своими событиями. Каждый
+    запрос спит latency секунд в потоке, который его выполняет, как
+    настоящий сетевой вызов.
+    """
+
+    def __init__(self, latency: float = 0.05, days_back: int = 30, days_ahead: int = 60, seed: int = 0,
+                 calendars: int = 1):
+        self.latency = latency
+        self.calendars = calendars
+        self._days_back = days_back
+        self._days_ahead = days_ahead
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._users = {}
+        self._sequence = itertools.count(1)
+        self.requests = 0
+        # id канала -> данные канала events.watch
+        self.channels = {}
+        self.push_source = None
+
+    def _generate(self, user_id):
+        rng = random.Random(f'{self._seed}:{user_id}')
+        events = {}
+        today = datetime.datetime.now(TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+        for offset in range(-self._days_back, self._days_ahead):
+            day = today + datetime.timedelta(days=offset)
+            slots = []
+            if day.weekday() < 5:
+                slots.append(('Планерка', day.replace(hour=10), 30))
+                for _ in range(rng.randint(1, 4)):
+                    slots.append((rng.choice(WORK_TITLES), day.replace(hour=rng.randint(11, 18)), rng.choice((30, 60, 90))))
+            elif rng.random() < 0.6:
+                slots.append((rng.choice(WEEKEND_TITLES), day.replace(hour=rng.randint(10, 19)), rng.choice((60, 120))))
+            for summary, start, minutes in slots:
+                self._store(events, {
+                    'summary': summary,
+                    'start': {'dateTime': start.isoformat(), 'timeZone': 'Europe/Moscow'},
+                    'end': {'dateTime': (start + datetime.timedelta(minutes=minutes)).isoformat(),
+                            'timeZone': 'Europe/Moscow'},
+                })
+        return {'events': events, 'log': []}
+
+    def _store(self, events, event, event_id=None):
+        sequence = next(self._sequence)
+        event = dict(event, id=event_id or f'ev{sequence:08d}', status='confirmed', etag=f'"{sequence}"')
+        event['htmlLink'] = f"https://calendar.google.com/calendar/event?eid={event['id']}"
+        events[event['id']] = event
+        return event, sequence
+
+    def _user(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = self._generate(user_id)
+        return user
+
+    def service(self, user_id: int):
+        return FakeCalendarService(self, user_id)
+
+    # Реализация методов API (вызывается под замком из FakeRequest.execute)
+
+    def list(self, user_id, syncToken=None, pageToken=None, maxResults=250, timeMin=None, orderBy=None, **params):
+        user = self._user(user_id)
+        if syncToken is not None:
+            since = int(syncToken)
+            changed = {event_id for sequence, event_id in user['log'] if sequence > since}
+            items = [user['events'].get(event_id, {'id': event_id, 'status': 'cancelled'}) for event_id in changed]
+        else:
+            items = list(user['events'].values())
+            if timeMin is not None:
+                bound = datetime.datetime.fromisoformat(timeMin.replace('Z', '+00:00'))
+                items = [item for item in items if datetime.datetime.fromisoformat(item['end']['dateTime']) > bound]
+            if orderBy == 'startTime':
+                items.sort(key=lambda item: item['start']['dateTime'])
+
+        offset = int(pageToken or 0)
+        page = {'items': [dict(item) for item in items[offset:offset + maxResults]]}
+        if offset + maxResults < len(items):
+            page['nextPageToken'] = str(offset + maxResults)
+        else:
+            page['nextSyncToken'] = str(next(self._sequence))
+        return page
+
+    def get(self, user_id, eventId, **params):
+        event = self._user(user_id)['events'].get(eventId)
+        if event is None:
+            raise _http_error(404, 'Not Found')
+        return dict(event)
+
+    def insert(self, user_id, body, **params):
+        user = self._user(user_id)
+        event, sequence = self._store(user['events'], body)
+        user['log'].append((sequence, event['id']))
+        self._changed(user_id)
+        return dict(event)
+
+    def patch(self, user_id, eventId, body, headers=None, **params):
+        user = self._user(user_id)
+        event = user['events'].get(eventId)
+        if event is None:
+            raise _http_error(404, 'Not Found')
+        if headers and headers.get('If-Match') and headers['If-Match'] != event['etag']:
+            raise _http_error(412, 'Precondition Failed')
+        event, sequence = self._store(user['events'], dict(event, **body), eventId)
+        user['log'].append((sequence, eventId))
+        self._changed(user_id)
+        return dict(event)
+
+    def delete(self, user_id, eventId, **params):
+        user = self._user(user_id)
+        if user['events'].pop(eventId, None) is None:
+            raise _http_error(410, 'Resource has been deleted')
+        user['log'].append((next(self._sequence), eventId))
+        self._changed(user_id)
+        return ''
+
+    def watch(self, user_id, body, calendarId='primary', **params):
+        ttl = float(body.get('params', {}).get('ttl', 7 * 24 * 60 * 60))
+        channel = {'id': body['id'], 'user_id': user_id, 'token': body.get('token', ''),
+                   'resource_id': f'resource-{user_id}', 'expiration': time.time() + ttl}
+        self.channels[channel['id']] = channel
+        self._notify(channel, 'sync')
+        return {'kind': 'api#channel', 'id': channel['id'], 'resourceId': channel['resource_id'],
+                'resourceUri': f'https://www.googleapis.com/calendar/v3/calendars/{calendarId}/events',
+                'expiration': str(int(channel['expiration'] * 1000))}
+
+    def stop_channel(self, user_id, body, **params):
+        if self.channels.pop(body['id'], None) is None:
+            raise _http_error(404, 'Channel not found')
+        return ''
+
+    def calendar_list(self, user_id, **params):
+        items = [{'id': f'user{user_id}@example.com', 'summary': f'user{user_id}@example.com', 'primary': True,
+                  'selected': True, 'accessRole': 'owner', 'timeZone': 'Europe/Moscow'}]
+        for index in range(self.calendars - 1):
+            items.append({'id': f'cal{index}-{user_id}@group.calendar.google.com',
+                          'summary': EXTRA_CALENDARS[index % len(EXTRA_CALENDARS)],
+                          'selected': True, 'accessRole': 'owner', 'timeZone': 'Europe/Moscow'})
+        return {'items': items}
+
+    def freebusy_query(self, user_id, body, **params):
+        time_min = datetime.datetime.fromisoformat(body['timeMin'].replace('Z', '+00:00'))
+        time_max = datetime.datetime.fromisoformat(body['timeMax'].replace('Z', '+00:00'))
+        calendars = {}
+        for item in body.get('items', []):
+            # Дополнительный календарь или календарь участника - отдельный сгенерированный календарь
+            owner = user_id if item['id'] == 'primary' else (user_id, item['id'])
+            busy = []
+            for event in self._user(owner)['events'].values():
+                start = datetime.datetime.fromisoformat(event['start']['dateTime'])
+                end = datetime.datetime.fromisoformat(event['end']['dateTime'])
+                if start < time_max and end > time_min:
+                    busy.append((start, end))
+            busy.sort()
+            calendars[item['id']] = {'busy': [
+                {'start': start.astimezone(datetime.timezone.utc).isoformat().replace('+00:00', 'Z'),
+                 'end': end.astimezone(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')}
+                for start, end in busy
+            ]}
+        return {'kind': 'calendar#freeBusy', 'timeMin': body['timeMin'], 'timeMax': body['timeMax'],
+                'calendars': calendars}
+
+    def _changed(self, user_id):
+        now = time.time()
+        for channel in list(self.channels.values()):
+            if channel['user_id'] == user_id and channel['expiration'] > now:
+                self._notify(channel, 'exists')
+
+    def _notify(self, channel, state):
+        if self.push_source is not None:
+            self.push_source.notify(channel, state)
+
+    def change(self, user_id: int, event: dict) -> dict:
+        """Изменение "со стороны пользователя" в обход бота, как правка в веб-интерфейсе"""
+        with self._lock:
+            if event.get('id') in self._user(user_id)['events']:
+                return self.patch(user_id, event['id'], event)
+            return self.insert(user_id, event)
+
+
+class FakeRequest:
+    """Аналог googleapiclient HttpRequest: выполняется синхронно через execute"""
+
+    def __init__(self, calendar: FakeCalendar, method: str, user_id: int, params: dict):
+        self._calendar = calendar
+        self._method = method
+        self._user_id = user_id
+        self._params = params
+        self.headers = {}
+        self.http = SimpleNamespace(credentials=None)
+
+    def _call(self):
+        params = dict(self._params)
+        if self._method == 'patch':
+            params['headers'] = self.headers
+        # События неосновного календаря хранятся как у отдельного "пользователя" (user_id, календарь)
+        calendar_id = params.pop('calendarId', 'primary')
+        owner = self._user_id if calendar_id == 'primary' else (self._user_id, calendar_id)
+        with self._calendar._lock:
+            self._calendar.requests += 1
+            return getattr(self._calendar, self._method)(owner, **params)
+
+    def execute(self, http=None, num_retries=0):
+        if self._calendar.latency:
+            time.sleep(self._calendar.latency)
+        return self._call()
+
+
+class FakeBatch:
+    def __init__(self, calendar: FakeCalendar, callback):
+        self._calendar = calendar
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request_id, request))
+
+    def execute(self, http=None):
+        # Один сетевой вызов на весь batch
+        if self._calendar.latency:
+            time.sleep(self._calendar.latency)
+        for request_id, request in self._requests:
+            try:
+                response, error = request._call(), None
+            except HttpError as e:
+                response, error = None, e
+            self._callback(request_id, response, error)
+
+
+class FakeEvents:
+    def __init__(self, calendar: FakeCalendar, user_id: int):
+        self._calendar = calendar
+        self._user_id = user_id
+
+    def __getattr__(self, method):
+        if method not in ('list', 'get', 'insert', 'patch', 'delete', 'watch'):
+            raise AttributeError(method)
+        return lambda **params: FakeRequest(self._calendar, method, self._user_id, params)
+
+
+class FakeCalendarService:
+    def __init__(self, calendar: FakeCalendar, user_id: int):
+        self._calendar = calendar
+        self._user_id = user_id
+
+    def events(self):
+        return FakeEvents(self._calendar, self._user_id)
+
+    def channels(self):
+        return SimpleNamespace(stop=lambda **params: FakeRequest(self._calendar, 'stop_channel', self._user_id, params))
+
+    def calendarList(self):
+        return SimpleNamespace(list=lambda **params: FakeRequest(self._calendar, 'calendar_list', self._user_id,
+                                                                 params))
+
+    def freebusy(self):
+        return SimpleNamespace(query=lambda **params: FakeRequest(self._calendar, 'freebusy_query', self._user_id,
+                                                                  params))
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self._calendar, callback)
+
+
+class FakePushSource:
+    """Доставляет уведомления каналов FakeCalendar в calendar_push.deliver без HTTP.
+
+    Календарь меняется в потоке запроса, поэтому доставка переносится
+    в цикл событий, как если бы Google прислал POST на веб-сервер.
+    """
+
+    def __init__(self, calendar: FakeCalendar, deliver, loop: asyncio.AbstractEventLoop = None,
+                 delay: float = 0.0):
+        calendar.push_source = self
+        self._deliver = deliver
+        self._loop = loop or asyncio.get_running_loop()
+        self._delay = delay
+        self._numbers = itertools.count(1)
+        self._tasks = set()
+        # HTTP-статусы ответов на доставленные уведомления
+        self.statuses = []
+
+    def notify(self, channel: dict, state: str):
+        headers = {
+            'X-Goog-Channel-ID': channel['id'],
+            'X-Goog-Channel-Token': channel['token'],
+            'X-Goog-Resource-ID': channel['resource_id'],
+            'X-Goog-Resource-State': state,
+            'X-Goog-Message-Number': str(next(self._numbers)),
+        }
+        self._loop.call_soon_threadsafe(self._spawn, headers)
+
+    def _spawn(self, headers):
+        task = self._loop.create_task(self._send(headers))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, headers):
+        if self._delay:
+            await asyncio.sleep(self._delay)
+        self.statuses.append(await self._deliver(headers))
@@ -0,0 +1,334 @@
+"""Замер бота целиком без сети: python -m benchmarks.run --users 50 --turns 500
+
+Обновления Telegram идут через настоящий Dispatcher с command_router и
+text_router, а Telegram, GigaChat и Google Calendar заменены локальными
+заглушками из benchmarks.fakes. Результат - JSON с задержками ходов,
+пропускной способностью, real-time factor распознавания и пиковой памятью.
+С --baseline результат сравнивается с прошлым прогоном, и при регрессии
+больше --tolerance процесс завершается с кодом 1. Так же он завершается,
+если были ошибки: исключения обработчиков, ответы пользователю об ошибке
+или ошибки инструментов, которые получила модель.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+# Фразы, которые быстрый путь разбирает без LLM
+FAST_PATH_TEXTS = ['что у меня завтра', 'какие встречи на следующей неделе', 'покажи расписание в пятницу',
+                   'что у меня сегодня', 'какие планы на выходные']
+# Фразы для агента, каждая попадает в свой план ScriptedChatModel
+AGENT_TEXTS = ['Расскажи, чем я занят на этой неделе', 'Перенеси планерку на завтра на 12',
+               'Создай встречу с подрядчиком завтра в 15:00', 'Отмени обед, пожалуйста',
+               'Найди мне час на созвон с коллегой на этой неделе',
+               'Привет! Что ты умеешь?']
+COMMANDS = ['/events', '/start', '/login']
+
+CLIP_SUFFIXES = ('.ogg', '.oga', '.opus', '.wav', '.mp3')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help="число пользователей")
+    parser.add_argument('--turns', type=int, default=500, help="число обновлений за прогон")
+    parser.add_argument('--concurrency', type=int, default=16, help="обновлений в обработке одновременно")
+    parser.add_argument('--mix', default='fast=0.4,agent=0.4,command=0.1,voice=0.1',
+                        help="доли сценариев fast, agent, command и voice")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="задержка ответа модели, с")
+    parser.add_argument('--llm-jitter', type=float, default=0.1)
+    parser.add_argument('--token-delay', type=float, default=0.01, help="задержка между словами в потоке, с")
+    parser.add_argument('--calendar-latency', type=float, default=0.05, help="задержка запроса к календарю, с")
+    parser.add_argument('--calendars', type=int, default=1, help="число календарей у пользователя")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="задержка вызова Bot API, с")
+    parser.add_argument('--clips', default='models/vosk', help="каталог с голосовыми клипами")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="куда записать JSON (по умолчанию stdout)")
+    parser.add_argument('--baseline', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое ухудшение, доля")
+    return parser.parse_args(argv)
+
+
+def prepare_environment(workdir: str):
+    """Окружение до импорта модулей бота: config читает его один раз при импорте"""
+    client_secret = os.path.join(workdir, 'client_secret.json')
+    with open(client_secret, 'w') as f:
+        json.dump({'web': {
+            'client_id': 'benchmark.apps.googleusercontent.com',
+            'client_secret': 'benchmark',
+            'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+            'token_uri': 'https://oauth2.googleapis.com/token',
+        }}, f)
+
+    defaults = {
+        'BOT_TOKEN': '123456789:BENCHMARKbenchmarkBENCHMARKbenchmark0',
+        'GOOGLE_CLIENT_SECRET_FILE': client_secret,
+        'GOOGLE_SCOPES': 'https://www.googleapis.com/auth/calendar',
+        'GOOGLE_REDIRECT_URI': 'http://localhost:8080/callback',
+        'CALENDAR_MIRROR_PATH': os.path.join(workdir, 'calendar_mirror.sqlite3'),
+        'CONVERSATIONS_DB_PATH': os.path.join(workdir, 'conversations.sqlite3'),
+        'CREDENTIALS_DB_PATH': os.path.join(workdir, 'credentials.sqlite3'),
+        'STATE_BACKEND_URL': 'sqlite:///' + os.path.join(workdir, 'state.sqlite3'),
+        # Ход целиком занимает в основном ожидание фальшивой модели, поэтому
+        # ограничение частоты снимаем, если его не задали явно
+        'LLM_RATE_LIMIT': '1000',
+        'LLM_RATE_BURST': '1000',
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def find_clips(directory: str) -> list:
+    clips = []
+    for root, _, files in os.walk(directory):
+        clips.extend(os.path.join(root, name) for name in files if name.lower().endswith(CLIP_SUFFIXES))
+    return sorted(clips)
+
+
+def parse_mix(mix: str) -> dict:
+    shares = {}
+    for part in mix.split(','):
+        name, share = part.split('=')
+        shares[name.strip()] = float(share)
+    return shares
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+
+    def percentile(q):
+        return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': values[-1] if values else 0.0,
+    }
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss в Linux в килобайтах
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def message_update(update_id: int, user_id: int, **content) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            **content,
+        },
+    }
+
+
+def workload(args, clips: list) -> list:
+    """Список (сценарий, user_id, содержимое сообщения)"""
+    rng = random.Random(args.seed)
+    shares = parse_mix(args.mix)
+    if not clips:
+        shares.pop('voice', None)
+    scenarios, weights = zip(*shares.items())
+
+    turns = []
+    for _ in range(args.turns):
+        scenario = rng.choices(scenarios, weights)[0]
+        user_id = 100000 + rng.randrange(args.users)
+        if scenario == 'fast':
+            content = {'text': rng.choice(FAST_PATH_TEXTS)}
+        elif scenario == 'agent':
+            content = {'text': rng.choice(AGENT_TEXTS)}
+        elif scenario == 'command':
+            command = rng.choice(COMMANDS)
+            content = {'text': command, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}
+        else:
+            index = rng.randrange(len(clips))
+            content = {'voice': {'file_id': f'clip{index}', 'file_unique_id': f'clip{index}', 'duration': 5}}
+        turns.append((scenario, user_id, content))
+    return turns
+
+
+def patch_services(calendar, model):
+    """Подменяет внешние сервисы в модулях, которые ими пользуются"""
+    import handlers.command_handlers
+    import handlers.text_handlers
+    import intent_router
+    import tools.google_calendar
+    import write_coalescer
+
+    # Все пользователи считаются авторизованными
+    credentials = {}
+    for module in (handlers.command_handlers, intent_router, tools.google_calendar, write_coalescer):
+        module.get_calendar_service = lambda user_id, creds_data: calendar.service(user_id)
+        module.credentials_store = credentials
+    handlers.text_handlers.get_model = lambda route='main': model
+    return credentials
+
+
+async def run(args, clips: list) -> dict:
+    from aiogram import Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from aiogram.types import Update
+
+    from benchmarks.fakes import FakeCalendar, FakeTelegramSession, ScriptedChatModel
+    from db import bot
+    from gigachain_module import llm_metrics
+    from handlers.command_handlers import command_router
+    from handlers.text_handlers import text_router, session_manager
+    from intent_router import intent_router
+    from tool_memo import tool_memo
+    from turn_scheduler import turn_scheduler, llm_rate_limiter
+    from calendar_mirror import calendar_mirror
+    from calendars import calendar_directory
+    from STT import stt_engine
+    from conversation_store import close_checkpointer
+
+    random.seed(args.seed)
+    calendar = FakeCalendar(latency=args.calendar_latency, seed=args.seed, calendars=args.calendars)
+    model = ScriptedChatModel(latency=args.llm_latency, jitter=args.llm_jitter, token_delay=args.token_delay)
+    session = FakeTelegramSession(latency=args.telegram_latency,
+                                  files={f'clip{index}': clip for index, clip in enumerate(clips)})
+    bot.session = session
+
+    credentials = patch_services(calendar, model)
+    for user_id in range(100000, 100000 + args.users):
+        credentials[user_id] = {'token': 'benchmark'}
+
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(command_router)
+    dp.include_router(text_router)
+
+    turns = workload(args, clips)
+    if clips:
+        stt_engine.start()
+
+    latencies = {}
+    errors = []
+    slots = asyncio.Semaphore(args.concurrency)
+    update_ids = itertools.count(1)
+
+    async def feed(scenario, user_id, content):
+        update = Update.model_validate(message_update(next(update_ids), user_id, **content), context={'bot': bot})
+        async with slots:
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                errors.append(f'{scenario}: {e!r}')
+            latencies.setdefault(scenario, []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(*turn) for turn in turns))
+    elapsed = time.perf_counter() - started
+    await close_checkpointer()
+
+    # Сбои инструментов уходят модели строкой, а сбои обработчиков - пользователю
+    # ответом, поэтому исключений до feed_update почти не доходит
+    errors.extend(f'reply: {text}' for text in session.error_replies())
+    errors.extend(f'tool: {result}' for result in model.tool_errors)
+
+    stt = None
+    if not clips:
+        stt = {'skipped': f'no audio clips found in {args.clips}'}
+    else:
+        stt = stt_engine.stats()
+        stt['clips'] = len(clips)
+        if not stt['jobs']:
+            stt['skipped'] = 'no clip was recognized, check VOSK_MODEL_PATH'
+        stt_engine.shutdown()
+
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'elapsed': elapsed,
+        'throughput': len(all_latencies) / elapsed if elapsed else 0.0,
+        'latency': {'all': percentiles(all_latencies),
+                    **{scenario: percentiles(values) for scenario, values in sorted(latencies.items())}},
+        'errors': {'count': len(errors), 'sample': errors[:10]},
+        'telegram': {'send_message': session.count('SendMessage'),
+                     'edit_message_text': session.count('EditMessageText'),
+                     'send_chat_action': session.count('SendChatAction')},
+        'calendar': {'requests': calendar.requests},
+        'llm': {'calls': model.calls, 'metrics': llm_metrics.stats(), 'rate_limiter': llm_rate_limiter.stats()},
+        'components': {
+            'turn_scheduler': turn_scheduler.stats(),
+            'intent_router': intent_router.stats(),
+            'tool_memo': tool_memo.stats(),
+            'calendar_mirror': calendar_mirror.stats(),
+            'calendars': calendar_directory.stats(),
+            'sessions': session_manager.stats(),
+        },
+        'stt': stt,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# (путь в отчете, больше - лучше)
+COMPARED = [
+    (('latency', 'all', 'p50'), False),
+    (('latency', 'all', 'p95'), False),
+    (('latency', 'all', 'p99'), False),
+    (('throughput',), True),
+    (('peak_rss_mb', 'self'), False),
+]
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Метрики, ухудшившиеся больше чем на tolerance относительно baseline"""
+    regressions = []
+    for path, higher_is_better in COMPARED:
+        current, previous = report, baseline
+        for key in path:
+            current, previous = current.get(key, {}), previous.get(key, {})
+        if not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append({'metric': '.'.join(path), 'baseline': previous, 'current': current,
+                                'change': change})
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    try:
+        prepare_environment(workdir)
+        clips = find_clips(args.clips)
+        report = asyncio.run(run(args, clips))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    status = 1 if report['errors']['count'] else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+        if report['regressions']:
+            status = 1
+
+    output = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,413 @@
+import asyncio
+import datetime
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from googleapiclient.errors import HttpError
+
+from config import CALENDAR_MIRROR_PATH, CALENDAR_MIRROR_MAX_AGE, CALENDAR_MIRROR_DAYS_BACK, SQLITE_BUSY_TIMEOUT
+from google_services import aexecute, iter_events, EVENT_FIELDS
+from state_backend import sqlite_pragmas
+
+
+logger = logging.getLogger('calendarMirror')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    user_id INTEGER NOT NULL,
+    calendar_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, calendar_id, event_id)
+);
+CREATE INDEX IF NOT EXISTS events_by_start ON events (user_id, calendar_id, start_ts);
+CREATE TABLE IF NOT EXISTS sync_state (
+    user_id INTEGER NOT NULL,
+    calendar_id TEXT NOT NULL,
+    sync_token TEXT,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (user_id, calendar_id)
+);
+'''
+
+
+def event_time(value: dict) -> datetime.datetime:
+    """Время начала/конца события в UTC (для событий на весь день - полночь UTC)"""
+    if 'dateTime' in value:
+        moment = datetime.datetime.fromisoformat(value['dateTime'].replace('Z', '+00:00'))
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        return moment.astimezone(datetime.timezone.utc)
+    day = datetime.date.fromisoformat(value['date'])
+    return datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc)
+
+
+def _timestamp(moment: datetime.datetime) -> float:
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def format_cursor(start_ts: float, event_id: str) -> str:
+    """Курсор страницы: время начала и id последнего показанного события"""
+    return f'{start_ts!r}~{event_id}'
+
+
+def parse_cursor(cursor: str):
+    after_ts, after_id = cursor.split('~', 1)
+    return float(after_ts), after_id
+
+
+def _isoformat(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+class CalendarMirror:
+    """Локальная копия календарей пользователей в SQLite.
+
+    Первый запрос делает полную синхронизацию, дальше копия догоняется
+    инкрементально по syncToken, если она старше max_age секунд.
+    Копия хранит только события, которые заканчиваются не раньше чем
+    days_back дней назад: полная синхронизация запрашивается с timeMin,
+    а более старые события вычищаются при каждой синхронизации. Запросы
+    к более раннему времени дочитываются из Google напрямую.
+    """
+
+    def __init__(self, path: str = CALENDAR_MIRROR_PATH, max_age: float = CALENDAR_MIRROR_MAX_AGE,
+                 days_back: float = CALENDAR_MIRROR_DAYS_BACK):
+        self._path = path
+        self._connection = None
+        self._max_age = max_age
+        self._days_back = days_back
+        self._locks = {}
+        # Номер версии копии пользователя, растет при каждом изменении
+        self._revisions = {}
+        # Функции listener(user_id), которые вызываются после каждого изменения
+        self._listeners = []
+
+        # Метрики
+        self.full_syncs = 0
+        self.incremental_syncs = 0
+        self.fresh_reads = 0
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # Файл открывается при первом обращении, а не при импорте модуля
+        if self._connection is None:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self._path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+            connection.executescript(sqlite_pragmas())
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def use_shard(self, shard: int):
+        """Отдельный файл копии для воркера.
+
+        Запросы к копии синхронные и идут в цикле событий, поэтому ждать
+        блокировку записи, которую держит другой процесс, они не должны.
+        Пользователь всегда обрабатывается одним воркером, так что его
+        события нужны только в файле этого воркера (а версии копии и так
+        живут в памяти процесса).
+        """
+        if self._connection is not None:
+            raise RuntimeError("Calendar mirror is already open")
+        root, extension = os.path.splitext(self._path)
+        self._path = f'{root}.{shard}{extension}'
+
+    def window_start(self) -> float:
+        """Начало окна копии (timestamp): события, закончившиеся раньше, в копии не хранятся"""
+        return time.time() - self._days_back * 24 * 60 * 60
+
+    def _lock(self, user_id, calendar_id):
+        key = (user_id, calendar_id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def _bump(self, user_id):
+        self._revisions[user_id] = self._revisions.get(user_id, 0) + 1
+        for listener in self._listeners:
+            listener(user_id)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def revision(self, user_id: int) -> int:
+        """Версия копии пользователя, по ней производные индексы понимают, что пора перестроиться"""
+        return self._revisions.get(user_id, 0)
+
+    def _sync_state(self, user_id, calendar_id):
+        return self._db.execute(
+            'SELECT sync_token, synced_at FROM sync_state WHERE user_id = ? AND calendar_id = ?',
+            (user_id, calendar_id)
+        ).fetchone()
+
+    async def sync(self, user_id: int, service, calendar_id: str = 'primary', force: bool = False):
+        """Догоняет копию календаря, если она устарела"""
+        async with self._lock(user_id, calendar_id):
+            state = self._sync_state(user_id, calendar_id)
+            if state and state[0] and not force and time.time() - state[1] < self._max_age:
+                self.fresh_reads += 1
+                return
+
+            sync_token = state[0] if state else None
+            try:
+                await self._pull(user_id, service, calendar_id, sync_token)
+            except HttpError as e:
+                # 410 - токен протух, нужна полная синхронизация заново
+                if e.resp.status != 410 or sync_token is None:
+                    raise
+                logger.info(f"Sync token expired for {user_id}/{calendar_id}, doing full sync")
+                await self._pull(user_id, service, calendar_id, None)
+
+    async def _pull(self, user_id, service, calendar_id, sync_token):
+        changes = []
+        page_token = None
+        window_start = self.window_start()
+        while True:
+            params = {'calendarId': calendar_id, 'singleEvents': True, 'maxResults': 2500,
+                      'fields': f'nextPageToken,nextSyncToken,items({EVENT_FIELDS})'}
+            if sync_token:
+                params['syncToken'] = sync_token
+            else:
+                # Полная синхронизация только за окно: вся история календаря копии не нужна
+                params['timeMin'] = _isoformat(window_start)
+            if page_token:
+                params['pageToken'] = page_token
+
+            page = await aexecute(service.events().list(**params), user_id)
+            changes.extend(page.get('items', []))
+
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                next_sync_token = page.get('nextSyncToken')
+                break
+
+        with self._db:
+            if sync_token is None:
+                self._db.execute('DELETE FROM events WHERE user_id = ? AND calendar_id = ?',
+                                 (user_id, calendar_id))
+            for event in changes:
+                self._apply(user_id, calendar_id, event)
+            # Окно сдвигается со временем, вышедшие из него события удаляем
+            self._db.execute('DELETE FROM events WHERE user_id = ? AND calendar_id = ? AND end_ts <= ?',
+                             (user_id, calendar_id, window_start))
+            self._db.execute(
+                'INSERT OR REPLACE INTO sync_state (user_id, calendar_id, sync_token, synced_at) '
+                'VALUES (?, ?, ?, ?)',
+                (user_id, calendar_id, next_sync_token, time.time())
+            )
+
+        if sync_token is None or changes:
+            self._bump(user_id)
+        if sync_token is None:
+            self.full_syncs += 1
+        else:
+            self.incremental_syncs += 1
+
+    def _apply(self, user_id, calendar_id, event):
+        if event.get('status') == 'cancelled' or 'start' not in event:
+            self._db.execute(
+                'DELETE FROM events WHERE user_id = ? AND calendar_id = ? AND event_id = ?',
+                (user_id, calendar_id, event['id'])
+            )
+            return
+
+        self._db.execute(
+            'INSERT OR REPLACE INTO events (user_id, calendar_id, event_id, start_ts, end_ts, summary, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user_id, calendar_id, event['id'],
+             event_time(event['start']).timestamp(),
+             event_time(event['end']).timestamp(),
+             event.get('summary', ''),
+             json.dumps(event, ensure_ascii=False))
+        )
+
+    async def events_between(self, user_id: int, service, time_min: datetime.datetime = None,
+                             time_max: datetime.datetime = None, limit: int = None,
+                             calendar_id: str = 'primary') -> list:
+        """События, пересекающие интервал, по возрастанию времени начала.
+
+        time_min None означает начало окна копии, time_max None - что
+        интервал сверху не ограничен.
+        """
+        events = []
+        async for event in self.iter_events(user_id, service, time_min, time_max, calendar_id):
+            events.append(event)
+            if limit is not None and len(events) >= limit:
+                break
+        return events
+
+    async def before_window(self, user_id: int, service, calendar_id: str, time_min: datetime.datetime = None,
+                            time_max: datetime.datetime = None, window_start: float = None) -> list:
+        """События интервала, закончившиеся до начала окна: их в копии нет, читаем из Google"""
+        if window_start is None:
+            window_start = self.window_start()
+        if time_min is None or _timestamp(time_min) >= window_start:
+            return []
+        time_max_ts = window_start if time_max is None else min(_timestamp(time_max), window_start)
+        events = []
+        async for event in iter_events(service, user_id, calendarId=calendar_id, singleEvents=True,
+                                       orderBy='startTime', timeMin=_isoformat(_timestamp(time_min)),
+                                       timeMax=_isoformat(time_max_ts)):
+            # Пересекающие начало окна события уже есть в копии
+            if event.get('status') != 'cancelled' and event_time(event['end']).timestamp() <= window_start:
+                events.append(event)
+        return events
+
+    async def iter_events(self, user_id: int, service, time_min: datetime.datetime = None,
+                          time_max: datetime.datetime = None, calendar_id: str = 'primary', chunk: int = 50):
+        """То же, что events_between, но лениво: строки читаются порциями по chunk.
+
+        Каждая порция - отдельный запрос с курсором (начало, id), поэтому
+        записи в копию между порциями не ломают обход. Часть интервала
+        раньше окна копии запрашивается у Google и вливается по времени начала.
+        """
+        await self.sync(user_id, service, calendar_id)
+        window_start = self.window_start()
+        older = await self.before_window(user_id, service, calendar_id, time_min, time_max, window_start)
+
+        rows = self._rows(user_id, calendar_id, time_min, time_max, chunk)
+        if older:
+            rows = heapq.merge(((event_time(event['start']).timestamp(), event['id'], event) for event in older),
+                               rows, key=lambda row: (row[0], row[1]))
+        for _, _, event in rows:
+            yield event
+
+    def _rows(self, user_id, calendar_id, time_min, time_max, chunk):
+        """(начало, id, событие) из копии порциями"""
+        where = 'user_id = ? AND calendar_id = ?'
+        params = [user_id, calendar_id]
+        if time_max is not None:
+            where += ' AND start_ts < ?'
+            params.append(_timestamp(time_max))
+        if time_min is not None:
+            where += ' AND end_ts > ?'
+            params.append(_timestamp(time_min))
+
+        after = None
+        while True:
+            query, query_params = where, list(params)
+            if after is not None:
+                query += ' AND (start_ts > ? OR (start_ts = ? AND event_id > ?))'
+                query_params += [after[0], after[0], after[1]]
+            rows = self._db.execute(
+                f'SELECT start_ts, event_id, data FROM events WHERE {query} ORDER BY start_ts, event_id LIMIT ?',
+                query_params + [chunk]
+            ).fetchall()
+            for row in rows:
+                yield row[0], row[1], json.loads(row[2])
+            if len(rows) < chunk:
+                return
+            after = (rows[-1][0], rows[-1][1])
+
+    def events_page(self, user_id: int, calendar_ids: list, time_min: datetime.datetime,
+                    time_max: datetime.datetime, limit: int, cursor: str = None):
+        """Страница событий нескольких календарей из копии, без синхронизации.
+
+        Событие, которое видно в нескольких календарях, считается один раз и
+        берется из календаря, идущего раньше в calendar_ids. Возвращает
+        события (с полем calendarId), число событий в интервале, сколько из
+        них до страницы и курсор следующей страницы (None для последней).
+        Курсор - время начала и id последнего показанного события, поэтому
+        вставки не сдвигают страницы.
+        """
+        if not calendar_ids:
+            return [], 0, 0, None
+
+        placeholders = ', '.join('?' * len(calendar_ids))
+        where = f'user_id = ? AND calendar_id IN ({placeholders}) AND start_ts < ? AND end_ts > ?'
+        params = [user_id, *calendar_ids, _timestamp(time_max), _timestamp(time_min)]
+        total = self._db.execute(
+            f'SELECT COUNT(*) FROM (SELECT 1 FROM events WHERE {where} GROUP BY start_ts, event_id)', params
+        ).fetchone()[0]
+
+        offset = 0
+        if cursor:
+            after_ts, after_id = parse_cursor(cursor)
+            offset = self._db.execute(
+                f'SELECT COUNT(*) FROM (SELECT 1 FROM events WHERE {where} '
+                'AND (start_ts < ? OR (start_ts = ? AND event_id <= ?)) GROUP BY start_ts, event_id)',
+                params + [after_ts, after_ts, after_id]
+            ).fetchone()[0]
+            where += ' AND (start_ts > ? OR (start_ts = ? AND event_id > ?))'
+            params += [after_ts, after_ts, after_id]
+
+        # Остальные столбцы при MIN() SQLite берет из той же строки, то есть из первого по порядку календаря
+        rank = 'CASE calendar_id ' + ' '.join(f'WHEN ? THEN {index}' for index in range(len(calendar_ids))) + ' END'
+        rows = self._db.execute(
+            f'SELECT start_ts, event_id, calendar_id, data, MIN({rank}) FROM events WHERE {where} '
+            'GROUP BY start_ts, event_id ORDER BY start_ts, event_id LIMIT ?',
+            [*calendar_ids] + params + [limit + 1]
+        ).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = format_cursor(rows[-1][0], rows[-1][1])
+        events = []
+        for _, _, calendar_id, data, _ in rows:
+            event = json.loads(data)
+            event['calendarId'] = calendar_id
+            events.append(event)
+        return events, total, offset, next_cursor
+
+    def get_event(self, user_id: int, event_id: str, calendar_id: str = 'primary'):
+        """Событие из копии без синхронизации (None, если его там нет)"""
+        row = self._db.execute(
+            'SELECT data FROM events WHERE user_id = ? AND calendar_id = ? AND event_id = ?',
+            (user_id, calendar_id, event_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def calendar_of(self, user_id: int, event_id: str) -> str:
+        """Календарь, в котором лежит событие; основной, если событие есть в нескольких или его нет в копии"""
+        row = self._db.execute(
+            "SELECT calendar_id FROM events WHERE user_id = ? AND event_id = ? "
+            "ORDER BY calendar_id != 'primary' LIMIT 1",
+            (user_id, event_id)
+        ).fetchone()
+        return row[0] if row else 'primary'
+
+    def upsert(self, user_id: int, event: dict, calendar_id: str = 'primary'):
+        """Записывает событие, которое вернул API после успешной записи"""
+        with self._db:
+            self._apply(user_id, calendar_id, event)
+        self._bump(user_id)
+
+    def remove(self, user_id: int, event_id: str, calendar_id: str = 'primary'):
+        with self._db:
+            self._db.execute(
+                'DELETE FROM events WHERE user_id = ? AND calendar_id = ? AND event_id = ?',
+                (user_id, calendar_id, event_id)
+            )
+        self._bump(user_id)
+
+    def forget(self, user_id: int):
+        """Удаляет копию пользователя (например, после входа под другим аккаунтом)"""
+        with self._db:
+            self._db.execute('DELETE FROM events WHERE user_id = ?', (user_id,))
+            self._db.execute('DELETE FROM sync_state WHERE user_id = ?', (user_id,))
+        self._bump(user_id)
+
+    def stats(self) -> dict:
+        return {
+            'full_syncs': self.full_syncs,
+            'incremental_syncs': self.incremental_syncs,
+            'fresh_reads': self.fresh_reads,
+        }
+
+
+calendar_mirror = CalendarMirror()
@@ -0,0 +1,237 @@
+import asyncio
+import heapq
+import hmac
+import json
+import logging
+import secrets
+import time
+import uuid
+
+from aiohttp import web
+from googleapiclient.errors import HttpError
+
+from google_services import get_calendar_service, aexecute
+from oauthServer import credentials_store
+from state_backend import get_backend
+from config import CALENDAR_PUSH_URL, CALENDAR_WATCH_TTL, CALENDAR_WATCH_RENEW_MARGIN, TOKEN_REFRESH_RETRY
+
+
+logger = logging.getLogger('calendarPush')
+
+CHANNEL_PREFIX = 'channel:'
+USER_CHANNEL_PREFIX = 'channel-user:'
+
+# Сколько запись о канале живет в хранилище после его истечения:
+# Google может прислать запоздавшее уведомление
+CHANNEL_GRACE = 60 * 60
+
+
+class PushChannels:
+    """Подписки на изменения календарей пользователей через events.watch.
+
+    Канал хранится в общем хранилище состояния (channel:<id> -> пользователь,
+    resourceId, секрет и срок), поэтому уведомление может принять любой
+    процесс с веб-сервером. Продлевает каналы процесс, за которым закреплен
+    пользователь: у него есть учетные данные. Продление идет по куче,
+    упорядоченной по времени, за margin секунд до истечения канала:
+    создается новый канал, старый останавливается.
+    """
+
+    def __init__(self, address: str = CALENDAR_PUSH_URL, ttl: float = CALENDAR_WATCH_TTL,
+                 margin: float = CALENDAR_WATCH_RENEW_MARGIN):
+        self.address = address
+        self._ttl = ttl
+        self._margin = margin
+
+        # (время продления, user_id, поколение) - как в CredentialStore
+        self._heap = []
+        self._generations = {}
+        self._wakeup = None
+        self._tasks = set()
+
+        # Метрики
+        self.subscribed = 0
+        self.renewed = 0
+        self.failures = 0
+        self.notifications = 0
+        self.unknown = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.address)
+
+    async def _channel_of(self, user_id: int):
+        channel_id = await get_backend().get(f'{USER_CHANNEL_PREFIX}{user_id}')
+        if channel_id is None:
+            return None
+        data = await get_backend().get(f'{CHANNEL_PREFIX}{channel_id}')
+        return json.loads(data) if data is not None else None
+
+    async def subscribe(self, user_id: int, renew: bool = False):
+        """Создает канал для календаря пользователя и останавливает предыдущий"""
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            await self.unsubscribe(user_id)
+            return
+
+        service = get_calendar_service(user_id, creds_data)
+        channel_id = uuid.uuid4().hex
+        token = secrets.token_urlsafe(24)
+        response = await aexecute(service.events().watch(calendarId='primary', body={
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': self.address,
+            'token': token,
+            'params': {'ttl': str(int(self._ttl))},
+        }), user_id)
+
+        expiration = int(response['expiration']) / 1000 if response.get('expiration') else time.time() + self._ttl
+        channel = {'id': channel_id, 'user_id': user_id, 'resource_id': response['resourceId'],
+                   'token': token, 'expiration': expiration}
+        previous = await self._channel_of(user_id)
+
+        backend = get_backend()
+        ttl = expiration - time.time() + CHANNEL_GRACE
+        await backend.set(f'{CHANNEL_PREFIX}{channel_id}', json.dumps(channel), ttl=ttl)
+        await backend.set(f'{USER_CHANNEL_PREFIX}{user_id}', channel_id, ttl=ttl)
+        self._schedule(user_id, expiration - self._margin)
+
+        if renew:
+            self.renewed += 1
+        else:
+            self.subscribed += 1
+        if previous is not None:
+            await self._stop(user_id, service, previous)
+
+    async def _stop(self, user_id, service, channel: dict):
+        await get_backend().delete(f"{CHANNEL_PREFIX}{channel['id']}")
+        try:
+            await aexecute(service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resource_id']}),
+                           user_id)
+        except HttpError as e:
+            # Канал уже истек или остановлен - это нормально
+            if e.resp.status not in (404, 410):
+                logger.warning(f"Failed to stop channel {channel['id']} of {user_id}: {e}")
+
+    async def unsubscribe(self, user_id: int):
+        self._generations.pop(user_id, None)
+        channel = await self._channel_of(user_id)
+        await get_backend().delete(f'{USER_CHANNEL_PREFIX}{user_id}')
+        if channel is None:
+            return
+        creds_data = credentials_store.get(user_id)
+        if creds_data:
+            await self._stop(user_id, get_calendar_service(user_id, creds_data), channel)
+        else:
+            await get_backend().delete(f"{CHANNEL_PREFIX}{channel['id']}")
+
+    async def ensure(self, user_id: int):
+        """Подписывает пользователя, если у него еще нет действующего канала"""
+        channel = await self._channel_of(user_id)
+        if channel is None or channel['expiration'] - time.time() < self._margin:
+            await self.subscribe(user_id, renew=channel is not None)
+        elif user_id not in self._generations:
+            self._schedule(user_id, channel['expiration'] - self._margin)
+
+    async def lookup(self, channel_id: str, token: str):
+        """Пользователь канала, если канал известен и секрет совпадает"""
+        data = await get_backend().get(f'{CHANNEL_PREFIX}{channel_id}') if channel_id else None
+        if data is None:
+            return None
+        channel = json.loads(data)
+        if not hmac.compare_digest(token or '', channel['token']):
+            return None
+        return channel['user_id']
+
+    # Продление
+
+    def _schedule(self, user_id, renew_at: float):
+        generation = self._generations.get(user_id, 0) + 1
+        self._generations[user_id] = generation
+        heapq.heappush(self._heap, (renew_at, user_id, generation))
+        if self._wakeup is not None and self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        return asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            while self._heap and self._generations.get(self._heap[0][1]) != self._heap[0][2]:
+                heapq.heappop(self._heap)
+            delay = self._heap[0][0] - time.time() if self._heap else None
+
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, user_id, _ = heapq.heappop(self._heap)
+            task = asyncio.create_task(self._renew(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _renew(self, user_id):
+        try:
+            await self.subscribe(user_id, renew=True)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Failed to renew push channel of {user_id}, retrying: {e}")
+            self._schedule(user_id, time.time() + TOKEN_REFRESH_RETRY)
+
+    def stats(self) -> dict:
+        return {
+            'channels': len(self._generations),
+            'subscribed': self.subscribed,
+            'renewed': self.renewed,
+            'failures': self.failures,
+            'notifications': self.notifications,
+            'unknown': self.unknown,
+        }
+
+
+push_channels = PushChannels()
+
+
+async def _ignore(user_id):
+    pass
+
+
+# Куда передается изменение календаря: движок напоминаний или, при нескольких воркерах, воркер пользователя
+push_handler = _ignore
+_tasks = set()
+
+
+def set_push_handler(handler):
+    global push_handler
+    push_handler = handler
+
+
+async def deliver(headers) -> int:
+    """Обрабатывает уведомление Google по его заголовкам, возвращает HTTP-статус ответа"""
+    # 'sync' приходит сразу после создания канала, еще до того, как мы его сохранили; изменений в нем нет
+    if headers.get('X-Goog-Resource-State') == 'sync':
+        return 200
+
+    user_id = await push_channels.lookup(headers.get('X-Goog-Channel-ID'), headers.get('X-Goog-Channel-Token'))
+    if user_id is None:
+        # Неизвестный или чужой канал: повторять доставку Google незачем
+        push_channels.unknown += 1
+        logger.warning(f"Push for unknown channel {headers.get('X-Goog-Channel-ID')}")
+        return 404
+
+    push_channels.notifications += 1
+    # Отвечаем сразу, сверка идет в фоне
+    task = asyncio.create_task(push_handler(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return 200
+
+
+async def receive(request: web.Request):
+    """Прием уведомлений events.watch на веб-сервере"""
+    return web.Response(status=await deliver(request.headers))
@@ -0,0 +1,315 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from calendar_mirror import calendar_mirror, event_time, format_cursor, parse_cursor
+from google_services import aexecute, UserLimits
+from config import CALENDAR_LIST_TTL, CALENDAR_FANOUT_CONCURRENCY
+
+
+logger = logging.getLogger('calendars')
+
+# Основной календарь в копии и в запросах всегда 'primary', а не email владельца
+PRIMARY = 'primary'
+
+# Роли, с которыми в календарь можно писать
+WRITE_ROLES = ('owner', 'writer')
+
+
+class CalendarDirectory:
+    """Календари пользователя из calendarList с кешем на ttl секунд.
+
+    Выбранными считаются календари, отмеченные в интерфейсе Google
+    (selected), и всегда основной. Основной календарь хранится под id
+    'primary', как в локальной копии, напоминаниях и подписках.
+    """
+
+    def __init__(self, ttl: float = CALENDAR_LIST_TTL):
+        self._ttl = ttl
+        # user_id -> (время загрузки, [календарь]), календарь - словарь id, summary, access_role, selected, time_zone
+        self._lists = {}
+        self._locks = {}
+
+        # Метрики
+        self.hits = 0
+        self.loads = 0
+        self.failures = 0
+
+    def _lock(self, user_id):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def calendars(self, user_id: int, service) -> list:
+        """Все календари пользователя, основной первым"""
+        cached = self._lists.get(user_id)
+        if cached is not None and time.monotonic() - cached[0] < self._ttl:
+            self.hits += 1
+            return cached[1]
+
+        # Параллельные ходы одного пользователя ждут одну загрузку
+        async with self._lock(user_id):
+            cached = self._lists.get(user_id)
+            if cached is not None and time.monotonic() - cached[0] < self._ttl:
+                self.hits += 1
+                return cached[1]
+            try:
+                calendars = await self._load(user_id, service)
+            except Exception as e:
+                self.failures += 1
+                if cached is not None:
+                    logger.warning(f"Failed to refresh calendar list of {user_id}, using stale one: {e}")
+                    return cached[1]
+                # Без списка работаем хотя бы с основным календарем
+                logger.warning(f"Failed to load calendar list of {user_id}: {e}")
+                return [{'id': PRIMARY, 'summary': 'Основной', 'access_role': 'owner', 'selected': True,
+                         'time_zone': None}]
+            self._lists[user_id] = (time.monotonic(), calendars)
+            self.loads += 1
+            return calendars
+
+    async def _load(self, user_id, service) -> list:
+        calendars = []
+        page_token = None
+        while True:
+            params = {'minAccessRole': 'freeBusyReader', 'showHidden': False,
+                      'fields': 'nextPageToken,items(id,summary,summaryOverride,primary,selected,accessRole,timeZone)'}
+            if page_token:
+                params['pageToken'] = page_token
+            page = await aexecute(service.calendarList().list(**params), user_id)
+            for item in page.get('items', []):
+                calendars.append({
+                    'id': PRIMARY if item.get('primary') else item['id'],
+                    'summary': item.get('summaryOverride') or item.get('summary') or item['id'],
+                    'access_role': item.get('accessRole', 'reader'),
+                    'selected': bool(item.get('primary') or item.get('selected')),
+                    'time_zone': item.get('timeZone'),
+                })
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                break
+
+        if not any(calendar['id'] == PRIMARY for calendar in calendars):
+            calendars.append({'id': PRIMARY, 'summary': 'Основной', 'access_role': 'owner', 'selected': True,
+                              'time_zone': None})
+        calendars.sort(key=lambda calendar: calendar['id'] != PRIMARY)
+        return calendars
+
+    async def selected(self, user_id: int, service) -> list:
+        """id календарей, события которых показываются пользователю.
+
+        Календари, где видна только занятость, в выборку не входят: событий из них не прочитать.
+        """
+        return [calendar['id'] for calendar in await self.calendars(user_id, service)
+                if calendar['selected'] and calendar['access_role'] != 'freeBusyReader']
+
+    async def busy_sources(self, user_id: int, service) -> list:
+        """id выбранных календарей, занятость которых учитывается при поиске свободного времени"""
+        return [calendar['id'] for calendar in await self.calendars(user_id, service) if calendar['selected']]
+
+    async def timezone(self, user_id: int, service):
+        """Часовой пояс основного календаря пользователя, если он неизвестен - пояс сервера"""
+        for calendar in await self.calendars(user_id, service):
+            if calendar['id'] == PRIMARY and calendar.get('time_zone'):
+                try:
+                    return ZoneInfo(calendar['time_zone'])
+                except (ZoneInfoNotFoundError, ValueError):
+                    logger.warning(f"Unknown time zone {calendar['time_zone']} of {user_id}")
+        return datetime.datetime.now().astimezone().tzinfo
+
+    async def resolve(self, user_id: int, service, name: str, writable: bool = False):
+        """Календарь по id или названию (без учета регистра, можно часть названия), None - если не найден"""
+        calendars = await self.calendars(user_id, service)
+        if writable:
+            calendars = [calendar for calendar in calendars if calendar['access_role'] in WRITE_ROLES]
+        needle = name.strip().lower()
+        for calendar in calendars:
+            if calendar['id'].lower() == needle or calendar['summary'].lower() == needle:
+                return calendar
+        for calendar in calendars:
+            if needle in calendar['summary'].lower():
+                return calendar
+        return None
+
+    def name(self, user_id: int, calendar_id: str) -> str:
+        """Название календаря из кеша без обращения к Google"""
+        cached = self._lists.get(user_id)
+        for calendar in cached[1] if cached is not None else ():
+            if calendar['id'] == calendar_id:
+                return calendar['summary']
+        return calendar_id
+
+    def forget(self, user_id: int):
+        self._lists.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._lists),
+            'hits': self.hits,
+            'loads': self.loads,
+            'failures': self.failures,
+        }
+
+
+calendar_directory = CalendarDirectory()
+
+
+# Ограничение параллельных запросов одного пользователя к его календарям
+_fanout = UserLimits(CALENDAR_FANOUT_CONCURRENCY)
+
+
+async def sync_all(user_id: int, service, calendar_ids: list, errors: dict = None):
+    """Догоняет копии нескольких календарей параллельно под тем же лимитом, что и слияние"""
+    async def sync(calendar_id):
+        async with _fanout.hold(user_id):
+            try:
+                await calendar_mirror.sync(user_id, service, calendar_id)
+            except Exception as e:
+                logger.warning(f"Failed to sync calendar {calendar_id} of {user_id}: {e}")
+                if errors is not None:
+                    errors[calendar_id] = e
+
+    await asyncio.gather(*(sync(calendar_id) for calendar_id in calendar_ids))
+
+
+class _Source:
+    """Один календарь в слиянии: события читаются из копии порциями, синхронизация - под общим лимитом"""
+
+    def __init__(self, user_id, service, calendar_id, time_min, time_max, errors):
+        self.calendar_id = calendar_id
+        self._user_id = user_id
+        self._events = calendar_mirror.iter_events(user_id, service, time_min, time_max, calendar_id)
+        self._errors = errors
+        self._started = False
+
+    async def next(self):
+        """Следующее событие календаря или None, если они кончились или календарь недоступен"""
+        try:
+            if not self._started:
+                # Первая порция догоняет копию календаря - это и есть запрос к Google
+                self._started = True
+                async with _fanout.hold(self._user_id):
+                    event = await anext(self._events, None)
+            else:
+                event = await anext(self._events, None)
+        except Exception as e:
+            logger.warning(f"Failed to read calendar {self.calendar_id}: {e}")
+            self._errors[self.calendar_id] = e
+            return None
+        if event is not None:
+            event['calendarId'] = self.calendar_id
+        return event
+
+    async def close(self):
+        await self._events.aclose()
+
+
+async def merged_events(user_id: int, service, time_min: datetime.datetime = None,
+                        time_max: datetime.datetime = None, calendar_ids: list = None, errors: dict = None):
+    """События всех выбранных календарей по возрастанию начала.
+
+    Календари догоняются параллельно, не больше CALENDAR_FANOUT_CONCURRENCY
+    одновременно на пользователя, так что задержка близка к самому
+    медленному календарю, а не к их сумме. Дальше идет ленивое слияние
+    кучей: из каждого календаря читается следующее событие, только когда
+    предыдущее ушло потребителю, поэтому для первых N событий из копии
+    читается примерно N строк на календарь. Событие, которое видно в
+    нескольких календарях (встреча из общего календаря), отдается один раз,
+    из календаря, идущего раньше в списке (основной первым).
+
+    Первое событие отдается, когда известны первые события всех календарей:
+    раньше нельзя, медленный календарь может начинаться раньше остальных.
+    Недоступные календари пропускаются, ошибки складываются в errors.
+    У каждого события появляется поле calendarId.
+    """
+    if calendar_ids is None:
+        calendar_ids = await calendar_directory.selected(user_id, service)
+    if errors is None:
+        errors = {}
+
+    sources = [_Source(user_id, service, calendar_id, time_min, time_max, errors) for calendar_id in calendar_ids]
+    try:
+        heads = await asyncio.gather(*(source.next() for source in sources))
+        heap = [(event_time(event['start']).timestamp(), event['id'], index, event)
+                for index, event in enumerate(heads) if event is not None]
+        heapq.heapify(heap)
+
+        last = None
+        while heap:
+            start_ts, event_id, index, event = heap[0]
+            following = await sources[index].next()
+            if following is not None:
+                heapq.heapreplace(heap, (event_time(following['start']).timestamp(), following['id'], index, following))
+            else:
+                heapq.heappop(heap)
+            # Копии одного события в разных календарях идут подряд: ключ (начало, id) у них общий
+            if (start_ts, event_id) == last:
+                continue
+            last = (start_ts, event_id)
+            yield event
+    finally:
+        await asyncio.gather(*(source.close() for source in sources), return_exceptions=True)
+
+
+def _key(event) -> tuple:
+    return event_time(event['start']).timestamp(), event['id']
+
+
+async def _before_window(user_id, service, calendar_ids, time_min, time_max, errors) -> list:
+    """События раньше окна копии из всех календарей, по возрастанию (начало, id), без повторов"""
+    async def read(calendar_id):
+        async with _fanout.hold(user_id):
+            try:
+                return await calendar_mirror.before_window(user_id, service, calendar_id, time_min, time_max)
+            except Exception as e:
+                logger.warning(f"Failed to read calendar {calendar_id} before the mirror window: {e}")
+                errors[calendar_id] = e
+                return []
+
+    found = {}
+    results = await asyncio.gather(*(read(calendar_id) for calendar_id in calendar_ids))
+    for calendar_id, events in zip(calendar_ids, results):
+        for event in events:
+            event['calendarId'] = calendar_id
+            found.setdefault(_key(event), event)
+    return [found[key] for key in sorted(found)]
+
+
+async def events_page(user_id: int, service, time_min: datetime.datetime, time_max: datetime.datetime,
+                      limit: int, cursor: str = None, calendar_ids: list = None, errors: dict = None):
+    """Страница событий выбранных календарей за интервал по возрастанию начала.
+
+    Копии календарей догоняются параллельно (sync_all), а страница читается
+    из копии одним запросом с LIMIT и курсором, поэтому длинный интервал
+    целиком в память не загружается. Часть интервала раньше окна копии
+    запрашивается у Google и вливается по времени начала. Недоступные
+    календари пропускаются, ошибки складываются в errors.
+    Возвращает (события, всего событий, сколько до страницы, курсор следующей).
+    """
+    if calendar_ids is None:
+        calendar_ids = await calendar_directory.selected(user_id, service)
+    if errors is None:
+        errors = {}
+
+    await sync_all(user_id, service, calendar_ids, errors)
+    available = [calendar_id for calendar_id in calendar_ids if calendar_id not in errors]
+    older = []
+    if time_min.timestamp() < calendar_mirror.window_start():
+        older = await _before_window(user_id, service, available, time_min, time_max, errors)
+    events, total, offset, next_cursor = calendar_mirror.events_page(user_id, available, time_min, time_max,
+                                                                     limit, cursor)
+    if not older:
+        return events, total, offset, next_cursor
+
+    after = parse_cursor(cursor) if cursor else None
+    before = [event for event in older if after is not None and _key(event) <= after]
+    rest = [event for event in older if after is None or _key(event) > after]
+    page = list(itertools.islice(heapq.merge(rest, events, key=_key), limit))
+    if next_cursor is not None or len(rest) + len(events) > limit:
+        next_cursor = format_cursor(*_key(page[-1]))
+    return page, total + len(older), offset + len(before), next_cursor
@@ -3,6 +3,128 @@ import os
 # Bot data
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 
-CLIENT_SECERT_FILE = os.environ.get('GOOGLE_CLIENT_SECRET_FILE')
+CLIENT_SECRET_FILE = os.environ.get('GOOGLE_CLIENT_SECRET_FILE', 'client_secret.json')
 SCOPES = os.environ.get('GOOGLE_SCOPES')
 REDIRECT_URI = os.environ.get('GOOGLE_REDIRECT_URI')
+
+# Кеш агентов
+AGENT_SESSIONS_MAX = int(os.environ.get('AGENT_SESSIONS_MAX', 2000))
+AGENT_SESSION_TTL = float(os.environ.get('AGENT_SESSION_TTL', 30 * 60))
+
+# Google API
+GOOGLE_HTTP_TIMEOUT = float(os.environ.get('GOOGLE_HTTP_TIMEOUT', 30))
+# Таймаут запроса вместе с ожиданием очереди, не меньше сетевого таймаута, иначе срабатывает раньше него
+GOOGLE_REQUEST_TIMEOUT = max(float(os.environ.get('GOOGLE_REQUEST_TIMEOUT', 60)), GOOGLE_HTTP_TIMEOUT)
+GOOGLE_MAX_WORKERS = int(os.environ.get('GOOGLE_MAX_WORKERS', 32))
+# Запросов одного пользователя одновременно: не меньше числа календарей, которые обычно догоняются разом
+GOOGLE_USER_CONCURRENCY = int(os.environ.get('GOOGLE_USER_CONCURRENCY', 5))
+GOOGLE_PAGE_SIZE = int(os.environ.get('GOOGLE_PAGE_SIZE', 250))
+
+# Распознавание речи
+VOSK_MODEL_PATH = os.environ.get('VOSK_MODEL_PATH', 'models/vosk/model')
+STT_WORKERS = int(os.environ.get('STT_WORKERS', os.cpu_count() or 1))
+STT_QUEUE_SIZE = int(os.environ.get('STT_QUEUE_SIZE', 16))
+STT_QUEUE_TIMEOUT = float(os.environ.get('STT_QUEUE_TIMEOUT', 30))
+STT_DOWNLOAD_TIMEOUT = float(os.environ.get('STT_DOWNLOAD_TIMEOUT', 30))
+# Предельное время распознавания одного сообщения, с
+STT_JOB_TIMEOUT = float(os.environ.get('STT_JOB_TIMEOUT', 120))
+
+# Локальная копия календарей
+CALENDAR_MIRROR_PATH = os.environ.get('CALENDAR_MIRROR_PATH', 'data/calendar_mirror.sqlite3')
+CALENDAR_MIRROR_MAX_AGE = float(os.environ.get('CALENDAR_MIRROR_MAX_AGE', 60))
+# Насколько глубоко в прошлое хранится копия, дни; более ранние события читаются из Google напрямую
+CALENDAR_MIRROR_DAYS_BACK = float(os.environ.get('CALENDAR_MIRROR_DAYS_BACK', 30))
+# Список календарей пользователя (calendarList) кешируется на это время, с
+CALENDAR_LIST_TTL = float(os.environ.get('CALENDAR_LIST_TTL', 60 * 60))
+# Сколько календарей одного пользователя догоняются одновременно, по умолчанию не меньше пяти,
+# чтобы обычные пять календарей догонялись за одну волну
+CALENDAR_FANOUT_CONCURRENCY = int(os.environ.get('CALENDAR_FANOUT_CONCURRENCY', max(5, GOOGLE_USER_CONCURRENCY)))
+
+# Инструменты календаря
+# Индексы поиска событий: сколько пользователей держать в памяти и сколько секунд простоя
+EVENT_SEARCH_MAX_USERS = int(os.environ.get('EVENT_SEARCH_MAX_USERS', 500))
+EVENT_SEARCH_TTL = float(os.environ.get('EVENT_SEARCH_TTL', 30 * 60))
+# Индекс покрывает окно копии календаря и столько дней вперед; поиск за пределами идет без индекса
+EVENT_SEARCH_DAYS_AHEAD = float(os.environ.get('EVENT_SEARCH_DAYS_AHEAD', 365))
+VIEW_EVENTS_PAGE_SIZE = int(os.environ.get('VIEW_EVENTS_PAGE_SIZE', 10))
+# Сколько событий быстрый путь показывает без LLM, остальные - по запросу
+FAST_VIEW_MAX_EVENTS = int(os.environ.get('FAST_VIEW_MAX_EVENTS', 20))
+# freebusy.query принимает ограниченный диапазон и число календарей, большие запросы режутся на части
+FREEBUSY_MAX_DAYS = int(os.environ.get('FREEBUSY_MAX_DAYS', 60))
+FREEBUSY_MAX_CALENDARS = int(os.environ.get('FREEBUSY_MAX_CALENDARS', 50))
+
+# Общее состояние процессов бота: sqlite:///путь или redis://хост:порт/база
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND_URL', 'sqlite:///data/state.sqlite3')
+# Число процессов-воркеров, пользователи закрепляются за ними по user_id
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 1))
+SHARD_QUEUE_SIZE = int(os.environ.get('SHARD_QUEUE_SIZE', 256))
+# Сколько соединение SQLite ждет, пока файл пишет другой процесс, прежде чем вернуть 'database is locked', с
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 30))
+
+# Учетные данные Google
+# Старая база учетных данных, при запуске переносится в общее хранилище
+CREDENTIALS_DB_PATH = os.environ.get('CREDENTIALS_DB_PATH', 'data/credentials.sqlite3')
+CREDENTIALS_KEY_PATH = os.environ.get('CREDENTIALS_KEY_PATH', CREDENTIALS_DB_PATH + '.key')
+CREDENTIALS_KEY = os.environ.get('CREDENTIALS_KEY')
+TOKEN_REFRESH_MARGIN = float(os.environ.get('TOKEN_REFRESH_MARGIN', 5 * 60))
+TOKEN_REFRESH_RETRY = float(os.environ.get('TOKEN_REFRESH_RETRY', 60))
+LOGIN_FLOW_TTL = float(os.environ.get('LOGIN_FLOW_TTL', 10 * 60))
+
+# История диалогов
+CONVERSATIONS_DB_PATH = os.environ.get('CONVERSATIONS_DB_PATH', 'data/conversations.sqlite3')
+CHECKPOINTS_PER_THREAD = int(os.environ.get('CHECKPOINTS_PER_THREAD', 5))
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', 3000))
+HISTORY_KEEP_TURNS = int(os.environ.get('HISTORY_KEEP_TURNS', 3))
+TOOL_OUTPUT_KEEP_CHARS = int(os.environ.get('TOOL_OUTPUT_KEEP_CHARS', 300))
+
+# Ответы в Telegram
+STREAM_REPLIES = os.environ.get('STREAM_REPLIES', '1') == '1'
+TELEGRAM_EDIT_INTERVAL = float(os.environ.get('TELEGRAM_EDIT_INTERVAL', 1.0))
+
+# HTTP-сервер (OAuth callback и webhook Telegram)
+WEB_SERVER_HOST = os.environ.get('WEB_SERVER_HOST', '0.0.0.0')
+WEB_SERVER_PORT = int(os.environ.get('WEB_SERVER_PORT', 8080))
+# Если задан публичный адрес, обновления приходят через webhook вместо long polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 256))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 32))
+
+# Очередь ходов агента
+AGENT_MAX_CONCURRENCY = int(os.environ.get('AGENT_MAX_CONCURRENCY', 16))
+TURN_QUEUE_MAX = int(os.environ.get('TURN_QUEUE_MAX', 200))
+TURN_USER_QUEUE_MAX = int(os.environ.get('TURN_USER_QUEUE_MAX', 3))
+# Вызовов GigaChat в секунду и сколько можно сделать подряд
+LLM_RATE_LIMIT = float(os.environ.get('LLM_RATE_LIMIT', 5))
+LLM_RATE_BURST = int(os.environ.get('LLM_RATE_BURST', 10))
+
+# Кеш результатов инструментов на время хода агента
+TOOL_MEMO_TTL = float(os.environ.get('TOOL_MEMO_TTL', 10))
+
+# Трассировка этапов хода
+# Доля ходов, трасса которых пишется в лог целиком (гистограммы считаются для всех)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.05))
+# Ходы дольше этого (с) пишутся в лог всегда
+TRACE_SLOW_TURN = float(os.environ.get('TRACE_SLOW_TURN', 10))
+METRICS_PATH = os.environ.get('METRICS_PATH', '/metrics')
+
+# Уведомления об изменениях календаря (events.watch)
+# Публичный URL, на который Google шлет уведомления (например, глобальный URL xTunnel + CALENDAR_PUSH_PATH).
+# Без него подписки не создаются и напоминания опираются только на периодическую сверку
+CALENDAR_PUSH_URL = os.environ.get('CALENDAR_PUSH_URL')
+CALENDAR_PUSH_PATH = os.environ.get('CALENDAR_PUSH_PATH', '/calendar/push')
+# Срок жизни канала (Google не дает больше недели) и за сколько до истечения его продлевать, с
+CALENDAR_WATCH_TTL = float(os.environ.get('CALENDAR_WATCH_TTL', 7 * 24 * 60 * 60))
+CALENDAR_WATCH_RENEW_MARGIN = float(os.environ.get('CALENDAR_WATCH_RENEW_MARGIN', 60 * 60))
+
+# Напоминания о встречах
+REMINDERS_ENABLED = os.environ.get('REMINDERS_ENABLED', '1') == '1'
+# За сколько до начала напоминать и на сколько вперед держать ленту событий, с
+REMINDER_LEAD = float(os.environ.get('REMINDER_LEAD', 10 * 60))
+REMINDER_HORIZON = float(os.environ.get('REMINDER_HORIZON', 24 * 60 * 60))
+
+# Исходящие уведомления: сообщений в секунду на бота и минимальный интервал в один чат
+TELEGRAM_SEND_RATE = float(os.environ.get('TELEGRAM_SEND_RATE', 25))
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get('TELEGRAM_CHAT_INTERVAL', 1.0))
+TELEGRAM_SEND_QUEUE = int(os.environ.get('TELEGRAM_SEND_QUEUE', 1000))
@@ -0,0 +1,64 @@
+import os
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from config import CONVERSATIONS_DB_PATH, CHECKPOINTS_PER_THREAD, SQLITE_BUSY_TIMEOUT
+from state_backend import sqlite_pragmas
+
+
+class BoundedSqliteSaver(AsyncSqliteSaver):
+    """Чекпоинтер LangGraph на SQLite, хранящий только последние чекпоинты каждого диалога"""
+
+    def __init__(self, conn, max_checkpoints: int = CHECKPOINTS_PER_THREAD):
+        super().__init__(conn)
+        self._max_checkpoints = max_checkpoints
+
+    async def setup(self):
+        if self.is_setup:
+            return
+        await super().setup()
+        # Файл диалогов общий для всех воркеров
+        await self.conn.executescript(sqlite_pragmas())
+
+    async def prune(self, thread_id):
+        """Удаляет старые чекпоинты диалога, оставляя max_checkpoints последних"""
+        await self.setup()
+        thread_id = str(thread_id)
+        async with self.lock:
+            # id чекпоинтов монотонно растут, поэтому по ним можно сортировать
+            await self.conn.execute(
+                'DELETE FROM writes WHERE thread_id = ? AND checkpoint_id NOT IN ('
+                'SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? '
+                'ORDER BY checkpoint_id DESC LIMIT ?)',
+                (thread_id, thread_id, self._max_checkpoints)
+            )
+            await self.conn.execute(
+                'DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id NOT IN ('
+                'SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? '
+                'ORDER BY checkpoint_id DESC LIMIT ?)',
+                (thread_id, thread_id, self._max_checkpoints)
+            )
+            await self.conn.commit()
+
+
+_checkpointer = None
+
+
+def get_checkpointer() -> BoundedSqliteSaver:
+    """Общий для всех агентов чекпоинтер (соединение открывается в цикле событий бота)"""
+    global _checkpointer
+    if _checkpointer is None:
+        directory = os.path.dirname(CONVERSATIONS_DB_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _checkpointer = BoundedSqliteSaver(aiosqlite.connect(CONVERSATIONS_DB_PATH, timeout=SQLITE_BUSY_TIMEOUT))
+    return _checkpointer
+
+
+async def close_checkpointer():
+    """Закрывает соединение чекпоинтера, иначе поток aiosqlite не дает процессу завершиться"""
+    global _checkpointer
+    if _checkpointer is not None:
+        await _checkpointer.conn.close()
+        _checkpointer = None
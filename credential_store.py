@@ -0,0 +1,300 @@
+import asyncio
+import datetime
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from cryptography.fernet import Fernet
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from config import CREDENTIALS_DB_PATH, CREDENTIALS_KEY, CREDENTIALS_KEY_PATH, TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_RETRY
+from google_services import invalidate as invalidate_services
+from state_backend import get_backend
+
+
+logger = logging.getLogger('credentialStore')
+
+KEY_PREFIX = 'credentials:'
+
+
+def _load_key(key_path: str) -> bytes:
+    """Ключ шифрования из окружения или из файла"""
+    if CREDENTIALS_KEY:
+        return CREDENTIALS_KEY.encode()
+
+    if not os.path.exists(key_path):
+        logger.warning(f"CREDENTIALS_KEY is not set, generating a key in {key_path}")
+        directory = os.path.dirname(key_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            # Ключ успел создать другой процесс
+            pass
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(Fernet.generate_key())
+
+    with open(key_path, 'rb') as f:
+        return f.read().strip()
+
+
+def _to_credentials(value) -> Credentials:
+    if isinstance(value, Credentials):
+        return value
+    return Credentials(
+        token=value.get('token'),
+        refresh_token=value.get('refresh_token'),
+        token_uri=value.get('token_uri'),
+        client_id=value.get('client_id'),
+        client_secret=value.get('client_secret'),
+        scopes=value.get('scopes')
+    )
+
+
+class CredentialStore:
+    """Зашифрованное хранилище учетных данных Google с фоновым обновлением токенов.
+
+    Ведет себя как словарь user_id -> Credentials, поэтому старый код,
+    работавший с credentials_store как с dict, менять не нужно.
+    Данные лежат в общем хранилище состояния, а в памяти процесса -
+    только пользователи, закрепленные за этим воркером (см. load).
+    Запись в хранилище идет в фоне, по порядку изменений.
+    Токены доступа обновляются заранее, за TOKEN_REFRESH_MARGIN секунд
+    до истечения, по куче, упорядоченной по времени обновления.
+    """
+
+    def __init__(self, key_path: str = CREDENTIALS_KEY_PATH, margin: float = TOKEN_REFRESH_MARGIN):
+        self._fernet = Fernet(_load_key(key_path))
+        self._margin = margin
+        self._lock = threading.RLock()
+        self._cache = {}
+
+        # (время обновления, user_id, поколение) - устаревшие записи кучи пропускаются по поколению
+        self._heap = []
+        self._generations = {}
+        self._loop = None
+        self._wakeup = None
+        self._notify = None
+        self._tasks = set()
+        self._writes = None
+        self._writer = None
+
+        # Метрики
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    async def load(self, owns=None):
+        """Загружает учетные данные из хранилища.
+
+        owns(user_id) -> bool отбирает пользователей этого воркера,
+        чтобы токены каждого обновлял ровно один процесс.
+        """
+        for key, data in await get_backend().scan(KEY_PREFIX):
+            user_id = int(key[len(KEY_PREFIX):])
+            if owns is not None and not owns(user_id):
+                continue
+            try:
+                info = json.loads(self._fernet.decrypt(data.encode()))
+                credentials = Credentials.from_authorized_user_info(info)
+                if credentials.expiry is None and info.get('expiry'):
+                    # Старые версии google-auth не читают expiry, а он нужен для расписания
+                    credentials.expiry = datetime.datetime.fromisoformat(info['expiry'].rstrip('Z'))
+            except Exception:
+                # Одна испорченная запись не должна мешать запуску воркера
+                logger.exception(f"Skipping unreadable credentials of {user_id}")
+                continue
+            self._cache[user_id] = credentials
+            self._schedule(user_id, credentials)
+
+    @staticmethod
+    async def migrate(path: str = CREDENTIALS_DB_PATH):
+        """Переносит зашифрованные записи из старой отдельной базы в общее хранилище"""
+        if not os.path.exists(path):
+            return
+        db = sqlite3.connect(path)
+        try:
+            rows = db.execute('SELECT user_id, data FROM credentials').fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            db.close()
+
+        backend = get_backend()
+        for user_id, data in rows:
+            await backend.set(f'{KEY_PREFIX}{user_id}', bytes(data).decode())
+        os.rename(path, path + '.migrated')
+        logger.info(f"Migrated {len(rows)} credentials from {path}")
+
+    def _persist(self, user_id, credentials: Credentials):
+        data = self._fernet.encrypt(credentials.to_json().encode()).decode()
+        self._write(user_id, data)
+
+    def _write(self, user_id, data):
+        # Одна фоновая задача пишет изменения по порядку, чтобы удаление не обогнало запись
+        if self._writer is None:
+            self._writes = asyncio.Queue()
+            self._writer = asyncio.create_task(self._write_loop())
+        self._writes.put_nowait((user_id, data))
+
+    async def _write_loop(self):
+        backend = get_backend()
+        while True:
+            user_id, data = await self._writes.get()
+            try:
+                if data is None:
+                    await backend.delete(f'{KEY_PREFIX}{user_id}')
+                else:
+                    await backend.set(f'{KEY_PREFIX}{user_id}', data)
+            except Exception:
+                logger.exception(f"Failed to save credentials of {user_id}")
+            finally:
+                self._writes.task_done()
+
+    async def flush(self):
+        """Дожидается записи всех изменений в хранилище"""
+        if self._writes is not None:
+            await self._writes.join()
+
+    def _schedule(self, user_id, credentials: Credentials, refresh_at: float = None):
+        if refresh_at is None:
+            if credentials.expiry is None:
+                # Срок неизвестен - обновляем сразу, чтобы его узнать
+                refresh_at = time.time()
+            else:
+                expiry = credentials.expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+                refresh_at = expiry - self._margin
+
+        with self._lock:
+            generation = self._generations.get(user_id, 0) + 1
+            self._generations[user_id] = generation
+            heapq.heappush(self._heap, (refresh_at, user_id, generation))
+            is_first = self._heap[0][1] == user_id and self._heap[0][2] == generation
+
+        # Новое событие раньше текущего ожидания - будим планировщик
+        if is_first and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # Интерфейс словаря
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            return self._cache.get(user_id, default)
+
+    def __getitem__(self, user_id):
+        with self._lock:
+            return self._cache[user_id]
+
+    def __setitem__(self, user_id, value):
+        credentials = _to_credentials(value)
+        self._persist(user_id, credentials)
+        with self._lock:
+            self._cache[user_id] = credentials
+        self._schedule(user_id, credentials)
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            del self._cache[user_id]
+            self._generations.pop(user_id, None)
+        self._write(user_id, None)
+
+    def pop(self, user_id, default=None):
+        try:
+            value = self[user_id]
+        except KeyError:
+            return default
+        del self[user_id]
+        return value
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return user_id in self._cache
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._cache))
+
+    # Фоновое обновление токенов
+
+    def start(self, notify=None):
+        """Запускает планировщик в текущем цикле событий.
+
+        notify(user_id, text) - корутина для уведомления пользователя,
+        если обновить токен не удалось и нужна повторная авторизация.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._notify = notify
+        return asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            with self._lock:
+                # Выбрасываем записи, которые перекрыты более новым расписанием
+                while self._heap and self._generations.get(self._heap[0][1]) != self._heap[0][2]:
+                    heapq.heappop(self._heap)
+                delay = self._heap[0][0] - time.time() if self._heap else None
+
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            with self._lock:
+                _, user_id, generation = heapq.heappop(self._heap)
+                credentials = self._cache.get(user_id)
+            if credentials is not None:
+                # Обновления идут параллельно, чтобы одно медленное не задерживало остальные
+                task = asyncio.create_task(self._refresh(user_id, credentials))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, user_id, credentials: Credentials):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, credentials.refresh, Request())
+        except RefreshError as e:
+            # Refresh-токен отозван или истек - без пользователя тут ничего не сделать
+            self.refresh_failures += 1
+            logger.error(f"Token refresh for {user_id} was rejected: {e}")
+            self.pop(user_id)
+            # Клиенты API с отозванным токеном больше не годятся
+            invalidate_services(user_id)
+            if self._notify is not None:
+                try:
+                    await self._notify(user_id, "⚠️ Доступ к Google Calendar истек. Авторизуйтесь снова: /login")
+                except Exception:
+                    logger.exception(f"Failed to notify {user_id} about expired credentials")
+            return
+        except Exception as e:
+            # Сетевые ошибки - пробуем еще раз позже
+            self.refresh_failures += 1
+            logger.warning(f"Token refresh for {user_id} failed, retrying: {e}")
+            self._schedule(user_id, credentials, time.time() + TOKEN_REFRESH_RETRY)
+            return
+
+        self.refreshes += 1
+        self._persist(user_id, credentials)
+        self._schedule(user_id, credentials)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'users': len(self._cache),
+                'scheduled': len(self._heap),
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+            }
@@ -1,5 +1,8 @@
 from config import BOT_TOKEN
 from aiogram import Bot
 
-user_credentials = {}
+from tracing import TelegramTracing
+
 bot = Bot(token=BOT_TOKEN)
+# Каждый вызов Bot API замеряется как этап хода
+bot.session.middleware(TelegramTracing())
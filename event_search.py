@@ -0,0 +1,211 @@
+import datetime
+import re
+import time
+from collections import OrderedDict
+
+from calendar_mirror import calendar_mirror, event_time
+from calendars import calendar_directory, merged_events, sync_all
+from config import EVENT_SEARCH_MAX_USERS, EVENT_SEARCH_TTL, EVENT_SEARCH_DAYS_AHEAD
+
+
+# Служебные слова, которые не несут смысла для поиска
+STOP_WORDS = {
+    'с', 'со', 'и', 'в', 'во', 'на', 'по', 'к', 'ко', 'у', 'о', 'об', 'от', 'до', 'за',
+    'для', 'про', 'из', 'мой', 'моя', 'мое', 'мои', 'мою', 'моего', 'моей',
+}
+
+# Окончания, которые отрезаются от слов, чтобы "Петей", "Петя" и "Пети" совпадали
+ENDINGS = sorted([
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой', 'ей', 'ий', 'ый', 'ая', 'яя',
+    'ое', 'ее', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ию', 'ия', 'ие', 'ые',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+MIN_STEM = 3
+MIN_SCORE = 0.35
+
+_word_re = re.compile(r'\w+')
+
+
+def stem(word: str) -> str:
+    """Грубый стемминг русских слов: отрезаем самое длинное подходящее окончание"""
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize(text: str) -> list:
+    """Разбивает текст на нормализованные основы слов"""
+    text = text.lower().replace('ё', 'е')
+    return [stem(word) for word in _word_re.findall(text) if word not in STOP_WORDS]
+
+
+def _timestamp(moment: datetime.datetime):
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def trigrams(token: str) -> set:
+    padded = f' {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _similarity(left: set, right: set) -> float:
+    # Коэффициент Дайса по триграммам терпит опечатки в одну-две буквы
+    if not left or not right:
+        return 0.0
+    return 2 * len(left & right) / (len(left) + len(right))
+
+
+class UserIndex:
+    """Триграммный индекс событий одного пользователя"""
+
+    def __init__(self, revision: int, events: list, calendar_ids: tuple = ('primary',), horizon: float = None):
+        self.revision = revision
+        self.calendar_ids = calendar_ids
+        # До какого времени (timestamp) события попали в индекс
+        self.horizon = horizon
+        self.last_used = time.monotonic()
+        self.events = {}
+        self.tokens = {}
+        self.starts = {}
+        self.postings = {}
+
+        for event in events:
+            event_id = event['id']
+            tokens = {token: trigrams(token) for token in normalize(event.get('summary', ''))}
+            self.events[event_id] = event
+            self.tokens[event_id] = tokens
+            self.starts[event_id] = event_time(event['start']).timestamp()
+            for grams in tokens.values():
+                for gram in grams:
+                    self.postings.setdefault(gram, set()).add(event_id)
+
+    def search(self, query: str, time_min: float = None, time_max: float = None, k: int = 5) -> list:
+        query_tokens = [trigrams(token) for token in normalize(query)]
+        if not query_tokens:
+            return []
+
+        # Кандидаты - события, у которых есть хотя бы одна общая триграмма с запросом
+        candidates = set()
+        for grams in query_tokens:
+            for gram in grams:
+                candidates |= self.postings.get(gram, set())
+
+        now = time.time()
+        ranked = []
+        for event_id in candidates:
+            start = self.starts[event_id]
+            if time_min is not None and start < time_min:
+                continue
+            if time_max is not None and start >= time_max:
+                continue
+
+            event_tokens = self.tokens[event_id].values()
+            # Для каждого слова запроса берем лучшее совпадение среди слов названия
+            score = sum(max((_similarity(grams, other) for other in event_tokens), default=0.0)
+                        for grams in query_tokens) / len(query_tokens)
+            if score < MIN_SCORE:
+                continue
+
+            # При равной похожести выше ближайшие будущие события, затем недавние прошедшие
+            distance = start - now if start >= now else 2 * (now - start)
+            ranked.append((-score, distance, event_id))
+
+        ranked.sort()
+        return [(self.events[event_id], -score) for score, _, event_id in ranked[:k]]
+
+
+class EventSearch:
+    """Поиск событий по названию поверх локальной копии выбранных календарей.
+
+    Индексы пользователей живут в LRU-кеше: не больше max_users и не
+    дольше ttl секунд простоя, как агенты в SessionManager. Индекс покрывает
+    только окно копии и days_ahead дней вперед, так что праздники и дни
+    рождения на годы вперед в память не попадают. Поиск по интервалу за
+    пределами окна читает события только этого интервала, без индекса в кеше.
+    """
+
+    def __init__(self, mirror=calendar_mirror, max_users: int = EVENT_SEARCH_MAX_USERS,
+                 ttl: float = EVENT_SEARCH_TTL, days_ahead: float = EVENT_SEARCH_DAYS_AHEAD):
+        self._mirror = mirror
+        self._max_users = max_users
+        self._ttl = ttl
+        self._days_ahead = days_ahead
+        self._indexes: OrderedDict[int, UserIndex] = OrderedDict()
+
+        # Метрики
+        self.builds = 0
+        self.evictions = 0
+        self.outside = 0
+
+    async def search(self, user_id: int, service, query: str, time_min: datetime.datetime = None,
+                     time_max: datetime.datetime = None, k: int = 5) -> list:
+        """Возвращает до k пар (событие, оценка) по убыванию оценки"""
+        # Синхронизация копий могла поменять ревизию, поэтому проверяем ее после
+        calendar_ids = tuple(await calendar_directory.selected(user_id, service))
+        await sync_all(user_id, service, calendar_ids)
+
+        lower, upper = _timestamp(time_min), _timestamp(time_max)
+        horizon = time.time() + self._days_ahead * 24 * 60 * 60
+        if (lower is not None and lower < self._mirror.window_start()) or \
+                (upper is not None and upper > horizon - 24 * 60 * 60):
+            # Интервал выходит за окно индекса: разовый индекс только по нему
+            self.outside += 1
+            time_max = time_max or datetime.datetime.fromtimestamp(horizon, datetime.timezone.utc)
+            events = [event async for event in merged_events(user_id, service, time_min, time_max,
+                                                             calendar_ids=list(calendar_ids))]
+            return UserIndex(0, events, calendar_ids).search(query, lower, upper, k)
+
+        now = time.monotonic()
+        self._expire(now)
+        revision = self._mirror.revision(user_id)
+        index = self._indexes.get(user_id)
+        # Окно сдвигается со временем, поэтому индекс пересобирается и раз в сутки
+        if index is None or index.revision != revision or index.calendar_ids != calendar_ids \
+                or index.horizon < horizon - 24 * 60 * 60:
+            # Начало - окно копии, то есть без запросов к Google
+            events = [event async for event in merged_events(
+                user_id, service, time_max=datetime.datetime.fromtimestamp(horizon, datetime.timezone.utc),
+                calendar_ids=list(calendar_ids))]
+            index = UserIndex(revision, events, calendar_ids, horizon)
+            self._indexes[user_id] = index
+            self.builds += 1
+            self._evict()
+        self._indexes.move_to_end(user_id)
+        index.last_used = now
+
+        return index.search(query, lower, upper, k)
+
+    def forget(self, user_id: int):
+        self._indexes.pop(user_id, None)
+
+    def _expire(self, now: float):
+        # Самые давно использованные индексы лежат в начале словаря
+        while self._indexes:
+            user_id, index = next(iter(self._indexes.items()))
+            if now - index.last_used < self._ttl:
+                break
+            del self._indexes[user_id]
+            self.evictions += 1
+
+    def _evict(self):
+        while len(self._indexes) > self._max_users:
+            self._indexes.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._indexes),
+            'events': sum(len(index.events) for index in self._indexes.values()),
+            'builds': self.builds,
+            'evictions': self.evictions,
+            'outside': self.outside,
+        }
+
+
+event_search = EventSearch()
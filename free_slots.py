@@ -0,0 +1,106 @@
+import bisect
+import datetime
+from array import array
+
+
+def merge_intervals(starts, ends, buffer: float = 0.0):
+    """Объединяет пересекающиеся интервалы занятости.
+
+    starts и ends - параллельные последовательности timestamp. Каждый интервал
+    расширяется на buffer секунд с обеих сторон (перерыв между встречами).
+    Возвращает два array('d') непересекающихся интервалов по возрастанию:
+    одна сортировка и один проход, без объектов на каждый интервал.
+    """
+    order = sorted(range(len(starts)), key=starts.__getitem__)
+    merged_starts, merged_ends = array('d'), array('d')
+    for index in order:
+        start, end = starts[index] - buffer, ends[index] + buffer
+        if merged_ends and start <= merged_ends[-1]:
+            if end > merged_ends[-1]:
+                merged_ends[-1] = end
+        else:
+            merged_starts.append(start)
+            merged_ends.append(end)
+    return merged_starts, merged_ends
+
+
+def subtract(windows: list, busy_starts, busy_ends) -> list:
+    """Свободные интервалы внутри окон (отсортированных и непересекающихся) за вычетом занятости.
+
+    Для каждого окна первая мешающая занятость ищется бинарным поиском,
+    поэтому стоимость не зависит от того, сколько занятости вне окна.
+    """
+    free = []
+    for window_start, window_end in windows:
+        cursor = window_start
+        index = bisect.bisect_right(busy_ends, window_start)
+        while index < len(busy_starts) and busy_starts[index] < window_end:
+            if busy_starts[index] > cursor:
+                free.append((cursor, busy_starts[index]))
+            cursor = max(cursor, busy_ends[index])
+            index += 1
+        if cursor < window_end:
+            free.append((cursor, window_end))
+    return free
+
+
+def working_windows(date_from: datetime.date, date_to: datetime.date, tz, work_start: int, work_end: int,
+                    weekends: bool = False, not_before: float = None) -> list:
+    """Рабочие часы по дням диапазона (включительно) как интервалы timestamp"""
+    windows = []
+    day = date_from
+    while day <= date_to:
+        if weekends or day.weekday() < 5:
+            start = datetime.datetime(day.year, day.month, day.day, work_start, tzinfo=tz).timestamp()
+            end = datetime.datetime(day.year, day.month, day.day, tzinfo=tz) + datetime.timedelta(hours=work_end)
+            end = end.timestamp()
+            if not_before is not None:
+                start = max(start, not_before)
+            if start < end:
+                windows.append((start, end))
+        day += datetime.timedelta(days=1)
+    return windows
+
+
+def _align(timestamp: float, tz, step: int) -> float:
+    """Ближайшее время не раньше timestamp, кратное step минутам по местным часам"""
+    moment = datetime.datetime.fromtimestamp(timestamp, tz)
+    midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    seconds = (moment - midnight).total_seconds()
+    aligned = -(-seconds // (step * 60)) * step * 60
+    return (midnight + datetime.timedelta(seconds=aligned)).timestamp()
+
+
+def rank_slots(free: list, duration: float, tz, step: int = 30, limit: int = 5, per_day: int = 2) -> list:
+    """Кандидаты встречи длительностью duration секунд.
+
+    Из каждого свободного интервала берется самое раннее выровненное по step
+    начало. Кандидаты идут по времени, но не больше per_day в один день,
+    чтобы в ответе были варианты на разные дни. Возвращает тройки
+    (начало, конец, до какого времени свободно).
+    """
+    slots = []
+    days = {}
+    for free_start, free_end in free:
+        start = _align(free_start, tz, step)
+        if start + duration > free_end:
+            continue
+        day = datetime.datetime.fromtimestamp(start, tz).date()
+        if days.get(day, 0) >= per_day:
+            continue
+        days[day] = days.get(day, 0) + 1
+        slots.append((start, start + duration, free_end))
+        if len(slots) >= limit:
+            break
+    return slots
+
+
+def find_free_slots(busy: list, date_from: datetime.date, date_to: datetime.date, duration: float, tz,
+                    work_start: int = 9, work_end: int = 19, buffer: float = 0.0, weekends: bool = False,
+                    not_before: float = None, step: int = 30, limit: int = 5) -> list:
+    """Свободные окна по интервалам занятости [(начало, конец), ...] в timestamp"""
+    busy_starts = array('d', (start for start, _ in busy))
+    busy_ends = array('d', (end for _, end in busy))
+    merged_starts, merged_ends = merge_intervals(busy_starts, busy_ends, buffer)
+    windows = working_windows(date_from, date_to, tz, work_start, work_end, weekends, not_before)
+    return rank_slots(subtract(windows, merged_starts, merged_ends), duration, tz, step, limit)
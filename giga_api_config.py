@@ -4,3 +4,18 @@ SCOPE = os.environ.get('GIGA_SCOPE')
 CLIENT_ID = os.environ.get('GIGA_CLIENT_ID')
 AUTHORIZATION_KEY = os.environ.get('GIGA_AUTHORIZATION_KEY')
 
+
+# Модели: основная для агента и дешевая для простых ходов и сводок истории (пусто - только основная)
+GIGACHAT_MODEL = os.environ.get('GIGACHAT_MODEL', 'GigaChat-2')
+GIGACHAT_LIGHT_MODEL = os.environ.get('GIGACHAT_LIGHT_MODEL', '')
+# Ход считается простым, если он короче и в нем нет слов, меняющих календарь
+LIGHT_TURN_MAX_CHARS = int(os.environ.get('LIGHT_TURN_MAX_CHARS', 80))
+
+# Таймаут одной попытки, общий дедлайн вызова с повторами и число повторов
+GIGACHAT_TIMEOUT = float(os.environ.get('GIGACHAT_TIMEOUT', 30))
+GIGACHAT_DEADLINE = float(os.environ.get('GIGACHAT_DEADLINE', 90))
+GIGACHAT_MAX_RETRIES = int(os.environ.get('GIGACHAT_MAX_RETRIES', 4))
+GIGACHAT_BACKOFF_BASE = float(os.environ.get('GIGACHAT_BACKOFF_BASE', 0.5))
+GIGACHAT_BACKOFF_MAX = float(os.environ.get('GIGACHAT_BACKOFF_MAX', 8))
+# За сколько секунд до истечения обновлять токен доступа
+GIGACHAT_TOKEN_MARGIN = float(os.environ.get('GIGACHAT_TOKEN_MARGIN', 60))
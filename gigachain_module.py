@@ -1,14 +1,231 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import deque
+
+import httpx
+from gigachat.exceptions import ResponseError
 from langchain_gigachat import GigaChat
 from giga_api_config import *
+from tracing import tracer
+
+
+logger = logging.getLogger('gigachain')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Слова, после которых ход меняет календарь и требует основной модели
+WRITE_WORDS = re.compile(r'созда|добав|перенес|перенос|измен|обнов|удал|отмен|постав|запланир|назнач|сдвин')
+
+
+class LLMMetrics:
+    """Задержки, повторы и расход токенов по моделям"""
+
+    def __init__(self, window: int = 1000):
+        self._window = window
+        self._models = {}
+
+    def _model(self, name):
+        model = self._models.get(name)
+        if model is None:
+            model = self._models[name] = {
+                'calls': 0, 'errors': 0, 'retries': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0,
+                'latencies': deque(maxlen=self._window),
+            }
+        return model
+
+    def record(self, name, latency, usage=None):
+        model = self._model(name)
+        model['calls'] += 1
+        model['latencies'].append(latency)
+        if usage:
+            model['prompt_tokens'] += usage.get('prompt_tokens', usage.get('input_tokens', 0))
+            model['completion_tokens'] += usage.get('completion_tokens', usage.get('output_tokens', 0))
+
+    def record_retry(self, name):
+        self._model(name)['retries'] += 1
+
+    def record_error(self, name):
+        self._model(name)['errors'] += 1
+
+    def stats(self) -> dict:
+        result = {}
+        for name, model in self._models.items():
+            latencies = sorted(model['latencies'])
+
+            def percentile(q):
+                return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+            result[name] = {
+                'calls': model['calls'],
+                'errors': model['errors'],
+                'retries': model['retries'],
+                'prompt_tokens': model['prompt_tokens'],
+                'completion_tokens': model['completion_tokens'],
+                'latency_p50': percentile(0.5),
+                'latency_p95': percentile(0.95),
+            }
+        return result
+
+
+llm_metrics = LLMMetrics()
+
+_token_lock = None
+
+
+def _retryable(error) -> bool:
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, ResponseError):
+        # ResponseError(url, status_code, content, headers)
+        status = error.args[1] if len(error.args) > 1 else None
+        return status in RETRY_STATUSES
+    return False
 
 
-def get_model():
-    model = GigaChat(
-        credentials=CLIENT_ID,
-        model="GigaChat-2-Max",
-        verify_ssl_certs=False,
-        scope=SCOPE,
-        profanity_check=False,
-        temperature=0.1
-    )
+def _retry_after(error):
+    if isinstance(error, ResponseError) and len(error.args) > 3 and error.args[3]:
+        try:
+            return float(error.args[3].get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def _usage(result) -> dict:
+    usage = (result.llm_output or {}).get('token_usage')
+    if usage is not None and not isinstance(usage, dict):
+        usage = usage.dict()
+    if not usage and result.generations:
+        usage = getattr(result.generations[0].message, 'usage_metadata', None)
+    return usage or {}
+
+
+class ManagedGigaChat(GigaChat):
+    """GigaChat с дедлайном на вызов, повторами с экспоненциальной задержкой и метриками.
+
+    Клиент SDK (пул соединений httpx и токен доступа) создается один раз
+    на экземпляр, поэтому экземпляры раздаются через get_model и общие для всех.
+    """
+
+    async def _ensure_token(self):
+        # Токен обновляем заранее, чтобы вызов модели не ждал авторизации
+        global _token_lock
+        if not self.credentials:
+            return
+        client = self._client
+        token = getattr(client, '_access_token', None)
+        if token is not None and token.expires_at / 1000 - time.time() > GIGACHAT_TOKEN_MARGIN:
+            return
+
+        if _token_lock is None:
+            _token_lock = asyncio.Lock()
+        async with _token_lock:
+            token = getattr(client, '_access_token', None)
+            refresh = getattr(client, 'aget_token', None)
+            if refresh is not None and (token is None or token.expires_at / 1000 - time.time() <= GIGACHAT_TOKEN_MARGIN):
+                await refresh()
+
+    async def _backoff(self, attempt, error, deadline) -> bool:
+        """Ждет перед повтором, False - если повторять нельзя или не успеваем"""
+        if attempt >= GIGACHAT_MAX_RETRIES or not _retryable(error):
+            return False
+        delay = _retry_after(error)
+        if delay is None:
+            # Full jitter: случайная задержка до экспоненциальной границы
+            delay = random.uniform(0, min(GIGACHAT_BACKOFF_MAX, GIGACHAT_BACKOFF_BASE * 2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            return False
+
+        llm_metrics.record_retry(self.model)
+        logger.warning(f"GigaChat call failed ({error!r}), retry {attempt + 1} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+        return True
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        called = time.monotonic()
+        deadline = called + GIGACHAT_DEADLINE
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                await self._ensure_token()
+                result = await asyncio.wait_for(
+                    super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+                    min(GIGACHAT_TIMEOUT, deadline - started)
+                )
+            except Exception as e:
+                if await self._backoff(attempt, e, deadline):
+                    attempt += 1
+                    continue
+                llm_metrics.record_error(self.model)
+                tracer.record('llm', time.monotonic() - called, error=type(e).__name__, model=self.model, attempts=attempt + 1)
+                raise
+
+            llm_metrics.record(self.model, time.monotonic() - started, _usage(result))
+            tracer.record('llm', time.monotonic() - called, model=self.model, attempts=attempt + 1)
+            return result
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        called = time.monotonic()
+        deadline = called + GIGACHAT_DEADLINE
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            usage = None
+            streamed = False
+            try:
+                await self._ensure_token()
+                stream = super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs).__aiter__()
+                while True:
+                    # Таймаут на каждый кусок: поток не должен зависнуть молча
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), min(GIGACHAT_TIMEOUT, deadline - time.monotonic()))
+                    except StopAsyncIteration:
+                        break
+                    streamed = True
+                    usage = getattr(chunk.message, 'usage_metadata', None) or usage
+                    yield chunk
+            except Exception as e:
+                # После первого куска повторять нельзя: пользователь уже видел часть ответа
+                if not streamed and await self._backoff(attempt, e, deadline):
+                    attempt += 1
+                    continue
+                llm_metrics.record_error(self.model)
+                tracer.record('llm', time.monotonic() - called, error=type(e).__name__, model=self.model, attempts=attempt + 1)
+                raise
+
+            llm_metrics.record(self.model, time.monotonic() - started, usage)
+            tracer.record('llm', time.monotonic() - called, model=self.model, attempts=attempt + 1, streamed=True)
+            return
+
+
+_models = {}
+
+
+def get_model(route: str = 'main') -> ManagedGigaChat:
+    """Общий клиент модели для маршрута: 'main' - основная, 'light' - дешевая"""
+    name = GIGACHAT_LIGHT_MODEL if route == 'light' and GIGACHAT_LIGHT_MODEL else GIGACHAT_MODEL
+    model = _models.get(name)
+    if model is None:
+        model = _models[name] = ManagedGigaChat(
+            credentials=AUTHORIZATION_KEY,
+            scope=SCOPE,
+            model=name,
+            verify_ssl_certs=False,
+            profanity_check=False,
+            timeout=GIGACHAT_TIMEOUT
+        )
     return model
+
+
+def choose_route(text: str) -> str:
+    """Короткие вопросы без изменений календаря отдаем дешевой модели"""
+    if not GIGACHAT_LIGHT_MODEL or not text:
+        return 'main'
+    if len(text) > LIGHT_TURN_MAX_CHARS or WRITE_WORDS.search(text.lower()):
+        return 'main'
+    return 'light'
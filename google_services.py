@@ -0,0 +1,279 @@
+import asyncio
+import contextlib
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import google_auth_httplib2
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from config import (GOOGLE_HTTP_TIMEOUT, GOOGLE_MAX_WORKERS,
+                    GOOGLE_USER_CONCURRENCY, GOOGLE_REQUEST_TIMEOUT, GOOGLE_PAGE_SIZE)
+from tracing import tracer
+
+# Разобранные discovery-документы (по одному на API на процесс)
+_documents = {}
+# user_id, api, version -> (отпечаток учетных данных, сервис)
+_services = {}
+_lock = threading.Lock()
+
+# Пул потоков для блокирующих вызовов googleapiclient
+_executor = ThreadPoolExecutor(max_workers=GOOGLE_MAX_WORKERS, thread_name_prefix='google-api')
+# httplib2.Http не потокобезопасен, поэтому у каждого потока свое keep-alive соединение
+_local = threading.local()
+_global_semaphore = None
+
+# Google принимает не больше 50 запросов в одном batch для Calendar API
+BATCH_LIMIT = 50
+
+
+def _discovery_document(api: str, version: str) -> dict:
+    """Статический discovery-документ из пакета googleapiclient, без похода в сеть"""
+    key = (api, version)
+    document = _documents.get(key)
+    if document is None:
+        content = get_static_doc(api, version)
+        if content is None:
+            raise RuntimeError(f"Нет статического discovery-документа для {api} {version}")
+        document = json.loads(content)
+        _documents[key] = document
+    return document
+
+
+def to_credentials(creds_data) -> Credentials:
+    """Преобразует словарь из хранилища в объект Credentials"""
+    if isinstance(creds_data, dict):
+        return Credentials(
+            token=creds_data.get('token'),
+            refresh_token=creds_data.get('refresh_token'),
+            token_uri=creds_data.get('token_uri'),
+            client_id=creds_data.get('client_id'),
+            client_secret=creds_data.get('client_secret'),
+            scopes=creds_data.get('scopes')
+        )
+    return creds_data
+
+
+def _fingerprint(creds_data):
+    if isinstance(creds_data, dict):
+        return (creds_data.get('refresh_token'),
+                creds_data.get('token'),
+                creds_data.get('client_id'),
+                tuple(creds_data.get('scopes') or ()))
+    return id(creds_data)
+
+
+def build_service(api: str, version: str, credentials):
+    """Собирает клиент API поверх готового документа и keep-alive соединения"""
+    http = google_auth_httplib2.AuthorizedHttp(
+        to_credentials(credentials),
+        http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+    )
+    return build_from_document(_discovery_document(api, version), http=http)
+
+
+def get_service(user_id: int, creds_data, api: str = 'calendar', version: str = 'v3'):
+    """Возвращает закешированный клиент пользователя, пересобирая его при смене учетных данных"""
+    key = (user_id, api, version)
+    fingerprint = _fingerprint(creds_data)
+
+    with _lock:
+        cached = _services.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+    service = build_service(api, version, creds_data)
+    with _lock:
+        _services[key] = (fingerprint, service)
+    return service
+
+
+def get_calendar_service(user_id: int, creds_data):
+    return get_service(user_id, creds_data, 'calendar', 'v3')
+
+
+def invalidate(user_id: int):
+    """Сбрасывает все клиенты пользователя (выход, повторная авторизация)"""
+    with _lock:
+        for key in [key for key in _services if key[0] == user_id]:
+            del _services[key]
+
+
+def _thread_http() -> httplib2.Http:
+    http = getattr(_local, 'http', None)
+    if http is None:
+        http = httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+        _local.http = http
+    return http
+
+
+def execute(request):
+    """Выполняет запрос в текущем потоке через его собственное соединение"""
+    http = google_auth_httplib2.AuthorizedHttp(request.http.credentials, http=_thread_http())
+    return request.execute(http=http)
+
+
+class UserLimits:
+    """Ограничение одновременных операций на пользователя.
+
+    Семафор пользователя живет, пока его кто-то держит или ждет, и
+    удаляется, как только пользователь простаивает, поэтому словарь
+    не растет с числом пользователей.
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        # user_id -> [семафор, сколько держат или ждут]
+        self._slots = {}
+
+    async def acquire(self, user_id):
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = [asyncio.Semaphore(self._limit), 0]
+        slot[1] += 1
+        try:
+            await slot[0].acquire()
+        except BaseException:
+            self._leave(user_id, slot)
+            raise
+
+    def release(self, user_id):
+        slot = self._slots[user_id]
+        slot[0].release()
+        self._leave(user_id, slot)
+
+    def _leave(self, user_id, slot):
+        slot[1] -= 1
+        if slot[1] == 0:
+            del self._slots[user_id]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id):
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    def __len__(self):
+        return len(self._slots)
+
+
+_user_limits = UserLimits(GOOGLE_USER_CONCURRENCY)
+
+
+def _global():
+    global _global_semaphore
+    if _global_semaphore is None:
+        _global_semaphore = asyncio.Semaphore(GOOGLE_MAX_WORKERS)
+    return _global_semaphore
+
+
+async def _acquire(user_id, global_semaphore):
+    if user_id is not None:
+        await _user_limits.acquire(user_id)
+    try:
+        await global_semaphore.acquire()
+    except BaseException:
+        if user_id is not None:
+            _user_limits.release(user_id)
+        raise
+
+
+def _finished(user_id, global_semaphore, future):
+    global_semaphore.release()
+    if user_id is not None:
+        _user_limits.release(user_id)
+    # Ошибку запроса, который вызывающий перестал ждать, все равно забираем, чтобы не было предупреждения
+    if not future.cancelled():
+        future.exception()
+
+
+async def _run(user_id, timeout, func, *args):
+    global_semaphore = _global()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    # Пока запрос ждет места, его можно снять с очереди по таймауту или отмене
+    await asyncio.wait_for(_acquire(user_id, global_semaphore), timeout)
+    try:
+        future = loop.run_in_executor(_executor, func, *args)
+    except BaseException:
+        _finished(user_id, global_semaphore, loop.create_future())
+        raise
+    # Места освобождаются, только когда поток закончил запрос, даже если вызывающий уже не ждет:
+    # иначе после таймаута в потоках шло бы больше запросов, чем позволяют лимиты
+    future.add_done_callback(functools.partial(_finished, user_id, global_semaphore))
+
+    with tracer.span(f'google.{func.__name__}'):
+        return await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - loop.time()))
+
+
+async def aexecute(request, user_id: int = None, timeout: float = GOOGLE_REQUEST_TIMEOUT):
+    """Асинхронно выполняет запрос Google API, не блокируя цикл событий бота.
+
+    Число одновременных запросов ограничено глобально и на пользователя.
+    Таймаут отсчитывается с момента постановки в очередь; при отмене задачи
+    обработчика запрос, еще не взятый потоком, снимается с очереди.
+    """
+    return await _run(user_id, timeout, execute, request)
+
+
+def execute_batch(service, requests: list) -> list:
+    """Отправляет запросы одним batch-запросом, возвращает пары (ответ, ошибка) в исходном порядке"""
+    results = [(None, None)] * len(requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    for offset in range(0, len(requests), BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for index in range(offset, min(offset + BATCH_LIMIT, len(requests))):
+            batch.add(requests[index], request_id=str(index))
+        http = google_auth_httplib2.AuthorizedHttp(requests[offset].http.credentials, http=_thread_http())
+        batch.execute(http=http)
+
+    return results
+
+
+async def aexecute_batch(service, requests: list, user_id: int = None,
+                         timeout: float = GOOGLE_REQUEST_TIMEOUT) -> list:
+    """Асинхронный вариант execute_batch с теми же ограничениями, что и aexecute"""
+    if not requests:
+        return []
+    return await _run(user_id, timeout, execute_batch, service, requests)
+
+
+# Поля события, которые мы реально показываем и храним
+EVENT_FIELDS = 'id,status,summary,start,end,etag,location,htmlLink'
+
+
+async def iter_events(service, user_id: int, limit: int = None, page_size: int = GOOGLE_PAGE_SIZE,
+                      fields: str = EVENT_FIELDS, **params):
+    """Лениво проходит по страницам events.list.
+
+    Запрашиваются только нужные поля, следующая страница запрашивается только
+    когда потребитель дочитал предыдущую, а при достижении limit обход прекращается.
+    """
+    page_token = None
+    yielded = 0
+    while True:
+        max_results = page_size if limit is None else min(page_size, limit - yielded)
+        request_params = dict(params, maxResults=max_results, fields=f'nextPageToken,items({fields})')
+        if page_token:
+            request_params['pageToken'] = page_token
+
+        page = await aexecute(service.events().list(**request_params), user_id)
+        for event in page.get('items', []):
+            yield event
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            return
@@ -1,44 +1,38 @@
 from aiogram import types, Router
 from aiogram.filters import Command
-from google_auth_oauthlib.flow import Flow
+import contextlib
 import datetime
-from google.oauth2.credentials import Credentials
+import logging
 from oauthServer import active_flows, credentials_store
-from config import CLIENT_SECRET_FILE, SCOPES, REDIRECT_URI
-import uuid
+from google_services import build_service, get_calendar_service, aexecute
+from calendars import calendar_directory, merged_events
 
 
+logger = logging.getLogger('commandHandlers')
+
 command_router = Router()
 
 
 async def get_user_info(credentials):
     """Получаем информацию о пользователе Google"""
-    from googleapiclient.discovery import build
-    service = build('oauth2', 'v2', credentials=credentials)
-    user_info = service.userinfo().get().execute()
+    service = build_service('oauth2', 'v2', credentials)
+    user_info = await aexecute(service.userinfo().get())
     return user_info
 
 
-async def get_events(credentials):
-    """Получаем события"""
-    from googleapiclient.discovery import build
-    service = build("calendar", "v3", credentials=credentials)
-
-    # Call the Calendar API
-    now = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
-    print("Getting the upcoming 10 events")
-    events_result = (
-        service.events()
-        .list(
-            calendarId="primary",
-            timeMin=now,
-            maxResults=10,
-            singleEvents=True,
-            orderBy="startTime",
-        )
-        .execute()
-    )
-    events = events_result.get("items", [])
+async def get_events(user_id, creds_data, limit: int = 10):
+    """Получаем ближайшие события из всех выбранных календарей"""
+    service = get_calendar_service(user_id, creds_data)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    logger.debug(f"Getting the upcoming {limit} events of {user_id}")
+    events = []
+    # Слияние ленивое: из каждого календаря читается только то, что попадет в первые limit событий
+    async with contextlib.aclosing(merged_events(user_id, service, time_min=now)) as merged:
+        async for event in merged:
+            events.append(event)
+            if len(events) >= limit:
+                break
 
     return events
 
@@ -53,25 +47,8 @@ async def handle_login(message: types.Message):
     user_id = message.from_user.id
 
     try:
-        # Создаем OAuth поток
-        flow = Flow.from_client_secrets_file(
-            CLIENT_SECRET_FILE,
-            scopes=SCOPES,
-            redirect_uri=REDIRECT_URI
-        )
-
-        # Генерируем уникальный state для защиты от CSRF
-        state = str(uuid.uuid4())
-
-        # Генерируем URL авторизации
-        auth_url, _ = flow.authorization_url(
-            access_type='offline',
-            prompt='consent',
-            state=state
-        )
-
-        # Сохраняем flow для последующего использования
-        active_flows[state] = (user_id, flow)
+        # Генерируем URL авторизации, state для защиты от CSRF живет LOGIN_FLOW_TTL
+        auth_url = await active_flows.start(user_id)
 
         # Отправляем кнопку с ссылкой
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -100,22 +77,13 @@ async def handle_events(message: types.Message):
         return
 
     try:
-        # Восстанавливаем credentials
-        creds_data = credentials_store[user_id]
-        credentials = Credentials(
-            token=creds_data['token'],
-            refresh_token=creds_data['refresh_token'],
-            token_uri=creds_data['token_uri'],
-            client_id=creds_data['client_id'],
-            client_secret=creds_data['client_secret'],
-            scopes=creds_data['scopes']
-        )
-
         # Получаем события
-        events = await get_events(credentials)
+        events = await get_events(user_id, credentials_store[user_id])
         for event in events:
             start = event["start"].get("dateTime", event["start"].get("date"))
-            await message.answer(f"Вот твой ивент: {start} {event["summary"]}")
+            calendar = event.get("calendarId", "primary")
+            suffix = f" [{calendar_directory.name(user_id, calendar)}]" if calendar != "primary" else ""
+            await message.answer(f"Вот твой ивент: {start} {event.get('summary', 'Без названия')}{suffix}")
 
     except Exception as e:
         await message.answer(f"⚠️ Ошибка: {str(e)}\nПопробуйте снова: /login")
@@ -1,59 +1,123 @@
 from aiogram import types, Router
+from aiogram.utils.chat_action import ChatActionSender
 from dotenv import find_dotenv, load_dotenv
-import os
 import json
+import logging
+import time
 from db import bot
 
-from langchain_gigachat import GigaChat
-
 from tools.google_calendar import (make_view_google_events_tool,
                                    make_create_google_event_tool,
                                    make_delete_google_event_tool,
                                    make_find_google_event_tool,
-                                   make_update_google_event_tool)
+                                   make_find_free_slots_tool,
+                                   make_update_google_event_tool,
+                                   make_bulk_create_google_events_tool,
+                                   make_bulk_update_google_events_tool,
+                                   make_bulk_delete_google_events_tool)
 
 from LLMAgent import LLMAgent
-from STT import convert_ogg_to_wav, recognize_speech
+from gigachain_module import get_model, choose_route
+from session_manager import SessionManager, AgentSession
+from write_coalescer import write_coalescer
+from intent_router import intent_router
+from turn_scheduler import turn_scheduler, SchedulerOverloaded
+from STT import recognize_speech
+from reply_stream import StreamingReply
+from tracing import tracer
+from config import STREAM_REPLIES, STT_DOWNLOAD_TIMEOUT
 
 
 text_router = Router()
 
-load_dotenv(find_dotenv())
-
-model = GigaChat(
-        model="GigaChat-2",
-        verify_ssl_certs=False
-    )
-
+logger = logging.getLogger('textHandlers')
 
-async def get_ai_response(message, user_id):
+load_dotenv(find_dotenv())
 
+def make_agent_session(user_id):
+    """Собирает инструменты и агента для пользователя"""
     google_view_events_tool = make_view_google_events_tool(user_id)
     google_find_events_tool = make_find_google_event_tool(user_id)
+    google_free_slots_tool = make_find_free_slots_tool(user_id)
     google_create_events_tool = make_create_google_event_tool(user_id)
     google_delete_events_tool = make_delete_google_event_tool(user_id)
     google_update_events_tool = make_update_google_event_tool(user_id)
+    google_bulk_create_events_tool = make_bulk_create_google_events_tool(user_id)
+    google_bulk_update_events_tool = make_bulk_update_google_events_tool(user_id)
+    google_bulk_delete_events_tool = make_bulk_delete_google_events_tool(user_id)
 
     tools = [google_view_events_tool,
              google_find_events_tool,
+             google_free_slots_tool,
              google_create_events_tool,
              google_delete_events_tool,
-             google_update_events_tool]
+             google_update_events_tool,
+             google_bulk_create_events_tool,
+             google_bulk_update_events_tool,
+             google_bulk_delete_events_tool]
 
     # Делаем агента
+    # Клиенты моделей общие для всех агентов: один пул соединений и один токен
     agent = LLMAgent(
-        model=model,
+        model=get_model('main'),
         tools=tools,
-        user_id=user_id
+        user_id=user_id,
+        light_model=get_model('light')
     )
 
-    # Получаем ответ
-    return await agent.ainvoke(message)
+    return AgentSession(agent=agent, tools=tools)
 
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-TEMP_DIR = os.path.join(BASE_DIR, "temp")
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Агенты переиспользуются между сообщениями, чтобы не компилировать граф
+# на каждый запрос и не терять память диалога
+session_manager = SessionManager(make_agent_session)
+
+
+async def get_ai_response(message, user_id):
+    session = session_manager.get(user_id)
+
+    # Получаем ответ
+    try:
+        answer = await session.agent.ainvoke(message, route=choose_route(message))
+    finally:
+        # Правки, не отправленные инструментами, уходят в конце хода
+        errors = await write_coalescer.flush(user_id)
+
+    return _with_write_errors(answer, errors)
+
+
+async def stream_ai_response(message: types.Message, request, user_id):
+    """Ход агента с прогрессом в одном редактируемом сообщении"""
+    session = session_manager.get(user_id)
+    reply = StreamingReply(message)
+
+    async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
+        await reply.start()
+        answer = ''
+        try:
+            async for kind, value in session.agent.astream(request, route=choose_route(request)):
+                if kind == "tool":
+                    reply.tool(value)
+                elif kind == "token":
+                    reply.token(value)
+                elif kind == "reset":
+                    reply.reset()
+                else:
+                    answer = value
+        except Exception:
+            # Подробности - в лог, пользователю текст исключения не нужен
+            logger.exception(f"Agent turn of {user_id} failed")
+            answer = "⚠️ Не получилось обработать запрос. Попробуйте еще раз"
+        finally:
+            errors = await write_coalescer.flush(user_id)
+
+        await reply.finish(_with_write_errors(answer, errors))
+
+
+def _with_write_errors(answer, errors):
+    if errors:
+        answer += "\n\n⚠️ Не все изменения сохранились:\n" + "\n".join(errors)
+    return answer
 
 
 async def speech_to_text(message: types.Message):
@@ -64,44 +128,69 @@ async def speech_to_text(message: types.Message):
     voice = message.voice
     file_id = voice.file_id
 
-    # Создаем пути с полными именами
-    ogg_path = os.path.join(TEMP_DIR, f"{file_id}.ogg")
-    wav_path = os.path.join(TEMP_DIR, f"{file_id}.wav")
-
     try:
-        # Скачивание файла
-        file = await bot.get_file(file_id)
-        await bot.download(file, destination=ogg_path)
-
-        # Конвертация
-        await convert_ogg_to_wav(ogg_path, wav_path)
+        # Файл не сохраняется на диск: скачиваем его в память здесь, чтобы URL
+        # с токеном бота не уходил в процессы распознавания, и декодируем на лету
+        with tracer.span('stt.download'):
+            file = await bot.get_file(file_id)
+            if bot.session.api.is_local:
+                source = file.file_path
+            else:
+                downloaded = await bot.download_file(file.file_path, timeout=STT_DOWNLOAD_TIMEOUT)
+                source = downloaded.getvalue()
 
         # Распознавание
-        text = await recognize_speech(wav_path)
+        with tracer.span('stt.recognize'):
+            text = await recognize_speech(source)
         if text.strip():
             answer = text
         else:
             answer = "Не удалось распознать речь"
     except Exception as e:
         answer = str(e)
-    finally:
-        # Безопасное удаление файлов
-        for path in [ogg_path, wav_path]:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception as e:
-                    print(f"Ошибка удаления файла {path}: {e}")
 
     return answer
 
 
 @text_router.message()
 async def handle_text(message: types.Message):
-    request = ''
-    if message.content_type == types.ContentType.VOICE:
-        request = await speech_to_text(message)
-    else:
-        request = message.text
+    user_id = message.from_user.id
 
-    await message.answer(await get_ai_response(request, message.from_user.id))
+    # Все этапы хода замеряются и привязываются к пользователю и номеру хода
+    with tracer.turn(user_id, kind=message.content_type):
+        request = ''
+        if message.content_type == types.ContentType.VOICE:
+            request = await speech_to_text(message)
+        else:
+            request = message.text
+
+        # Ходы одного пользователя идут по очереди, общее число одновременных ограничено
+        try:
+            async with turn_scheduler.turn(user_id) as ticket:
+                tracer.record('scheduler.wait', ticket.wait)
+                await handle_turn(message, request, user_id)
+        except SchedulerOverloaded:
+            await message.answer("🙏 Сейчас очень много запросов, я не успеваю. Попробуйте через минуту")
+
+
+async def handle_turn(message: types.Message, request, user_id):
+    # Простые запросы ("что у меня завтра", "удали X в пятницу") обрабатываем без LLM
+    session = session_manager.get(user_id)
+    with tracer.span('intent_router'):
+        answer = await intent_router.handle(request, user_id, {tool.name: tool for tool in session.tools})
+
+    if answer is not None:
+        await message.answer(answer)
+        try:
+            await session.agent.remember(request, answer)
+        except Exception:
+            logger.exception(f"Failed to save fast path turn of {user_id}")
+        return
+
+    started = time.perf_counter()
+    with tracer.span('agent', route=choose_route(request)):
+        if STREAM_REPLIES:
+            await stream_ai_response(message, request, user_id)
+        else:
+            await message.answer(await get_ai_response(request, user_id))
+    intent_router.record_llm(time.perf_counter() - started)
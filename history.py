@@ -0,0 +1,99 @@
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage, RemoveMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+from turn_scheduler import llm_rate_limiter
+from config import HISTORY_TOKEN_BUDGET, HISTORY_KEEP_TURNS, TOOL_OUTPUT_KEEP_CHARS
+
+
+SUMMARY_ID = 'history-summary'
+TRIMMED_MARK = '…(обрезано)'
+
+SUMMARY_PROMPT = (
+    "Сожми историю диалога пользователя с ассистентом календаря в краткую сводку. "
+    "Сохрани договоренности, названия, даты и id событий, которые могут понадобиться дальше. "
+    "Не добавляй ничего от себя. Пиши по-русски, не больше 10 предложений."
+)
+
+
+def approx_tokens(messages) -> int:
+    # Точный токенизатор GigaChat требует запроса к API, для бюджета хватает оценки
+    return sum(len(str(message.content)) for message in messages) // 3
+
+
+def split_history(messages):
+    """Делит историю на сводку (если есть) и ходы, каждый ход начинается с сообщения пользователя"""
+    summary = None
+    if messages and messages[0].id == SUMMARY_ID:
+        summary, messages = messages[0], messages[1:]
+
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return summary, turns
+
+
+def _trim_tool_outputs(turn):
+    trimmed = []
+    changed = False
+    for message in turn:
+        content = str(message.content)
+        if (isinstance(message, ToolMessage) and len(content) > TOOL_OUTPUT_KEEP_CHARS
+                and not content.endswith(TRIMMED_MARK)):
+            message = message.model_copy(update={'content': content[:TOOL_OUTPUT_KEEP_CHARS] + TRIMMED_MARK})
+            changed = True
+        trimmed.append(message)
+    return trimmed, changed
+
+
+async def _summarize(model, summary, turns) -> str:
+    lines = []
+    if summary is not None:
+        lines.append(f"Предыдущая сводка: {summary.content}")
+    for turn in turns:
+        for message in turn:
+            if message.content:
+                lines.append(f"{message.type}: {message.content}")
+
+    # Сводка - такой же вызов GigaChat, как ход агента, и расходует тот же лимит
+    await llm_rate_limiter.acquire()
+    response = await model.ainvoke([
+        SystemMessage(content=SUMMARY_PROMPT),
+        HumanMessage(content="\n".join(lines))
+    ])
+    return response.content
+
+
+async def compact(model, messages, budget: int = HISTORY_TOKEN_BUDGET, keep_turns: int = HISTORY_KEEP_TURNS):
+    """Ужимает историю диалога.
+
+    Результаты инструментов из прошлых ходов обрезаются, а если история
+    все равно больше бюджета, ходы старше keep_turns последних сворачиваются
+    в сводку. Возвращает новый список сообщений или None, если менять нечего.
+    """
+    summary, turns = split_history(messages)
+
+    changed = False
+    for index in range(len(turns) - 1):
+        turns[index], trimmed = _trim_tool_outputs(turns[index])
+        changed = changed or trimmed
+
+    kept = [message for turn in turns for message in turn]
+    if approx_tokens(kept) > budget and len(turns) > keep_turns:
+        old, turns = turns[:-keep_turns], turns[-keep_turns:]
+        summary = SystemMessage(content=await _summarize(model, summary, old), id=SUMMARY_ID)
+        kept = [message for turn in turns for message in turn]
+        changed = True
+
+    if not changed:
+        return None
+    return ([summary] if summary is not None else []) + kept
+
+
+async def compaction_hook(model, state) -> dict:
+    """pre_model_hook для create_react_agent: переписывает историю в чекпоинте"""
+    messages = await compact(model, state["messages"])
+    if messages is None:
+        return {}
+    return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)] + messages}
@@ -0,0 +1,251 @@
+import datetime
+import logging
+import re
+import time
+
+from calendar_mirror import event_time
+from calendars import calendar_directory, events_page
+from event_search import event_search
+from google_services import get_calendar_service
+from oauthServer import credentials_store
+from config import FAST_VIEW_MAX_EVENTS
+
+
+logger = logging.getLogger('intentRouter')
+
+WEEKDAYS = {
+    'понедельник': 0, 'вторник': 1, 'среду': 2, 'среда': 2, 'четверг': 3,
+    'пятницу': 4, 'пятница': 4, 'субботу': 5, 'суббота': 5, 'воскресенье': 6,
+}
+
+MONTHS = {
+    'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4, 'мая': 5, 'июня': 6,
+    'июля': 7, 'августа': 8, 'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12,
+}
+
+# Минимальная оценка поиска, при которой удаляем событие без уточнений
+DELETE_MIN_SCORE = 0.8
+
+VIEW_RE = re.compile(
+    r'^(?:а\s+)?(?:что|какие|какое|покажи(?:\s+мне)?)\s+'
+    r'(?:у\s+меня\s+)?'
+    r'(?:(?:запланировано|есть|в\s+планах|в\s+календаре)\s+)?'
+    r'(?:(?:мои\s+)?(?:встречи|события|дела|планы|мероприятия|расписание)\s+)?'
+    r'(?:у\s+меня\s+)?'
+    r'(?P<when>.+)$'
+)
+
+DELETE_RE = re.compile(
+    r'^(?:удали|удалить|отмени|отменить)\s+(?:(?:встречу|событие|мероприятие)\s+)?(?P<rest>.+)$'
+)
+
+
+def _day(date: datetime.date, tz) -> datetime.datetime:
+    return datetime.datetime(date.year, date.month, date.day, tzinfo=tz)
+
+
+def parse_when(text: str, now: datetime.datetime = None):
+    """Разбирает относительную дату ("завтра", "на следующей неделе", "в пятницу", "15 мая").
+
+    Возвращает интервал (начало, конец) или None, если фраза не распознана целиком.
+    """
+    now = now or datetime.datetime.now().astimezone()
+    tz = now.tzinfo
+    today = now.date()
+    text = re.sub(r'^(?:на|в|во)\s+', '', text.strip())
+
+    if text == 'сегодня':
+        return _day(today, tz), _day(today + datetime.timedelta(days=1), tz)
+    if text == 'завтра':
+        return _day(today + datetime.timedelta(days=1), tz), _day(today + datetime.timedelta(days=2), tz)
+    if text == 'послезавтра':
+        return _day(today + datetime.timedelta(days=2), tz), _day(today + datetime.timedelta(days=3), tz)
+    if text == 'вчера':
+        return _day(today - datetime.timedelta(days=1), tz), _day(today, tz)
+
+    week_start = today - datetime.timedelta(days=today.weekday())
+    if text in ('неделе', 'этой неделе', 'эту неделю', 'неделю'):
+        return _day(today, tz), _day(week_start + datetime.timedelta(days=7), tz)
+    if text in ('следующей неделе', 'следующую неделю'):
+        start = week_start + datetime.timedelta(days=7)
+        return _day(start, tz), _day(start + datetime.timedelta(days=7), tz)
+    if text in ('выходных', 'выходные', 'эти выходные'):
+        saturday = week_start + datetime.timedelta(days=5)
+        return _day(max(saturday, today), tz), _day(week_start + datetime.timedelta(days=7), tz)
+    if text in ('этом месяце', 'этот месяц', 'месяц'):
+        next_month = (today.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        return _day(today, tz), _day(next_month, tz)
+
+    if text in WEEKDAYS:
+        # Ближайший такой день недели, включая сегодняшний
+        date = today + datetime.timedelta(days=(WEEKDAYS[text] - today.weekday()) % 7)
+        return _day(date, tz), _day(date + datetime.timedelta(days=1), tz)
+
+    date = None
+    match = re.fullmatch(r'(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?', text)
+    if match:
+        day, month, year = match.groups()
+        year = int(year) + (2000 if len(year) == 2 else 0) if year else today.year
+        date = (year, int(month), int(day))
+    match = re.fullmatch(r'(\d{1,2})\s+(\w+)', text)
+    if match and match.group(2) in MONTHS:
+        date = (today.year, MONTHS[match.group(2)], int(match.group(1)))
+    if date:
+        try:
+            date = datetime.date(*date)
+        except ValueError:
+            return None
+        return _day(date, tz), _day(date + datetime.timedelta(days=1), tz)
+
+    return None
+
+
+def _format_when(event: dict, tz) -> str:
+    """Время события в часовом поясе пользователя, без ISO"""
+    if 'dateTime' not in event['start']:
+        return datetime.date.fromisoformat(event['start']['date']).strftime('%d.%m') + ', весь день'
+    start = event_time(event['start']).astimezone(tz)
+    end = event_time(event['end']).astimezone(tz)
+    if start.date() == end.date():
+        return f"{start:%d.%m %H:%M}–{end:%H:%M}"
+    return f"{start:%d.%m %H:%M} – {end:%d.%m %H:%M}"
+
+
+def _format_event(event: dict, tz) -> str:
+    """Строка события для ответа пользователю"""
+    return f"• {_format_when(event, tz)} {event.get('summary', 'Без названия')}"
+
+
+def _normalize(text: str) -> str:
+    text = text.lower().replace('ё', 'е')
+    # Точку между цифрами оставляем, это дата вида 15.05
+    text = re.sub(r'[?!,;:]+|\.(?!\d)', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def _split_when(rest: str, now: datetime.datetime = None):
+    """Отделяет дату от конца фразы: "созвон с петей завтра" -> ("созвон с петей", интервал)"""
+    words = rest.split()
+    for size in (3, 2, 1):
+        if len(words) <= size:
+            continue
+        interval = parse_when(' '.join(words[-size:]), now)
+        if interval:
+            return ' '.join(words[:-size]), interval
+    return None, None
+
+
+class IntentRouter:
+    """Быстрый путь для простых запросов без вызова LLM.
+
+    Распознает просмотр событий за относительный период и удаление события
+    по названию и дате. Если уверенности нет, возвращает None, и запрос
+    уходит агенту.
+    """
+
+    def __init__(self):
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.fast_time = 0.0
+        self.llm_turns = 0
+        self.llm_time = 0.0
+
+    async def handle(self, text: str, user_id: int, tools: dict):
+        """Отвечает на запрос напрямую или возвращает None"""
+        if not text:
+            return None
+
+        started = time.perf_counter()
+        answer = await self._route(_normalize(text), user_id, tools)
+        if answer is None:
+            self.misses += 1
+            return None
+
+        elapsed = time.perf_counter() - started
+        self.hits += 1
+        self.fast_time += elapsed
+        logger.info(f"Fast path answered {user_id} in {elapsed:.3f}s")
+        return answer
+
+    def record_llm(self, elapsed: float):
+        self.llm_turns += 1
+        self.llm_time += elapsed
+
+    async def _route(self, text, user_id, tools):
+        view = VIEW_RE.match(text)
+        delete = None if view else DELETE_RE.match(text)
+        if not view and not delete:
+            return None
+
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            return None
+        service = get_calendar_service(user_id, creds_data)
+        # Границы дней и время в ответе - по часам пользователя, а не сервера
+        tz = await calendar_directory.timezone(user_id, service)
+        now = datetime.datetime.now(tz)
+
+        if view:
+            interval = parse_when(view.group('when'), now)
+            if interval:
+                return await self._view(user_id, service, interval, tz)
+            return None
+
+        what, interval = _split_when(delete.group('rest'), now)
+        if what:
+            return await self._delete(user_id, service, tools, what, interval, tz)
+        return None
+
+    async def _view(self, user_id, service, interval, tz):
+        start, end = interval
+        errors = {}
+        events, total, _, _ = await events_page(user_id, service, start.astimezone(datetime.timezone.utc),
+                                                end.astimezone(datetime.timezone.utc), FAST_VIEW_MAX_EVENTS,
+                                                errors=errors)
+
+        lines = []
+        for event in events:
+            line = _format_event(event, tz)
+            calendar_id = event.get('calendarId', 'primary')
+            if calendar_id != 'primary':
+                line += f" [{calendar_directory.name(user_id, calendar_id)}]"
+            lines.append(line)
+        if total > len(events):
+            lines.append(f"…и еще {total - len(events)}. Напишите «покажи остальные», если нужно")
+        if not events:
+            lines.append("На этот период событий нет")
+        for calendar_id in errors:
+            lines.append(f"⚠️ Календарь {calendar_directory.name(user_id, calendar_id)} сейчас недоступен, "
+                         f"его события не показаны")
+        return "\n".join(lines)
+
+    async def _delete(self, user_id, service, tools, what, interval, tz):
+        found = await event_search.search(user_id, service, what, interval[0], interval[1], k=2)
+
+        # Удаляем только при одном уверенном совпадении, иначе пусть разбирается агент
+        if not found or found[0][1] < DELETE_MIN_SCORE:
+            return None
+        if len(found) > 1 and found[1][1] >= DELETE_MIN_SCORE:
+            return None
+
+        event = found[0][0]
+        result = await tools['delete_google_event'].ainvoke({'event_id': event['id']})
+        if result.startswith('ERROR'):
+            return result
+
+        return f"Удалил «{event.get('summary', 'Без названия')}» ({_format_when(event, tz)})"
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'fast_hits': self.hits,
+            'fast_misses': self.misses,
+            'fast_hit_rate': self.hits / total if total else 0.0,
+            'fast_avg_latency': self.fast_time / self.hits if self.hits else 0.0,
+            'llm_turns': self.llm_turns,
+            'llm_avg_latency': self.llm_time / self.llm_turns if self.llm_turns else 0.0,
+        }
+
+
+intent_router = IntentRouter()
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import multiprocessing
 
 from aiogram import Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -8,22 +9,216 @@ from db import bot
 from handlers.command_handlers import command_router
 from handlers.text_handlers import text_router
 import oauthServer
+import oauth_flow
+from credential_store import CredentialStore
+from sharding import ShardRouter, consume, shard_of
+from state_backend import get_backend
+from conversation_store import close_checkpointer
+from STT import stt_engine
+from web_server import WebServer, UpdateQueue
+from tracing import metrics
+from turn_scheduler import turn_scheduler, llm_rate_limiter
+from gigachain_module import llm_metrics
+from intent_router import intent_router
+from tool_memo import tool_memo
+from calendar_mirror import calendar_mirror
+from calendars import calendar_directory
+from event_search import event_search
+from write_coalescer import write_coalescer
+from handlers.text_handlers import session_manager
+import calendar_push
+from calendar_push import push_channels
+from reminders import notification_sender, reminder_engine
+from config import (WEB_SERVER_HOST, WEB_SERVER_PORT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_WORKERS, BOT_WORKERS,
+                    REMINDERS_ENABLED)
 
 
-# Ставим сервер для доступа по URL (нужно для гуг-авторизации)
-def set_oauth_server():
-    oauthServer.start_flask_server()
-    oauthServer.set_bot(bot)
+_background = set()
 
 
-async def main():
-    set_oauth_server()
+def _keep(task: asyncio.Task):
+    """Держит ссылку на фоновую задачу, иначе сборщик мусора может удалить ее на ходу"""
+    _background.add(task)
+    task.add_done_callback(_background.discard)
 
-    # Запуск бота
+
+def build_dispatcher() -> Dispatcher:
+    # Пользователь всегда попадает в один процесс, поэтому FSM в памяти процесса достаточно
     dp = Dispatcher(storage=MemoryStorage())
     dp.include_router(command_router)
     dp.include_router(text_router)
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    return dp
+
+
+async def start_services(owns=None, shards: int = 1):
+    """Запускает то, что нужно для обработки обновлений (в воркере или единственном процессе)"""
+    # Лимиты ходов агента и частоты GigaChat заданы на весь бот и делятся между воркерами,
+    # как лимит отправки в Telegram; процессы распознавания тоже
+    turn_scheduler.share(shards)
+    llm_rate_limiter.share(shards)
+    stt_engine.share(shards)
+
+    # Процессы распознавания поднимаем до остальных потоков
+    stt_engine.start()
+    oauthServer.set_bot(bot)
+
+    # Фоновое обновление токенов Google
+    await oauthServer.credentials_store.load(owns)
+    _keep(oauthServer.credentials_store.start(notify=bot.send_message))
+
+    if REMINDERS_ENABLED:
+        start_reminders(shards)
+
+    # Счетчики компонентов попадают в /metrics как gauge
+    for name, component in [('stt', stt_engine), ('turn_scheduler', turn_scheduler),
+                            ('llm_rate_limiter', llm_rate_limiter), ('llm', llm_metrics),
+                            ('intent_router', intent_router), ('tool_memo', tool_memo),
+                            ('calendar_mirror', calendar_mirror), ('calendars', calendar_directory),
+                            ('event_search', event_search), ('write_coalescer', write_coalescer),
+                            ('sessions', session_manager), ('credentials', oauthServer.credentials_store),
+                            ('push_channels', push_channels), ('reminders', reminder_engine),
+                            ('notifications', notification_sender)]:
+        metrics.register(name, component.stats)
+
+
+def start_reminders(shards: int):
+    """Напоминания о встречах пользователей этого процесса и подписки на изменения их календарей"""
+    # Лимит Telegram общий на бота, поэтому делится между воркерами
+    _keep(notification_sender.start(bot, share=shards))
+    _keep(reminder_engine.start())
+
+    subscribe = None
+    if push_channels.enabled:
+        _keep(push_channels.start())
+        subscribe = push_channels.ensure
+    calendar_push.set_push_handler(reminder_engine.calendar_changed)
+
+    async def track_login(user_id):
+        await reminder_engine.track([user_id], subscribe)
+
+    oauthServer.add_login_listener(track_login)
+    _keep(asyncio.create_task(reminder_engine.track(list(oauthServer.credentials_store), subscribe)))
+
+
+async def stop_services():
+    await oauthServer.credentials_store.flush()
+    await oauth_flow.close()
+    await get_backend().close()
+    await close_checkpointer()
+
+
+async def worker(shard: int, shards: int, source):
+    # Копия календарей у каждого воркера своя, записи не ждут другие процессы
+    calendar_mirror.use_shard(shard)
+    await start_services(owns=lambda user_id: shard_of(user_id, shards) == shard, shards=shards)
+    updates = UpdateQueue(build_dispatcher(), bot)
+    updates.start()
+    metrics.register('updates', updates.stats)
+
+    # Метрики воркера на своем порту: следующие за портом главного процесса
+    server = WebServer(updates, callback=False)
+    await server.start(WEB_SERVER_HOST, WEB_SERVER_PORT + 1 + shard)
+    logging.info(f"Worker {shard + 1}/{shards} started")
+    try:
+        await consume(source, updates, oauthServer.complete_login, reminder_engine.calendar_changed)
+    finally:
+        await server.stop()
+        await updates.stop()
+        await stop_services()
+
+
+def run_worker(shard: int, shards: int, source):
+    """Точка входа процесса-воркера"""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(worker(shard, shards, source))
+    except KeyboardInterrupt:
+        pass
+
+
+async def poll(updates, allowed_updates):
+    """Long polling, раздающий сырые обновления по очередям"""
+    offset = None
+    while True:
+        try:
+            batch = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception:
+            logging.exception("Failed to get updates")
+            await asyncio.sleep(1)
+            continue
+
+        for update in batch:
+            data = update.model_dump(mode='json', by_alias=True, exclude_none=True)
+            # При long polling Telegram не повторит доставку, поэтому ждем места в очереди
+            while not updates.offer(data):
+                await asyncio.sleep(0.1)
+            offset = update.update_id + 1
+
+
+async def main():
+    await CredentialStore.migrate()
+
+    dp = build_dispatcher()
+    allowed_updates = dp.resolve_used_update_types()
+
+    processes = []
+    if BOT_WORKERS > 1:
+        # Этот процесс только принимает обновления, обрабатывают их воркеры
+        context = multiprocessing.get_context('spawn')
+        updates = ShardRouter(context, BOT_WORKERS)
+        # Воркеры не демоны: у них свои процессы распознавания речи
+        processes = [
+            context.Process(target=run_worker, args=(shard, BOT_WORKERS, updates.queues[shard]), name=f'bot-worker-{shard}')
+            for shard in range(BOT_WORKERS)
+        ]
+        for process in processes:
+            process.start()
+        oauthServer.set_login_handler(updates.forward_login)
+        calendar_push.set_push_handler(updates.forward_push)
+    else:
+        await start_services()
+        updates = UpdateQueue(dp, bot)
+        updates.start()
+
+    # Сервер для доступа по URL (нужен для гугл-авторизации и webhook)
+    server = WebServer(updates)
+    metrics.register('web_server', server.stats)
+    metrics.register('updates', updates.stats)
+    metrics.register('logins', oauthServer.active_flows.stats)
+    if WEBHOOK_URL:
+        server.enable_webhook(WEBHOOK_PATH)
+    await server.start(WEB_SERVER_HOST, WEB_SERVER_PORT)
+
+    # Запуск бота
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=server.secret,
+                allowed_updates=allowed_updates,
+                max_connections=min(WEBHOOK_WORKERS * BOT_WORKERS, 100)
+            )
+            await asyncio.Event().wait()
+        else:
+            # Если раньше работали через webhook, polling без его удаления не запустится
+            await bot.delete_webhook()
+            if processes:
+                await poll(updates, allowed_updates)
+            else:
+                await dp.start_polling(bot, allowed_updates=allowed_updates)
+    finally:
+        await server.stop()
+        if processes:
+            updates.stop()
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            await oauth_flow.close()
+            await get_backend().close()
+        else:
+            await updates.stop()
+            await stop_services()
 
 
 if __name__ == "__main__":
@@ -1,24 +1,25 @@
-from flask import Flask, request, redirect
-from threading import Thread
-import asyncio
+from aiohttp import web
 from aiogram import Bot
+import asyncio
 import logging
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from config import BOT_TOKEN
-import requests
-
-app = Flask(__name__)
+from google_services import invalidate as invalidate_services
+from calendar_mirror import calendar_mirror
+from calendars import calendar_directory
+from event_search import event_search
+from credential_store import CredentialStore
+from oauth_flow import LoginFlows, exchange_code, fetch_user_info
 
 # Настройка логгирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('oauthServer')
 
 # Глобальные переменные
-active_flows = {}
-credentials_store = {}
+active_flows = LoginFlows()
+credentials_store = CredentialStore()
 bot_instance = None
-loop = asyncio.new_event_loop()
+# Корутины listener(user_id), которые выполняются после успешной авторизации
+login_listeners = []
+_listener_tasks = set()
 
 
 def set_bot(bot: Bot):
@@ -26,120 +27,96 @@ def set_bot(bot: Bot):
     bot_instance = bot
 
 
-def credentials_to_dict(credentials):
-    return {
-        'token': credentials.token,
-        'refresh_token': credentials.refresh_token,
-        'token_uri': credentials.token_uri,
-        'client_id': credentials.client_id,
-        'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
-    }
-
-
-def get_user_info_sync(credentials):
-    """Синхронное получение информации о пользователе"""
-    credentials_obj = Credentials(
-        token=credentials['token'],
-        refresh_token=credentials['refresh_token'],
-        token_uri=credentials['token_uri'],
-        client_id=credentials['client_id'],
-        client_secret=credentials['client_secret'],
-        scopes=credentials['scopes']
-    )
+def add_login_listener(listener):
+    login_listeners.append(listener)
 
-    service = build('oauth2', 'v2', credentials=credentials_obj)
-    return service.userinfo().get().execute()
 
+async def complete_login(user_id, code, code_verifier):
+    """Обмен кода на токены и сохранение учетных данных.
 
-@app.route('/callback')
-def callback():
-    """Обработка OAuth callback от Google"""
+    Выполняется в процессе, за которым закреплен пользователь: только там
+    его учетные данные лежат в памяти и обновляются.
+    """
     try:
-        # Получаем состояния
-        state = request.args.get('state')
-        code = request.args.get('code')
-
-        # Лог колбека
-        logger.info(f"Received callback: state={state}, code={code}")
-
-        # Не получили статус или код
-        if not state or not code:
-            logger.error("Missing state or code parameters")
-            return "Ошибка: отсутствует state или code", 400
-
-        # Нет нужного состояния
-        if state not in active_flows:
-            logger.error(f"Invalid state parameter: {state}. Active states: {list(active_flows.keys())}")
-            return f"Неверный state параметр: {state}", 400
-
-        # получаем user_id
-        user_id, flow = active_flows[state]
-
         # Обмен кода на токены
-        flow.fetch_token(code=code)
-        credentials = flow.credentials
+        credentials = await exchange_code(code, code_verifier)
 
-        # Сохраняем учетные данные
-        credentials_dict = credentials_to_dict(credentials)
-        credentials_store[user_id] = credentials_dict
+        # Сохраняем учетные данные (в общее хранилище, в зашифрованном виде)
+        credentials_store[user_id] = credentials
+        invalidate_services(user_id)
+        calendar_mirror.forget(user_id)
+        calendar_directory.forget(user_id)
+        event_search.forget(user_id)
 
         # Уведомляем пользователя
-        user_info = get_user_info_sync(credentials_dict)
+        user_info = await fetch_user_info(credentials)
         logger.info(f"User info retrieved: {user_info}")
 
-        # Отправляем сообщение через бота (синхронно)
+        # Сервер работает в цикле событий бота, поэтому пишем через него же
         if bot_instance:
-            send_message_sync(user_id, f"✅ Авторизация успешна! Привет, {user_info['name']}!")
+            await bot_instance.send_message(user_id, f"✅ Авторизация успешна! Привет, {user_info['name']}!")
         else:
             logger.error("Bot instance not set")
 
-        return redirect("https://telegram.me/giga_secretary_bot")
-
     except Exception as e:
-        logger.exception("Exception in callback handler")
-        error_msg = f"Ошибка авторизации: {str(e)}"
+        logger.exception(f"Failed to complete login of {user_id}")
 
         # Попытка уведомить пользователя об ошибке
         try:
             if bot_instance:
-                state = request.args.get('state')
-                if state in active_flows:
-                    user_id, _ = active_flows[state]
-                    send_message_sync(user_id, error_msg)
+                await bot_instance.send_message(user_id, f"Ошибка авторизации: {str(e)}")
         except Exception as inner_e:
             logger.error(f"Failed to send error message: {str(inner_e)}")
+        raise
+
+    # Слушатели работают в фоне, чтобы не задерживать перенаправление пользователя
+    for listener in login_listeners:
+        task = asyncio.create_task(_run_listener(listener, user_id))
+        _listener_tasks.add(task)
+        task.add_done_callback(_listener_tasks.discard)
+
+
+async def _run_listener(listener, user_id):
+    try:
+        await listener(user_id)
+    except Exception:
+        logger.exception(f"Login listener failed for {user_id}")
 
-        return error_msg, 500
 
+# Куда передается завершение авторизации: при нескольких воркерах - воркеру пользователя
+login_handler = complete_login
 
-def send_message_sync(user_id, text):
-    """Синхронная отправка сообщения через Telegram API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {
-        'chat_id': user_id,
-        'text': text,
-        'parse_mode': 'HTML'
-    }
 
+def set_login_handler(handler):
+    global login_handler
+    login_handler = handler
+
+
+async def callback(request: web.Request):
+    """Обработка OAuth callback от Google"""
     try:
-        response = requests.post(url, json=payload, timeout=5)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Telegram API error: {str(e)}")
-        return None
+        # Получаем состояния
+        state = request.query.get('state')
+        code = request.query.get('code')
 
+        # Лог колбека
+        logger.info(f"Received callback: state={state}, code={code}")
+
+        # Не получили статус или код
+        if not state or not code:
+            logger.error("Missing state or code parameters")
+            return web.Response(text="Ошибка: отсутствует state или code", status=400)
 
-def run_flask_server():
-    """Запускает Flask сервер"""
-    app.run(port=8080, debug=False, use_reloader=False)
+        # Нет нужного состояния (или авторизация истекла, или state уже использован)
+        login = await active_flows.pop(state)
+        if login is None:
+            logger.error(f"Invalid state parameter: {state}")
+            return web.Response(text="Ссылка авторизации устарела, запросите новую: /login", status=400)
 
+        await login_handler(login.user_id, code, login.code_verifier)
 
-def start_flask_server():
-    """Запускает Flask в отдельном потоке"""
-    thread = Thread(target=run_flask_server)
-    thread.daemon = True
-    thread.start()
+    except Exception as e:
+        logger.exception("Exception in callback handler")
+        return web.Response(text=f"Ошибка авторизации: {str(e)}", status=500)
 
-    logger.info("Flask server started on http://localhost:8080/callback")
\ No newline at end of file
+    raise web.HTTPFound("https://telegram.me/giga_secretary_bot")
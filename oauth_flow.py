@@ -0,0 +1,155 @@
+import base64
+import datetime
+import hashlib
+import json
+import secrets
+from dataclasses import dataclass, asdict
+from urllib.parse import urlencode
+
+import aiohttp
+from google.oauth2.credentials import Credentials
+
+from config import CLIENT_SECRET_FILE, SCOPES, REDIRECT_URI, LOGIN_FLOW_TTL, GOOGLE_HTTP_TIMEOUT
+from state_backend import get_backend
+
+
+USERINFO_URI = 'https://www.googleapis.com/oauth2/v2/userinfo'
+
+_client_config = None
+_session = None
+
+
+def client_config() -> dict:
+    """Настройки OAuth-клиента из client_secret.json (файл читается один раз)"""
+    global _client_config
+    if _client_config is None:
+        with open(CLIENT_SECRET_FILE) as f:
+            config = json.load(f)
+        _client_config = config.get('web') or config['installed']
+    return _client_config
+
+
+def scopes() -> list:
+    return (SCOPES or '').replace(',', ' ').split()
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Общая сессия с пулом keep-alive соединений к Google (создается в цикле событий бота)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=GOOGLE_HTTP_TIMEOUT))
+    return _session
+
+
+async def close():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+@dataclass
+class PendingLogin:
+    """Начатая авторизация, ожидающая callback от Google"""
+    user_id: int
+    code_verifier: str
+
+
+class LoginFlows:
+    """Незавершенные авторизации по state в общем хранилище состояния.
+
+    Callback может прийти в любой процесс бота, поэтому авторизации лежат
+    не в памяти, а в хранилище с TTL. У пользователя одновременно живет
+    только последняя авторизация, так что их не больше, чем пользователей.
+    state одноразовый: callback забирает его через pop.
+    """
+
+    def __init__(self, ttl: float = LOGIN_FLOW_TTL):
+        self._ttl = ttl
+
+        # Метрики
+        self.started = 0
+        self.completed = 0
+
+    async def start(self, user_id: int) -> str:
+        """Начинает авторизацию пользователя и возвращает ссылку на страницу согласия Google"""
+        backend = get_backend()
+
+        previous = await backend.pop(f'login-user:{user_id}')
+        if previous is not None:
+            await backend.delete(f'login:{previous}')
+
+        state = secrets.token_urlsafe(24)
+        # PKCE: Google проверит, что код обменивает тот же, кто начал авторизацию
+        code_verifier = secrets.token_urlsafe(64)
+        challenge = base64.urlsafe_b64encode(hashlib.sha256(code_verifier.encode()).digest()).rstrip(b'=').decode()
+
+        login = PendingLogin(user_id=user_id, code_verifier=code_verifier)
+        await backend.set(f'login:{state}', json.dumps(asdict(login)), self._ttl)
+        await backend.set(f'login-user:{user_id}', state, self._ttl)
+        self.started += 1
+
+        config = client_config()
+        return config['auth_uri'] + '?' + urlencode({
+            'response_type': 'code',
+            'client_id': config['client_id'],
+            'redirect_uri': REDIRECT_URI,
+            'scope': ' '.join(scopes()),
+            'state': state,
+            'access_type': 'offline',
+            'prompt': 'consent',
+            'code_challenge': challenge,
+            'code_challenge_method': 'S256',
+        })
+
+    async def pop(self, state: str):
+        """Забирает авторизацию по state или возвращает None, если ее нет или она истекла"""
+        backend = get_backend()
+        data = await backend.pop(f'login:{state}')
+        if data is None:
+            return None
+
+        login = PendingLogin(**json.loads(data))
+        await backend.delete(f'login-user:{login.user_id}')
+        self.completed += 1
+        return login
+
+    def stats(self) -> dict:
+        return {
+            'started': self.started,
+            'completed': self.completed,
+        }
+
+
+async def exchange_code(code: str, code_verifier: str) -> Credentials:
+    """Обменивает код авторизации на токены"""
+    config = client_config()
+    async with http_session().post(config['token_uri'], data={
+        'grant_type': 'authorization_code',
+        'code': code,
+        'code_verifier': code_verifier,
+        'client_id': config['client_id'],
+        'client_secret': config['client_secret'],
+        'redirect_uri': REDIRECT_URI,
+    }) as response:
+        payload = await response.json(content_type=None)
+        if response.status != 200:
+            raise RuntimeError(payload.get('error_description') or payload.get('error') or f"HTTP {response.status}")
+
+    # google-auth хранит expiry как наивное время в UTC
+    expiry = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) \
+        + datetime.timedelta(seconds=payload.get('expires_in', 3600))
+    return Credentials(
+        token=payload['access_token'],
+        refresh_token=payload.get('refresh_token'),
+        token_uri=config['token_uri'],
+        client_id=config['client_id'],
+        client_secret=config['client_secret'],
+        scopes=payload.get('scope', ' '.join(scopes())).split(),
+        expiry=expiry
+    )
+
+
+async def fetch_user_info(credentials: Credentials) -> dict:
+    """Профиль пользователя Google по свежему токену доступа"""
+    async with http_session().get(USERINFO_URI, headers={'Authorization': f'Bearer {credentials.token}'}) as response:
+        response.raise_for_status()
+        return await response.json()
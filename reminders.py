@@ -0,0 +1,357 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+from dataclasses import dataclass
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from calendar_mirror import calendar_mirror, event_time
+from google_services import get_calendar_service
+from oauthServer import credentials_store
+from turn_scheduler import TokenBucket
+from config import (REMINDER_LEAD, REMINDER_HORIZON, TELEGRAM_SEND_RATE,
+                    TELEGRAM_CHAT_INTERVAL, TELEGRAM_SEND_QUEUE)
+
+
+logger = logging.getLogger('reminders')
+
+# Метка записи кучи, которая означает сверку ленты пользователя, а не напоминание
+REFILL = ''
+
+# Сколько лент собирается одновременно при старте
+TRACK_CONCURRENCY = 8
+
+
+class TelegramSender:
+    """Очередь исходящих уведомлений с ограничениями Telegram.
+
+    Не больше rate сообщений в секунду на бота и не чаще одного сообщения
+    в chat_interval секунд в один чат. На 429 ждет retry_after и повторяет,
+    пользователей, заблокировавших бота, пропускает.
+    """
+
+    def __init__(self, rate: float = TELEGRAM_SEND_RATE, chat_interval: float = TELEGRAM_CHAT_INTERVAL,
+                 queue_size: int = TELEGRAM_SEND_QUEUE):
+        self._rate = rate
+        self._chat_interval = chat_interval
+        self._queue_size = queue_size
+        self._queue = None
+        self._bucket = None
+        self._bot = None
+        self._last_sent = {}
+
+        # Метрики
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot, share: int = 1):
+        """share - на сколько процессов делится лимит бота"""
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._bucket = TokenBucket(self._rate / share, max(1, int(self._rate / share)))
+        return asyncio.create_task(self._run())
+
+    def send(self, chat_id: int, text: str) -> bool:
+        """Ставит сообщение в очередь, False - если очередь полна"""
+        try:
+            self._queue.put_nowait((chat_id, text))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Send queue is full, dropping message to {chat_id}")
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                await self._deliver(chat_id, text)
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Failed to send message to {chat_id}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, chat_id, text):
+        while True:
+            wait = self._last_sent.get(chat_id, 0) + self._chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id, text)
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота
+                self.dropped += 1
+                return
+            finally:
+                self._last_sent[chat_id] = time.monotonic()
+            self.sent += 1
+            self._prune()
+            return
+
+    def _prune(self):
+        if len(self._last_sent) > 10000:
+            now = time.monotonic()
+            self._last_sent = {chat_id: sent for chat_id, sent in self._last_sent.items()
+                               if now - sent < self._chat_interval}
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+
+@dataclass
+class Reminder:
+    fire_at: float
+    start_ts: float
+    summary: str
+    # Время начала в часовом поясе события, для текста
+    start_text: str
+    generation: int
+
+
+class ReminderEngine:
+    """Напоминания о ближайших встречах.
+
+    Для каждого пользователя держится лента событий на horizon секунд
+    вперед из локальной копии календаря. Лента пересобирается, когда
+    приходит уведомление об изменении календаря (тогда копия сначала
+    догоняется по syncToken), когда меняется сама копия (правки через бота)
+    и по плановой сверке раз в половину горизонта.
+    Все напоминания всех пользователей лежат в одной куче по времени
+    срабатывания, ее разбирает одна задача, а сообщения уходят через
+    TelegramSender. Запись кучи устаревает, если событие перенесли или
+    удалили: у напоминания в ленте меняется поколение.
+    """
+
+    def __init__(self, sender: TelegramSender, lead: float = REMINDER_LEAD, horizon: float = REMINDER_HORIZON):
+        self._sender = sender
+        self._lead = lead
+        self._horizon = horizon
+        # user_id -> {event_id: Reminder}
+        self._timelines = {}
+        # (время, user_id, event_id или REFILL, поколение)
+        self._heap = []
+        self._refills = {}
+        self._generation = 0
+        # (user_id, event_id) -> начало события, о котором уже напомнили
+        self._fired = {}
+        # Пересборки в работе и пользователи, чей календарь изменился за время пересборки
+        # (True - копию нужно догнать по Google, False - достаточно перечитать)
+        self._refreshing = {}
+        self._dirty = {}
+        # Пользователи, чью копию сейчас догоняет сама пересборка: ее изменения она прочитает сама
+        self._syncing = set()
+        self._tasks = set()
+        self._wakeup = None
+
+        # Метрики
+        self.fired = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        calendar_mirror.add_listener(self._mirror_changed)
+        return asyncio.create_task(self._run())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _push(self, at, user_id, event_id, generation):
+        heapq.heappush(self._heap, (at, user_id, event_id, generation))
+        if self._wakeup is not None and self._heap[0][3] == generation:
+            self._wakeup.set()
+
+    def _next_generation(self) -> int:
+        self._generation += 1
+        return self._generation
+
+    async def calendar_changed(self, user_id: int):
+        """Календарь изменился: догоняем копию и пересобираем ленту"""
+        await self.refresh(user_id, force=True)
+
+    def _mirror_changed(self, user_id: int):
+        # Копию изменил сам бот или синхронизация: Google уже не нужен, только перечитать ленту
+        if user_id in self._refills and user_id not in self._syncing:
+            self._spawn(self.refresh(user_id))
+
+    async def refresh(self, user_id: int, force: bool = False):
+        # Уведомления приходят пачками: одна пересборка за раз, и еще одна после нее, если успели прийти новые
+        running = self._refreshing.get(user_id)
+        if running is None:
+            running = self._refreshing[user_id] = asyncio.create_task(self._refresh_loop(user_id, force))
+        else:
+            self._dirty[user_id] = self._dirty.get(user_id, False) or force
+        # Отмена одного из ждущих не должна отменять общую пересборку
+        await asyncio.shield(running)
+
+    async def _refresh_loop(self, user_id, force):
+        try:
+            while True:
+                try:
+                    await self._refresh(user_id, force)
+                except Exception as e:
+                    self.refresh_failures += 1
+                    logger.warning(f"Failed to refresh timeline of {user_id}: {e}")
+                    self._schedule_refill(user_id, time.time() + self._lead)
+                    return
+                if user_id not in self._dirty:
+                    return
+                force = self._dirty.pop(user_id)
+        finally:
+            # Без await между проверкой _dirty и этим местом, так что изменение не потеряется
+            self._refreshing.pop(user_id, None)
+            self._dirty.pop(user_id, None)
+
+    async def _refresh(self, user_id, force):
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            self.forget(user_id)
+            return
+
+        service = get_calendar_service(user_id, creds_data)
+        now = time.time()
+        time_min = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+        self._syncing.add(user_id)
+        try:
+            if force:
+                await calendar_mirror.sync(user_id, service, force=True)
+            events = await calendar_mirror.events_between(
+                user_id, service, time_min, time_min + datetime.timedelta(seconds=self._horizon + self._lead))
+        finally:
+            self._syncing.discard(user_id)
+        self._rebuild(user_id, events, now)
+        self.refreshes += 1
+        self._schedule_refill(user_id, now + self._horizon / 2)
+
+    def _rebuild(self, user_id, events: list, now: float):
+        previous = self._timelines.get(user_id, {})
+        timeline = {}
+        for event in events:
+            # Для событий на весь день напоминание не нужно
+            if 'dateTime' not in event['start']:
+                continue
+            start_ts = event_time(event['start']).timestamp()
+            if start_ts <= now or self._fired.get((user_id, event['id'])) == start_ts:
+                continue
+
+            fire_at = max(now, start_ts - self._lead)
+            summary = event.get('summary', 'Без названия')
+            old = previous.get(event['id'])
+            if old is not None and old.start_ts == start_ts:
+                # Время не изменилось - старая запись кучи остается в силе
+                old.summary = summary
+                timeline[event['id']] = old
+                continue
+
+            start = datetime.datetime.fromisoformat(event['start']['dateTime'].replace('Z', '+00:00'))
+            reminder = Reminder(fire_at=fire_at, start_ts=start_ts, summary=summary,
+                                start_text=start.strftime('%H:%M'), generation=self._next_generation())
+            timeline[event['id']] = reminder
+            self._push(fire_at, user_id, event['id'], reminder.generation)
+
+        if timeline:
+            self._timelines[user_id] = timeline
+        else:
+            self._timelines.pop(user_id, None)
+        # Уже прошедшие события больше не нужны для защиты от повторов
+        for key in [key for key, start_ts in self._fired.items() if key[0] == user_id and start_ts <= now]:
+            del self._fired[key]
+
+    def _schedule_refill(self, user_id, at: float):
+        generation = self._next_generation()
+        self._refills[user_id] = generation
+        self._push(at, user_id, REFILL, generation)
+
+    def forget(self, user_id: int):
+        self._timelines.pop(user_id, None)
+        self._refills.pop(user_id, None)
+        for key in [key for key in self._fired if key[0] == user_id]:
+            del self._fired[key]
+
+    def _current(self, entry) -> bool:
+        _, user_id, event_id, generation = entry
+        if event_id == REFILL:
+            return self._refills.get(user_id) == generation
+        reminder = self._timelines.get(user_id, {}).get(event_id)
+        return reminder is not None and reminder.generation == generation
+
+    async def _run(self):
+        while True:
+            while self._heap and not self._current(self._heap[0]):
+                heapq.heappop(self._heap)
+            delay = self._heap[0][0] - time.time() if self._heap else None
+
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, user_id, event_id, _ = heapq.heappop(self._heap)
+            if event_id == REFILL:
+                self._spawn(self.refresh(user_id))
+            else:
+                self._fire(user_id, event_id)
+
+    def _fire(self, user_id, event_id):
+        timeline = self._timelines[user_id]
+        reminder = timeline.pop(event_id)
+        if not timeline:
+            del self._timelines[user_id]
+        self._fired[(user_id, event_id)] = reminder.start_ts
+        minutes = round((reminder.start_ts - time.time()) / 60)
+        if minutes > 0:
+            text = f"⏰ Через {minutes} мин ({reminder.start_text}): {reminder.summary}"
+        else:
+            text = f"⏰ Начинается ({reminder.start_text}): {reminder.summary}"
+        self._sender.send(user_id, text)
+        self.fired += 1
+
+    async def track(self, user_ids, subscribe=None):
+        """Сборка лент (и подписка на изменения) для пользователей процесса"""
+        slots = asyncio.Semaphore(TRACK_CONCURRENCY)
+
+        async def track_user(user_id):
+            async with slots:
+                try:
+                    if subscribe is not None:
+                        await subscribe(user_id)
+                    await self.refresh(user_id)
+                except Exception as e:
+                    logger.warning(f"Failed to start tracking calendar of {user_id}: {e}")
+
+        await asyncio.gather(*(track_user(user_id) for user_id in user_ids))
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._timelines),
+            'pending': sum(len(timeline) for timeline in self._timelines.values()),
+            'heap': len(self._heap),
+            'fired': self.fired,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures,
+        }
+
+
+notification_sender = TelegramSender()
+reminder_engine = ReminderEngine(notification_sender)
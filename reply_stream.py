@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import TELEGRAM_EDIT_INTERVAL
+
+
+logger = logging.getLogger('replyStream')
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+TOOL_STATUSES = {
+    'view_google_events': "📅 Смотрю календарь…",
+    'find_google_event': "🔎 Ищу событие…",
+    'find_free_slots': "🔎 Ищу свободное время…",
+    'create_google_event': "✍️ Создаю событие…",
+    'update_google_event': "✍️ Обновляю событие…",
+    'delete_google_event': "🗑 Удаляю событие…",
+    'bulk_create_google_events': "✍️ Создаю события…",
+    'bulk_update_google_events': "✍️ Обновляю события…",
+    'bulk_delete_google_events': "🗑 Удаляю события…",
+}
+
+
+class StreamingReply:
+    """Один ответ бота, который редактируется по мере готовности текста.
+
+    Правки не чаще одной в TELEGRAM_EDIT_INTERVAL секунд: промежуточные
+    изменения копятся и уходят одной правкой, последнее состояние
+    отправляется гарантированно.
+    """
+
+    def __init__(self, message: types.Message, interval: float = TELEGRAM_EDIT_INTERVAL):
+        self._message = message
+        self._interval = interval
+        self._reply = None
+        self._shown = None
+        self._pending = None
+        self._last_edit = 0.0
+        self._flush_task = None
+        self._editing = False
+        self._finished = False
+        self._text = ''
+        self._status = None
+
+    async def start(self, status: str = "⏳ Думаю…"):
+        self._status = status
+        self._reply = await self._message.answer(status)
+        self._shown = status
+        self._last_edit = time.monotonic()
+
+    def tool(self, name: str):
+        # Статус показывается, пока модель не начала писать ответ
+        self._status = TOOL_STATUSES.get(name, "⚙️ Работаю…")
+        self._text = ''
+        self._update()
+
+    def token(self, text: str):
+        self._text += text
+        self._update()
+
+    def reset(self):
+        # Текст шага с вызовом инструмента - это не ответ пользователю
+        self._text = ''
+        self._update()
+
+    def _render(self) -> str:
+        if not self._text:
+            return self._status
+        text = self._text + " ▌"
+        if len(text) > MESSAGE_LIMIT:
+            text = text[:MESSAGE_LIMIT - 1] + "…"
+        return text
+
+    def _update(self):
+        self._pending = self._render()
+        if self._flush_task is None and not self._finished:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            # Пока идет правка, текст может измениться - тогда после паузы отправляем и его
+            while not self._finished:
+                text = self._pending
+                delay = self._last_edit + self._interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    text = self._pending
+                self._editing = True
+                try:
+                    await self._edit(text)
+                finally:
+                    self._editing = False
+                if self._pending == text:
+                    break
+        finally:
+            self._flush_task = None
+
+    async def _edit(self, text: str):
+        if not text or text == self._shown:
+            return
+        self._last_edit = time.monotonic()
+        try:
+            await self._reply.edit_text(text)
+            self._shown = text
+        except TelegramRetryAfter as e:
+            # Упираемся в лимит правок - просто пропускаем промежуточное состояние
+            self._last_edit = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            logger.debug(f"Edit skipped: {e}")
+
+    async def _deliver(self, text: str):
+        """Итоговая правка: при лимите ждем и повторяем, если не вышло - отправляем новым сообщением"""
+        for attempt in range(2):
+            try:
+                await self._reply.edit_text(text)
+                self._shown = text
+                return
+            except TelegramRetryAfter as e:
+                if attempt == 0:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                logger.warning(f"Final edit is still rate limited: {e}")
+            except TelegramBadRequest as e:
+                logger.warning(f"Final edit failed: {e}")
+            break
+        await self._message.answer(text)
+
+    async def finish(self, text: str):
+        """Показывает итоговый ответ, длинный разбивается на несколько сообщений"""
+        self._finished = True
+        task = self._flush_task
+        if task is not None:
+            # Ожидание паузы прерываем, а начатую правку дожидаемся, чтобы она не легла поверх ответа
+            if not self._editing:
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        text = text or "…"
+        chunks = [text[i:i + MESSAGE_LIMIT] for i in range(0, len(text), MESSAGE_LIMIT)]
+
+        # Итоговая правка важнее лимита, поэтому ждем, если нужно
+        delay = self._last_edit + self._interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if chunks[0] != self._shown:
+            await self._deliver(chunks[0])
+        for chunk in chunks[1:]:
+            await self._message.answer(chunk)
@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from config import AGENT_SESSIONS_MAX, AGENT_SESSION_TTL
+
+
+@dataclass
+class AgentSession:
+    """Скомпилированный агент пользователя вместе с его инструментами"""
+    agent: object
+    tools: list
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class SessionManager:
+    """LRU-кеш агентов по user_id с вытеснением по времени простоя"""
+
+    def __init__(self, factory, max_sessions: int = AGENT_SESSIONS_MAX, ttl: float = AGENT_SESSION_TTL):
+        # factory(user_id) -> AgentSession
+        self._factory = factory
+        self._max_sessions = max_sessions
+        self._ttl = ttl
+        self._sessions: OrderedDict[int, AgentSession] = OrderedDict()
+
+        # Счетчики для подбора размеров кеша
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, user_id: int) -> AgentSession:
+        """Возвращает сессию пользователя, при необходимости создавая новую"""
+        now = time.monotonic()
+        self._expire(now)
+
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self.hits += 1
+            self._sessions.move_to_end(user_id)
+        else:
+            self.misses += 1
+            session = self._factory(user_id)
+            self._sessions[user_id] = session
+            self._evict()
+
+        session.last_used = now
+        return session
+
+    def invalidate(self, user_id: int):
+        """Сбрасывает сессию (например, после повторной авторизации)"""
+        self._sessions.pop(user_id, None)
+
+    def clear(self):
+        self._sessions.clear()
+
+    def _expire(self, now: float):
+        # Самые давно использованные сессии лежат в начале словаря
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used < self._ttl:
+                break
+            del self._sessions[user_id]
+            self.expirations += 1
+
+    def _evict(self):
+        while len(self._sessions) > self._max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._sessions),
+            'max_sessions': self._max_sessions,
+            'ttl': self._ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
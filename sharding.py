@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import queue
+
+from config import SHARD_QUEUE_SIZE
+
+
+logger = logging.getLogger('sharding')
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    """Номер воркера для пользователя (jump consistent hash).
+
+    При изменении числа воркеров с N на N+1 переезжает только 1/(N+1)
+    пользователей, остальные остаются на своих воркерах вместе с кешами.
+    """
+    key = user_id & 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < shards:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def update_user_id(data: dict) -> int:
+    """Автор обновления Telegram из сырого JSON, без разбора всего обновления"""
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user')
+        if sender:
+            return sender['id']
+        chat = value.get('chat') or value.get('message', {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+class ShardRouter:
+    """Раздает обновления воркерам так, что один пользователь всегда попадает на один воркер.
+
+    Все, что хранится в памяти воркера (агенты, кеши, очередь правок),
+    поэтому остается согласованным без общего хранилища.
+    """
+
+    def __init__(self, context, shards: int, queue_size: int = SHARD_QUEUE_SIZE):
+        self.shards = shards
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(shards)]
+
+        # Метрики
+        self.routed = [0] * shards
+        self.shed = 0
+
+    def offer(self, data: dict) -> bool:
+        """Отдает обновление воркеру пользователя, False - если его очередь полна"""
+        shard = shard_of(update_user_id(data), self.shards)
+        try:
+            self.queues[shard].put_nowait(('update', data))
+        except queue.Full:
+            self.shed += 1
+            return False
+        self.routed[shard] += 1
+        return True
+
+    async def forward_login(self, user_id: int, code: str, code_verifier: str):
+        """Завершение авторизации выполняет воркер пользователя: учетные данные живут у него"""
+        item = ('login', {'user_id': user_id, 'code': code, 'code_verifier': code_verifier})
+        target = self.queues[shard_of(user_id, self.shards)]
+        await asyncio.get_running_loop().run_in_executor(None, target.put, item)
+
+    async def forward_push(self, user_id: int):
+        """Изменение календаря обрабатывает воркер пользователя: лента напоминаний живет у него"""
+        target = self.queues[shard_of(user_id, self.shards)]
+        await asyncio.get_running_loop().run_in_executor(None, target.put, ('push', {'user_id': user_id}))
+
+    def stop(self):
+        for target in self.queues:
+            try:
+                target.put(None, timeout=1)
+            except queue.Full:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'shards': self.shards,
+            'routed': list(self.routed),
+            'shed': self.shed,
+            'queued': [target.qsize() for target in self.queues],
+        }
+
+
+async def consume(source, updates, complete_login, calendar_changed):
+    """Цикл воркера: читает свою очередь и обрабатывает обновления, авторизации и изменения календарей"""
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def login(payload):
+        try:
+            await complete_login(**payload)
+        except Exception:
+            # complete_login уже записал ошибку в лог и сообщил пользователю
+            pass
+
+    def spawn(coro):
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    while True:
+        item = await loop.run_in_executor(None, source.get)
+        if item is None:
+            break
+
+        kind, payload = item
+        if kind == 'update':
+            await updates.put(payload)
+        elif kind == 'login':
+            spawn(login(payload))
+        elif kind == 'push':
+            spawn(calendar_changed(**payload))
@@ -0,0 +1,193 @@
+import abc
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from config import STATE_BACKEND_URL, SQLITE_BUSY_TIMEOUT
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires_at) WHERE expires_at IS NOT NULL;
+'''
+
+# Как часто встроенное хранилище вычищает истекшие ключи
+PURGE_INTERVAL = 60
+
+
+def sqlite_pragmas(busy_timeout: float = SQLITE_BUSY_TIMEOUT) -> str:
+    """Настройки соединения с файлом SQLite, который открывают несколько воркеров.
+
+    В режиме WAL чтение не ждет запись, а busy_timeout заставляет ждать
+    чужую запись вместо немедленной ошибки "database is locked".
+    """
+    return f'PRAGMA journal_mode=WAL; PRAGMA busy_timeout={int(busy_timeout * 1000)};'
+
+
+class StateBackend(abc.ABC):
+    """Общее для всех процессов бота хранилище ключ-значение.
+
+    Значения - строки, ttl в секундах (None - без срока). pop атомарен:
+    если два процесса забирают один ключ, значение получит только один.
+    """
+
+    @abc.abstractmethod
+    async def get(self, key: str):
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: str, ttl: float = None):
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abc.abstractmethod
+    async def pop(self, key: str):
+        ...
+
+    @abc.abstractmethod
+    async def scan(self, prefix: str) -> list:
+        """Все пары (ключ, значение) с ключами, начинающимися на prefix"""
+        ...
+
+    async def close(self):
+        pass
+
+
+class SqliteBackend(StateBackend):
+    """Встроенное хранилище в файле SQLite, общее для процессов на одной машине"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._db.executescript(sqlite_pragmas())
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    async def _call(self, func, *args):
+        # Файл могут держать другие процессы, поэтому ждем блокировку не в цикле событий
+        return await asyncio.to_thread(self._locked, func, *args)
+
+    def _locked(self, func, *args):
+        with self._lock:
+            return func(*args)
+
+    def _get(self, key):
+        row = self._db.execute(
+            'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        self._db.execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, value, now + ttl if ttl is not None else None)
+        )
+        if now - self._purged_at > PURGE_INTERVAL:
+            self._purged_at = now
+            self._db.execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+
+    def _delete(self, key):
+        self._db.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def _pop(self, key):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            value = self._get(key)
+            self._delete(key)
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+        return value
+
+    def _scan(self, prefix):
+        return self._db.execute(
+            'SELECT key, value FROM kv WHERE key >= ? AND key < ? AND (expires_at IS NULL OR expires_at > ?)',
+            (prefix, prefix + '\uffff', time.time())
+        ).fetchall()
+
+    async def get(self, key):
+        return await self._call(self._get, key)
+
+    async def set(self, key, value, ttl=None):
+        await self._call(self._set, key, value, ttl)
+
+    async def delete(self, key):
+        await self._call(self._delete, key)
+
+    async def pop(self, key):
+        return await self._call(self._pop, key)
+
+    async def scan(self, prefix):
+        return await self._call(self._scan, prefix)
+
+    async def close(self):
+        await self._call(self._db.close)
+
+
+class RedisBackend(StateBackend):
+    """Сетевое хранилище в Redis, общее для процессов на разных машинах"""
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key):
+        return await self._redis.get(key)
+
+    async def set(self, key, value, ttl=None):
+        # Redis принимает срок в целых миллисекундах
+        await self._redis.set(key, value, px=int(ttl * 1000) if ttl is not None else None)
+
+    async def delete(self, key):
+        await self._redis.delete(key)
+
+    async def pop(self, key):
+        return await self._redis.getdel(key)
+
+    async def scan(self, prefix):
+        keys = [key async for key in self._redis.scan_iter(match=prefix + '*', count=1000)]
+        if not keys:
+            return []
+        values = await self._redis.mget(keys)
+        return [(key, value) for key, value in zip(keys, values) if value is not None]
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def create_backend(url: str) -> StateBackend:
+    """Хранилище по адресу: sqlite:///path/to/file.sqlite3 или redis://host:port/db"""
+    scheme = urlparse(url).scheme
+    if scheme == 'sqlite':
+        return SqliteBackend(url[len('sqlite:///'):])
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+    raise ValueError(f"Неизвестное хранилище состояния: {url}")
+
+
+_backend = None
+
+
+def get_backend() -> StateBackend:
+    """Общее хранилище состояния процесса (адрес берется из STATE_BACKEND_URL)"""
+    global _backend
+    if _backend is None:
+        _backend = create_backend(STATE_BACKEND_URL)
+    return _backend
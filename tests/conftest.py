@@ -0,0 +1,33 @@
+import atexit
+import base64
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# Модули бота лежат в корне репозитория и импортируются по имени
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Хранилища создаются при импорте модулей, поэтому до импорта уводим их во временный каталог
+_workdir = tempfile.mkdtemp(prefix='bot-tests-')
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ.setdefault('CREDENTIALS_KEY', base64.urlsafe_b64encode(b'0' * 32).decode())
+os.environ.setdefault('STATE_BACKEND_URL', f'sqlite:///{_workdir}/state.sqlite3')
+os.environ.setdefault('CREDENTIALS_DB_PATH', f'{_workdir}/credentials.sqlite3')
+os.environ.setdefault('CALENDAR_MIRROR_PATH', f'{_workdir}/calendar_mirror.sqlite3')
+os.environ.setdefault('CONVERSATIONS_DB_PATH', f'{_workdir}/conversations.sqlite3')
+
+
+@pytest.fixture
+def mirror(request, tmp_path, monkeypatch):
+    """Отдельная копия календарей для теста, подставленная в calendars"""
+    import calendars
+    from calendar_mirror import CalendarMirror
+
+    # Окно копии короче истории календаря, чтобы начало интервала дочитывалось из Google
+    mirror = CalendarMirror(str(tmp_path / 'mirror.sqlite3'), days_back=5)
+    monkeypatch.setattr(calendars, 'calendar_mirror', mirror)
+    calendars.calendar_directory.forget(request.module.USER_ID)
+    return mirror
@@ -0,0 +1,93 @@
+import asyncio
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import calendars
+from benchmarks.fakes import FakeCalendar
+from calendar_mirror import event_time
+
+
+USER_ID = 100000
+
+
+def interval(days_back, days_ahead):
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - datetime.timedelta(days=days_back), today + datetime.timedelta(days=days_ahead)
+
+
+async def all_pages(service, time_min, time_max, limit):
+    pages = []
+    cursor = None
+    while True:
+        events, total, offset, cursor = await calendars.events_page(USER_ID, service, time_min, time_max, limit, cursor)
+        pages.append((events, total, offset))
+        if cursor is None:
+            return pages
+
+
+def test_pages_match_merged_events(mirror):
+    service = FakeCalendar(latency=0, calendars=3).service(USER_ID)
+    time_min, time_max = interval(10, 10)
+
+    async def main():
+        pages = await all_pages(service, time_min, time_max, limit=7)
+        merged = [event async for event in calendars.merged_events(USER_ID, service, time_min, time_max)]
+        return pages, merged
+
+    pages, merged = asyncio.run(main())
+    shown = [(event['calendarId'], event['id']) for events, _, _ in pages for event in events]
+    assert shown == [(event['calendarId'], event['id']) for event in merged]
+    assert len(pages) > 2
+    # Часть событий старше окна копии и пришла из Google
+    assert any(event_time(event['end']).timestamp() <= mirror.window_start() for event in merged)
+
+    seen = 0
+    for events, total, offset in pages:
+        assert total == len(merged)
+        assert offset == seen
+        assert 0 < len(events) <= 7
+        seen += len(events)
+
+
+def test_page_is_read_with_limit(mirror):
+    service = FakeCalendar(latency=0, calendars=2).service(USER_ID)
+    time_min, time_max = interval(0, 30)
+
+    events, total, offset, cursor = asyncio.run(calendars.events_page(USER_ID, service, time_min, time_max, 5))
+    assert len(events) == 5
+    assert total > 5
+    assert offset == 0
+    assert cursor is not None
+
+
+def test_event_shared_between_calendars_is_shown_once(mirror):
+    calendar = FakeCalendar(latency=0, calendars=2)
+    service = calendar.service(USER_ID)
+    time_min, time_max = interval(0, 1)
+    start = time_min + datetime.timedelta(hours=5)
+    shared = {'id': 'shared', 'summary': 'Общая встреча',
+              'start': {'dateTime': start.isoformat()},
+              'end': {'dateTime': (start + datetime.timedelta(hours=1)).isoformat()}}
+
+    async def main():
+        calendar_ids = await calendars.calendar_directory.selected(USER_ID, service)
+        await calendars.sync_all(USER_ID, service, calendar_ids)
+        for calendar_id in reversed(calendar_ids):
+            mirror.upsert(USER_ID, shared, calendar_id)
+        return await calendars.events_page(USER_ID, service, time_min, time_max, 100)
+
+    events, total, _, _ = asyncio.run(main())
+    copies = [event for event in events if event['id'] == 'shared']
+    assert len(copies) == 1
+    assert copies[0]['calendarId'] == 'primary'
+    assert total == len(events)
+
+
+def test_timezone_of_primary_calendar():
+    directory = calendars.CalendarDirectory()
+    service = FakeCalendar(latency=0, calendars=2).service(USER_ID)
+    assert asyncio.run(directory.timezone(USER_ID, service)) == ZoneInfo('Europe/Moscow')
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import calendar_push
+from benchmarks.fakes import FakeCalendar, FakePushSource, TZ
+
+
+USER_ID = 200001
+
+
+@pytest.fixture
+def calendar(monkeypatch):
+    calendar = FakeCalendar(latency=0, days_back=0, days_ahead=0)
+    monkeypatch.setattr(calendar_push, 'credentials_store', {USER_ID: {'token': 'test'}})
+    monkeypatch.setattr(calendar_push, 'get_calendar_service', lambda user_id, creds_data: calendar.service(user_id))
+    return calendar
+
+
+def test_channel_is_renewed_before_expiration(calendar):
+    # Канал живет 2 секунды и продлевается за 1.5 секунды до истечения
+    channels = calendar_push.PushChannels(address='https://bot.example.com/push', ttl=2, margin=1.5)
+
+    async def main():
+        renewer = channels.start()
+        await channels.subscribe(USER_ID)
+        first = await channels._channel_of(USER_ID)
+        await asyncio.sleep(1)
+        renewer.cancel()
+        await asyncio.gather(*channels._tasks)
+        renewed = await channels._channel_of(USER_ID)
+        return first, renewed, await channels.lookup(first['id'], first['token']), \
+            await channels.lookup(renewed['id'], renewed['token'])
+
+    first, renewed, old_user, new_user = asyncio.run(main())
+    assert channels.subscribed == 1
+    assert channels.renewed >= 1
+    assert renewed['id'] != first['id']
+    assert renewed['expiration'] > first['expiration']
+    # Старый канал остановлен и в Google, и в хранилище
+    assert first['id'] not in calendar.channels
+    assert list(calendar.channels) == [renewed['id']]
+    assert old_user is None
+    assert new_user == USER_ID
+
+
+def test_change_is_delivered_to_push_handler(calendar, monkeypatch):
+    channels = calendar_push.PushChannels(address='https://bot.example.com/push', ttl=3600, margin=60)
+    monkeypatch.setattr(calendar_push, 'push_channels', channels)
+    changed = []
+
+    async def handler(user_id):
+        changed.append(user_id)
+
+    monkeypatch.setattr(calendar_push, 'push_handler', handler)
+
+    async def main():
+        source = FakePushSource(calendar, calendar_push.deliver)
+        await channels.subscribe(USER_ID)
+        start = datetime.datetime.now(TZ) + datetime.timedelta(hours=1)
+        calendar.change(USER_ID, {'summary': 'Созвон',
+                                  'start': {'dateTime': start.isoformat()},
+                                  'end': {'dateTime': (start + datetime.timedelta(minutes=30)).isoformat()}})
+        await asyncio.sleep(0.1)
+        return source.statuses
+
+    statuses = asyncio.run(main())
+    # Первое уведомление - sync при создании канала, второе - об изменении
+    assert statuses == [200, 200]
+    assert changed == [USER_ID]
+    assert channels.notifications == 1
+
+
+def test_push_with_wrong_token_is_rejected(calendar, monkeypatch):
+    channels = calendar_push.PushChannels(address='https://bot.example.com/push', ttl=3600, margin=60)
+    monkeypatch.setattr(calendar_push, 'push_channels', channels)
+
+    async def main():
+        await channels.subscribe(USER_ID)
+        channel = await channels._channel_of(USER_ID)
+        return await calendar_push.deliver({
+            'X-Goog-Channel-ID': channel['id'],
+            'X-Goog-Channel-Token': 'wrong',
+            'X-Goog-Resource-State': 'exists',
+        })
+
+    assert asyncio.run(main()) == 404
+    assert channels.unknown == 1
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('langgraph.checkpoint.sqlite')
+
+import aiosqlite
+from conversation_store import BoundedSqliteSaver
+from langgraph.checkpoint.base import empty_checkpoint
+
+
+async def save_checkpoints(saver, thread_id, count):
+    """Пишет count чекпоинтов диалога, у каждого по одной промежуточной записи"""
+    ids = []
+    for step in range(count):
+        checkpoint = empty_checkpoint()
+        config = {'configurable': {'thread_id': thread_id, 'checkpoint_ns': ''}}
+        saved = await saver.aput(config, checkpoint, {'step': step}, {})
+        await saver.aput_writes(saved, [('messages', step)], task_id=f'task_{step}')
+        ids.append(checkpoint['id'])
+    return ids
+
+
+async def stored_ids(saver, table, thread_id):
+    async with saver.conn.execute(f'SELECT DISTINCT checkpoint_id FROM {table} WHERE thread_id = ?',
+                                  (thread_id,)) as cursor:
+        return sorted(row[0] for row in await cursor.fetchall())
+
+
+def test_prune_keeps_last_checkpoints_of_thread(tmp_path):
+    async def main():
+        saver = BoundedSqliteSaver(aiosqlite.connect(str(tmp_path / 'conversations.sqlite3')), max_checkpoints=2)
+        async with saver.conn:
+            ids = await save_checkpoints(saver, '1', 5)
+            other = await save_checkpoints(saver, '2', 3)
+            await saver.prune(1)
+            return (ids, other, await stored_ids(saver, 'checkpoints', '1'), await stored_ids(saver, 'writes', '1'),
+                    await stored_ids(saver, 'checkpoints', '2'),
+                    (await saver.aget_tuple({'configurable': {'thread_id': '1'}})).checkpoint['id'])
+
+    ids, other, checkpoints, writes, other_checkpoints, latest = asyncio.run(main())
+    assert checkpoints == sorted(ids[-2:])
+    assert writes == sorted(ids[-2:])
+    # Чужие диалоги не трогаются, а последний чекпоинт по-прежнему читается
+    assert other_checkpoints == sorted(other)
+    assert latest == ids[-1]
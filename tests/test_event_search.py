@@ -0,0 +1,40 @@
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from benchmarks.fakes import FakeCalendar, TZ
+from event_search import EventSearch
+
+
+USER_ID = 200003
+
+
+def test_index_is_bounded_and_far_events_are_still_found(mirror):
+    calendar = FakeCalendar(latency=0, days_back=0, days_ahead=0, calendars=2)
+    service = calendar.service(USER_ID)
+    now = datetime.datetime.now(TZ)
+    for days, summary in [(-20, 'Ретро'), (3, 'Ретро'), (100, 'Ретро')]:
+        start = now + datetime.timedelta(days=days)
+        calendar.change(USER_ID, {'summary': summary, 'start': {'dateTime': start.isoformat()},
+                                  'end': {'dateTime': (start + datetime.timedelta(hours=1)).isoformat()}})
+    search = EventSearch(mirror, days_ahead=30)
+
+    async def main():
+        near = await search.search(USER_ID, service, 'ретро')
+        far = await search.search(USER_ID, service, 'ретро', time_min=now + datetime.timedelta(days=50),
+                                  time_max=now + datetime.timedelta(days=150))
+        old = await search.search(USER_ID, service, 'ретро', time_min=now - datetime.timedelta(days=30),
+                                  time_max=now - datetime.timedelta(days=10))
+        return near, far, old
+
+    near, far, old = asyncio.run(main())
+    # В индексе только окно копии и 30 дней вперед
+    assert search.stats()['events'] == 1
+    assert len(near) == 1
+    assert len(far) == 1 and far[0][0]['id'] != near[0][0]['id']
+    assert len(old) == 1
+    assert search.stats()['outside'] == 2
+    assert search.stats()['builds'] == 1
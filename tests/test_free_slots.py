@@ -0,0 +1,93 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+import free_slots
+
+
+MOSCOW = ZoneInfo('Europe/Moscow')
+BERLIN = ZoneInfo('Europe/Berlin')
+HOUR = 3600
+
+
+def moment(tz, day, hour, minute=0) -> float:
+    return datetime.datetime(2026, 3, day, hour, minute, tzinfo=tz).timestamp()
+
+
+def test_merge_intervals_joins_overlapping_and_touching():
+    starts = [50, 0, 10, 30, 100]
+    ends = [60, 10, 20, 40, 110]
+    merged_starts, merged_ends = free_slots.merge_intervals(starts, ends)
+    assert list(zip(merged_starts, merged_ends)) == [(0, 20), (30, 40), (50, 60), (100, 110)]
+
+
+def test_merge_intervals_keeps_longest_end():
+    merged_starts, merged_ends = free_slots.merge_intervals([0, 5], [100, 10])
+    assert list(zip(merged_starts, merged_ends)) == [(0, 100)]
+
+
+def test_merge_intervals_applies_buffer():
+    # Перерыв 5 секунд с обеих сторон склеивает встречи с зазором 10 секунд
+    merged_starts, merged_ends = free_slots.merge_intervals([0, 30, 70], [20, 40, 80], buffer=5)
+    assert list(zip(merged_starts, merged_ends)) == [(-5, 45), (65, 85)]
+
+
+def test_merge_intervals_empty():
+    merged_starts, merged_ends = free_slots.merge_intervals([], [])
+    assert len(merged_starts) == len(merged_ends) == 0
+
+
+def test_subtract_busy_from_windows():
+    windows = [(0, 100), (200, 300)]
+    free = free_slots.subtract(windows, [-10, 40, 90, 250], [10, 60, 210, 260])
+    assert free == [(10, 40), (60, 90), (210, 250), (260, 300)]
+
+
+def test_subtract_without_busy_returns_windows():
+    assert free_slots.subtract([(0, 100)], [], []) == [(0, 100)]
+
+
+def test_subtract_fully_busy_window():
+    assert free_slots.subtract([(10, 20)], [0], [30]) == []
+
+
+def test_rank_slots_aligns_to_step():
+    free = [(moment(MOSCOW, 2, 9, 10), moment(MOSCOW, 2, 12))]
+    start, end, free_until = free_slots.rank_slots(free, HOUR, MOSCOW)[0]
+    assert start == moment(MOSCOW, 2, 9, 30)
+    assert end == moment(MOSCOW, 2, 10, 30)
+    assert free_until == moment(MOSCOW, 2, 12)
+
+
+def test_rank_slots_skips_short_gaps_and_limits_per_day():
+    free = [
+        (moment(MOSCOW, 2, 9), moment(MOSCOW, 2, 9, 45)),
+        (moment(MOSCOW, 2, 10), moment(MOSCOW, 2, 11)),
+        (moment(MOSCOW, 2, 12), moment(MOSCOW, 2, 13)),
+        (moment(MOSCOW, 2, 14), moment(MOSCOW, 2, 15)),
+        (moment(MOSCOW, 3, 9), moment(MOSCOW, 3, 10)),
+    ]
+    slots = free_slots.rank_slots(free, HOUR, MOSCOW, per_day=2)
+    assert [start for start, _, _ in slots] == [moment(MOSCOW, 2, 10), moment(MOSCOW, 2, 12), moment(MOSCOW, 3, 9)]
+
+
+def test_rank_slots_limit():
+    free = [(moment(MOSCOW, day, 9), moment(MOSCOW, day, 19)) for day in range(2, 12)]
+    assert len(free_slots.rank_slots(free, HOUR, MOSCOW, limit=3)) == 3
+
+
+def test_working_hours_follow_daylight_saving():
+    # В Берлине 29 марта 2026 переводят часы: рабочий день начинается в 9:00 по местному времени до и после
+    windows = free_slots.working_windows(datetime.date(2026, 3, 27), datetime.date(2026, 3, 30), BERLIN, 9, 19,
+                                         weekends=True)
+    starts = [datetime.datetime.fromtimestamp(start, BERLIN) for start, _ in windows]
+    ends = [datetime.datetime.fromtimestamp(end, BERLIN) for _, end in windows]
+    assert [(start.hour, end.hour) for start, end in zip(starts, ends)] == [(9, 19)] * 4
+    assert starts[0].utcoffset() != starts[-1].utcoffset()
+
+
+def test_find_free_slots_in_user_timezone():
+    busy = [(moment(MOSCOW, 2, 9), moment(MOSCOW, 2, 10, 30))]
+    slots = free_slots.find_free_slots(busy, datetime.date(2026, 3, 2), datetime.date(2026, 3, 2), HOUR, MOSCOW)
+    first = datetime.datetime.fromtimestamp(slots[0][0], MOSCOW)
+    assert (first.hour, first.minute) == (10, 30)
+    assert datetime.datetime.fromtimestamp(slots[0][2], MOSCOW).hour == 19
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('langgraph')
+
+import history
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from turn_scheduler import TokenBucket
+
+
+class SummaryModel:
+    """Отвечает на запрос сводки фиксированным текстом и запоминает, что ей передали"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def ainvoke(self, messages):
+        self.requests.append(messages)
+        return AIMessage(content='Сводка')
+
+
+@pytest.fixture(autouse=True)
+def limiter(monkeypatch):
+    monkeypatch.setattr(history, 'llm_rate_limiter', TokenBucket(rate=1000, burst=1000))
+
+
+def turn(index, tool_output='ok'):
+    """Ход агента: запрос, вызов инструмента, его результат и ответ"""
+    call_id = f'call_{index}'
+    return [
+        HumanMessage(content=f'Запрос {index}', id=f'human_{index}'),
+        AIMessage(content='', tool_calls=[{'name': 'get_events', 'args': {}, 'id': call_id}], id=f'call_ai_{index}'),
+        ToolMessage(content=tool_output, tool_call_id=call_id, name='get_events', id=f'tool_{index}'),
+        AIMessage(content=f'Ответ {index}', id=f'answer_{index}'),
+    ]
+
+
+def test_short_history_is_left_as_is():
+    model = SummaryModel()
+    messages = turn(1) + turn(2)
+    assert asyncio.run(history.compact(model, messages, budget=1000, keep_turns=3)) is None
+    assert model.requests == []
+
+
+def test_old_tool_outputs_are_trimmed():
+    model = SummaryModel()
+    long_output = 'x' * (history.TOOL_OUTPUT_KEEP_CHARS * 2)
+    messages = turn(1, long_output) + turn(2, long_output)
+
+    compacted = asyncio.run(history.compact(model, messages, budget=100000, keep_turns=3))
+    old_tool, last_tool = compacted[2], compacted[6]
+    assert old_tool.content.endswith(history.TRIMMED_MARK)
+    assert len(old_tool.content) == history.TOOL_OUTPUT_KEEP_CHARS + len(history.TRIMMED_MARK)
+    # Результат текущего хода агенту еще нужен целиком
+    assert last_tool.content == long_output
+    assert model.requests == []
+
+
+def test_old_turns_are_summarized_by_whole_turns():
+    model = SummaryModel()
+    messages = [message for index in range(5) for message in turn(index, 'событие ' * 50)]
+
+    compacted = asyncio.run(history.compact(model, messages, budget=10, keep_turns=2))
+    summary, kept = compacted[0], compacted[1:]
+    assert isinstance(summary, SystemMessage)
+    assert (summary.id, summary.content) == (history.SUMMARY_ID, 'Сводка')
+    # Граница проходит по началу хода: вызов инструмента и его результат не разрываются
+    assert isinstance(kept[0], HumanMessage) and kept[0].content == 'Запрос 3'
+    assert len(kept) == 8
+    calls = {call['id'] for message in kept if isinstance(message, AIMessage) for call in message.tool_calls}
+    assert {message.tool_call_id for message in kept if isinstance(message, ToolMessage)} == calls
+    # В сводку ушли только свернутые ходы
+    prompt = model.requests[0][1].content
+    assert 'Запрос 2' in prompt and 'Запрос 3' not in prompt
+
+
+def test_previous_summary_is_folded_into_new_one():
+    model = SummaryModel()
+    previous = SystemMessage(content='Старая сводка', id=history.SUMMARY_ID)
+    messages = [previous] + turn(1, 'событие ' * 50) + turn(2, 'событие ' * 50)
+
+    compacted = asyncio.run(history.compact(model, messages, budget=10, keep_turns=1))
+    assert [message.id for message in compacted] == [history.SUMMARY_ID] + [message.id for message in turn(2)]
+    assert 'Предыдущая сводка: Старая сводка' in model.requests[0][1].content
@@ -0,0 +1,58 @@
+import asyncio
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import calendars
+import intent_router
+from benchmarks.fakes import FakeCalendar
+
+
+USER_ID = 200005
+MOSCOW = ZoneInfo('Europe/Moscow')
+
+
+def test_parse_when_uses_day_boundaries_of_given_now():
+    now = datetime.datetime(2026, 3, 2, 1, 30, tzinfo=MOSCOW)
+    start, end = intent_router.parse_when('завтра', now)
+    assert start == datetime.datetime(2026, 3, 3, tzinfo=MOSCOW)
+    assert end == datetime.datetime(2026, 3, 4, tzinfo=MOSCOW)
+
+
+def test_split_when_passes_now_through():
+    now = datetime.datetime(2026, 3, 2, 1, 30, tzinfo=MOSCOW)
+    what, (start, _) = intent_router._split_when('созвон с петей завтра', now)
+    assert what == 'созвон с петей'
+    assert start == datetime.datetime(2026, 3, 3, tzinfo=MOSCOW)
+
+
+def test_format_event_in_user_timezone():
+    event = {'summary': 'Планерка', 'start': {'dateTime': '2026-03-02T07:00:00Z'},
+             'end': {'dateTime': '2026-03-02T07:30:00Z'}}
+    assert intent_router._format_event(event, MOSCOW) == '• 02.03 10:00–10:30 Планерка'
+
+
+def test_view_uses_calendar_timezone(monkeypatch):
+    calendar = FakeCalendar(latency=0, days_back=0, days_ahead=0)
+    monkeypatch.setattr(intent_router, 'credentials_store', {USER_ID: {'token': 'test'}})
+    monkeypatch.setattr(intent_router, 'get_calendar_service', lambda user_id, creds_data: calendar.service(user_id))
+    calendars.calendar_directory.forget(USER_ID)
+    requested = []
+
+    async def events_page(user_id, service, time_min, time_max, limit, cursor=None, calendar_ids=None, errors=None):
+        requested.append((time_min, time_max))
+        return [], 0, 0, None
+
+    monkeypatch.setattr(intent_router, 'events_page', events_page)
+
+    answer = asyncio.run(intent_router.IntentRouter().handle('что у меня завтра', USER_ID, {}))
+    assert answer == 'На этот период событий нет'
+    time_min, time_max = requested[0]
+    # Сутки по Москве, в какой бы зоне ни работал сервер
+    local = time_min.astimezone(MOSCOW)
+    assert (local.hour, local.minute) == (0, 0)
+    assert local.date() == datetime.datetime.now(MOSCOW).date() + datetime.timedelta(days=1)
+    assert time_max - time_min == datetime.timedelta(days=1)
@@ -0,0 +1,149 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import calendar_push
+import reminders
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+from benchmarks.fakes import FakeCalendar, FakePushSource, TZ
+from calendar_mirror import CalendarMirror
+
+
+USER_ID = 200002
+
+
+class RecordingSender:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, chat_id, text):
+        self.messages.append((time.time(), chat_id, text))
+        return True
+
+
+@pytest.fixture
+def calendar(tmp_path, monkeypatch):
+    # Без сгенерированных событий: в календаре только то, что добавит тест
+    calendar = FakeCalendar(latency=0, days_back=0, days_ahead=0)
+    service = lambda user_id, creds_data: calendar.service(user_id)
+    for module in (reminders, calendar_push):
+        monkeypatch.setattr(module, 'credentials_store', {USER_ID: {'token': 'test'}})
+        monkeypatch.setattr(module, 'get_calendar_service', service)
+    monkeypatch.setattr(reminders, 'calendar_mirror', CalendarMirror(str(tmp_path / 'mirror.sqlite3')))
+    return calendar
+
+
+def event(summary, start, event_id=None):
+    body = {'summary': summary,
+            'start': {'dateTime': start.isoformat()},
+            'end': {'dateTime': (start + datetime.timedelta(minutes=30)).isoformat()}}
+    if event_id is not None:
+        body['id'] = event_id
+    return body
+
+
+def test_reminder_fires_before_event(calendar):
+    sender = RecordingSender()
+    engine = reminders.ReminderEngine(sender, lead=1, horizon=3600)
+    start = datetime.datetime.now(TZ) + datetime.timedelta(seconds=1.5)
+    calendar.change(USER_ID, event('Созвон', start))
+
+    async def main():
+        runner = engine.start()
+        await engine.track([USER_ID])
+        await asyncio.sleep(1)
+        runner.cancel()
+
+    asyncio.run(main())
+    assert len(sender.messages) == 1
+    sent_at, chat_id, text = sender.messages[0]
+    assert chat_id == USER_ID
+    assert 'Созвон' in text
+    assert sent_at < start.timestamp()
+    assert engine.fired == 1
+
+
+def test_rescheduled_event_reminds_at_new_time(calendar, monkeypatch):
+    sender = RecordingSender()
+    engine = reminders.ReminderEngine(sender, lead=1, horizon=4 * 3600)
+    channels = calendar_push.PushChannels(address='https://bot.example.com/push', ttl=3600, margin=60)
+    monkeypatch.setattr(calendar_push, 'push_channels', channels)
+    monkeypatch.setattr(calendar_push, 'push_handler', engine.calendar_changed)
+    start = datetime.datetime.now(TZ) + datetime.timedelta(seconds=2)
+    created = calendar.change(USER_ID, event('Планерка', start))
+
+    async def main():
+        FakePushSource(calendar, calendar_push.deliver)
+        runner = engine.start()
+        await engine.track([USER_ID], channels.ensure)
+        before = dict(engine._timelines[USER_ID])
+        # Встречу переносят в интерфейсе Google, бот узнает об этом из уведомления
+        calendar.change(USER_ID, event('Планерка', start + datetime.timedelta(hours=2), created['id']))
+        await asyncio.sleep(1.5)
+        runner.cancel()
+        return before
+
+    before = asyncio.run(main())
+    assert list(before) == [created['id']]
+    # Старое напоминание устарело и не сработало, новое ждет своего времени
+    assert sender.messages == []
+    assert engine.stats()['pending'] == 1
+    assert engine._timelines[USER_ID][created['id']].start_ts == (start + datetime.timedelta(hours=2)).timestamp()
+
+
+class FlakyBot:
+    """Отвечает 429 на первую отправку в чат, а заблокировавшему бота чату - 403"""
+
+    def __init__(self, retry_after=1, blocked=()):
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.attempts = []
+        self.delivered = []
+
+    async def send_message(self, chat_id, text):
+        method = SendMessage(chat_id=chat_id, text=text)
+        self.attempts.append((time.monotonic(), chat_id))
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(method, 'bot was blocked by the user')
+        if len(self.attempts) == 1:
+            raise TelegramRetryAfter(method, 'Too Many Requests', self.retry_after)
+        self.delivered.append((chat_id, text))
+
+
+def test_sender_waits_retry_after_and_resends():
+    bot = FlakyBot(retry_after=1)
+    sender = reminders.TelegramSender(rate=100, chat_interval=0)
+
+    async def main():
+        runner = sender.start(bot)
+        sender.send(1, 'Напоминание')
+        await sender._queue.join()
+        runner.cancel()
+
+    asyncio.run(main())
+    assert bot.delivered == [(1, 'Напоминание')]
+    assert len(bot.attempts) == 2
+    assert bot.attempts[1][0] - bot.attempts[0][0] >= 1
+    assert sender.stats()['retried'] == 1
+    assert sender.stats()['sent'] == 1
+
+
+def test_sender_skips_blocked_chat():
+    bot = FlakyBot(blocked=[2])
+    sender = reminders.TelegramSender(rate=100, chat_interval=0)
+
+    async def main():
+        runner = sender.start(bot)
+        sender.send(2, 'Напоминание')
+        await sender._queue.join()
+        runner.cancel()
+
+    asyncio.run(main())
+    assert bot.delivered == []
+    assert sender.stats()['dropped'] == 1
+    assert sender.stats()['failed'] == 0
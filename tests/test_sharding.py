@@ -0,0 +1,117 @@
+import asyncio
+import collections
+import multiprocessing
+
+import pytest
+
+from sharding import ShardRouter, consume, shard_of, update_user_id
+
+
+USERS = range(100000, 120000)
+
+
+def message(user_id: int, update_id: int = 1) -> dict:
+    return {'update_id': update_id, 'message': {'message_id': 1, 'date': 0, 'text': 'привет',
+                                                'chat': {'id': user_id, 'type': 'private'},
+                                                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'}}}
+
+
+def test_shard_of_is_stable():
+    # Закреплено: смена формулы перераспределит всех пользователей и их кеши между воркерами
+    assert [shard_of(user_id, 4) for user_id in (1, 42, 100000, 123456789, 987654321012)] == [0, 2, 3, 0, 2]
+    assert [shard_of(user_id, 7) for user_id in (1, 42, 100000, 123456789, 987654321012)] == [6, 2, 3, 0, 5]
+    assert all(shard_of(user_id, 1) == 0 for user_id in USERS)
+
+
+@pytest.mark.parametrize('shards', [2, 3, 4, 8])
+def test_shard_of_is_balanced(shards):
+    counts = collections.Counter(shard_of(user_id, shards) for user_id in USERS)
+    assert sorted(counts) == list(range(shards))
+    expected = len(USERS) / shards
+    assert all(abs(count - expected) < 0.05 * expected for count in counts.values())
+
+
+@pytest.mark.parametrize('shards', [1, 2, 3, 7])
+def test_adding_worker_moves_only_its_share(shards):
+    moved = [user_id for user_id in USERS if shard_of(user_id, shards + 1) != shard_of(user_id, shards)]
+    # Переезжают только на новый воркер и примерно 1/(N+1) пользователей
+    assert all(shard_of(user_id, shards + 1) == shards for user_id in moved)
+    assert abs(len(moved) / len(USERS) - 1 / (shards + 1)) < 0.02
+
+
+def test_update_user_id():
+    assert update_user_id(message(7)) == 7
+    assert update_user_id({'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 8}}}) == 8
+    assert update_user_id({'update_id': 1, 'my_chat_member': {'chat': {'id': 9}, 'from': {'id': 10}}}) == 10
+    assert update_user_id({'update_id': 1}) == 0
+
+
+def make_router(shards=3, queue_size=4):
+    return ShardRouter(multiprocessing.get_context(), shards, queue_size=queue_size)
+
+
+def drain(target) -> list:
+    items = []
+    while not target.empty():
+        items.append(target.get(timeout=1))
+    return items
+
+
+def test_router_sends_user_to_own_worker():
+    router = make_router()
+    for update_id, user_id in enumerate((100000, 100001, 100002, 100000), 1):
+        assert router.offer(message(user_id, update_id))
+
+    for shard, target in enumerate(router.queues):
+        for kind, data in drain(target):
+            assert kind == 'update'
+            assert shard_of(update_user_id(data), router.shards) == shard
+    assert sum(router.stats()['routed']) == 4
+
+
+def test_router_sheds_when_worker_queue_is_full():
+    router = make_router(queue_size=1)
+    assert router.offer(message(100000, 1))
+    assert not router.offer(message(100000, 2))
+    assert router.stats()['shed'] == 1
+    drain(router.queues[shard_of(100000, router.shards)])
+
+
+def test_router_forwards_login_and_push_to_user_worker():
+    router = make_router()
+
+    async def forward():
+        await router.forward_login(100001, 'code', 'verifier')
+        await router.forward_push(100001)
+
+    asyncio.run(forward())
+    items = drain(router.queues[shard_of(100001, router.shards)])
+    assert items == [('login', {'user_id': 100001, 'code': 'code', 'code_verifier': 'verifier'}),
+                     ('push', {'user_id': 100001})]
+
+
+def test_consume_dispatches_worker_queue():
+    router = make_router(shards=1)
+    calls = []
+
+    class Updates:
+        async def put(self, data):
+            calls.append(('update', data['update_id']))
+
+    async def complete_login(user_id, code, code_verifier):
+        calls.append(('login', user_id))
+
+    async def calendar_changed(user_id):
+        calls.append(('push', user_id))
+
+    async def main():
+        router.offer(message(100000, 5))
+        await router.forward_login(100000, 'code', 'verifier')
+        await router.forward_push(100000)
+        router.stop()
+        await consume(router.queues[0], Updates(), complete_login, calendar_changed)
+        # Авторизации и изменения календарей обрабатываются отдельными задачами
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert calls == [('update', 5), ('login', 100000), ('push', 100000)]
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from state_backend import SqliteBackend, RedisBackend, create_backend
+
+
+# Redis для тестов: по умолчанию локальный сервер, отдельная база
+REDIS_URL = os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15')
+
+
+def redis_available() -> bool:
+    try:
+        import redis
+    except ImportError:
+        return False
+    try:
+        return redis.Redis.from_url(REDIS_URL, socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def make_backend(request, tmp_path):
+    if request.param == 'sqlite':
+        path = str(tmp_path / 'state.sqlite3')
+        return lambda: SqliteBackend(path)
+    if not redis_available():
+        pytest.skip(f"Redis is not available at {REDIS_URL}")
+    return lambda: RedisBackend(REDIS_URL)
+
+
+def run(make_backend, scenario):
+    """Выполняет сценарий с хранилищем, созданным в цикле событий теста"""
+    async def main():
+        backend = make_backend()
+        # Ключи с уникальным префиксом, чтобы прогоны не мешали друг другу в общем Redis
+        prefix = f'test:{uuid.uuid4().hex}:'
+        try:
+            return await scenario(backend, prefix)
+        finally:
+            for key, _ in await backend.scan(prefix):
+                await backend.delete(key)
+            await backend.close()
+
+    return asyncio.run(main())
+
+
+def test_set_get_delete(make_backend):
+    async def scenario(backend, prefix):
+        await backend.set(prefix + 'a', 'значение')
+        value = await backend.get(prefix + 'a')
+        await backend.delete(prefix + 'a')
+        return value, await backend.get(prefix + 'a'), await backend.get(prefix + 'missing')
+
+    assert run(make_backend, scenario) == ('значение', None, None)
+
+
+def test_ttl_expires(make_backend):
+    async def scenario(backend, prefix):
+        await backend.set(prefix + 'short', '1', ttl=0.2)
+        await backend.set(prefix + 'long', '2', ttl=60)
+        before = await backend.get(prefix + 'short')
+        await asyncio.sleep(0.4)
+        return before, await backend.get(prefix + 'short'), await backend.get(prefix + 'long')
+
+    assert run(make_backend, scenario) == ('1', None, '2')
+
+
+def test_pop_returns_value_once(make_backend):
+    async def scenario(backend, prefix):
+        await backend.set(prefix + 'state', 'verifier')
+        results = await asyncio.gather(*(backend.pop(prefix + 'state') for _ in range(5)))
+        return results, await backend.get(prefix + 'state')
+
+    results, left = run(make_backend, scenario)
+    assert sorted(results, key=str) == [None, None, None, None, 'verifier']
+    assert left is None
+
+
+def test_scan_by_prefix(make_backend):
+    async def scenario(backend, prefix):
+        await backend.set(prefix + 'credentials:1', 'x')
+        await backend.set(prefix + 'credentials:2', 'y')
+        await backend.set(prefix + 'oauth:1', 'z')
+        await backend.set(prefix + 'credentials:3', 'expired', ttl=0.1)
+        await asyncio.sleep(0.3)
+        return sorted((key[len(prefix):], value) for key, value in await backend.scan(prefix + 'credentials:'))
+
+    assert run(make_backend, scenario) == [('credentials:1', 'x'), ('credentials:2', 'y')]
+
+
+def test_sqlite_connection_is_ready_for_several_processes(tmp_path):
+    backend = SqliteBackend(str(tmp_path / 'state.sqlite3'))
+    try:
+        assert backend._db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert backend._db.execute('PRAGMA busy_timeout').fetchone()[0] > 0
+    finally:
+        backend._db.close()
+
+
+def test_sqlite_pop_is_atomic_across_connections(tmp_path):
+    # Как два воркера с одним файлом: значение достается только одному
+    path = str(tmp_path / 'state.sqlite3')
+
+    async def main():
+        backends = [SqliteBackend(path) for _ in range(4)]
+        try:
+            await backends[0].set('oauth:state', 'verifier')
+            return await asyncio.gather(*(backend.pop('oauth:state') for backend in backends))
+        finally:
+            for backend in backends:
+                await backend.close()
+
+    assert sorted(asyncio.run(main()), key=str) == [None, None, None, 'verifier']
+
+
+def test_create_backend_by_url(tmp_path):
+    backend = create_backend(f'sqlite:///{tmp_path}/state.sqlite3')
+    assert isinstance(backend, SqliteBackend)
+    asyncio.run(backend.close())
+    with pytest.raises(ValueError):
+        create_backend('memcached://localhost')
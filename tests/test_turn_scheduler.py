@@ -0,0 +1,33 @@
+import asyncio
+
+from turn_scheduler import TokenBucket, TurnScheduler
+
+
+def test_bucket_share_divides_rate_and_burst():
+    bucket = TokenBucket(rate=6, burst=9)
+    bucket.share(3)
+    assert bucket.stats()['rate'] == 2
+    assert bucket.stats()['burst'] == 3
+
+    # Каждый процесс получает хотя бы одно разрешение подряд
+    bucket.share(20)
+    assert bucket.stats()['burst'] == 1
+
+
+def test_scheduler_share_limits_concurrent_turns():
+    scheduler = TurnScheduler(max_concurrency=8, max_queue=100)
+    scheduler.share(4)
+    peak = 0
+
+    async def turn(user_id):
+        nonlocal peak
+        async with scheduler.turn(user_id):
+            peak = max(peak, scheduler.stats()['running'])
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*(turn(user_id) for user_id in range(10)))
+
+    asyncio.run(main())
+    assert scheduler.stats()['max_concurrency'] == 2
+    assert peak == 2
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('aiogram')
+web_server = pytest.importorskip('web_server')
+
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher
+
+
+SECRET = 'test-secret'
+WEBHOOK_PATH = '/telegram'
+
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 7, 'type': 'private'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'Test'},
+        'text': 'что у меня завтра',
+    },
+}
+
+
+def make_server(updates) -> web_server.WebServer:
+    server = web_server.WebServer(updates, secret=SECRET, callback=False)
+    server.enable_webhook(WEBHOOK_PATH)
+    return server
+
+
+async def post(server, *bodies, secret=SECRET) -> list:
+    """Отправляет обновления на webhook, возвращает коды ответов"""
+    headers = {web_server.SECRET_HEADER: secret} if secret is not None else {}
+    async with TestClient(TestServer(server.app)) as client:
+        statuses = []
+        for body in bodies:
+            response = await client.post(WEBHOOK_PATH, json=body, headers=headers)
+            statuses.append(response.status)
+        return statuses
+
+
+def make_queue(dispatcher=None, queue_size=8):
+    # Токен нужен только для разбора обновлений, запросов к Telegram в тестах нет
+    bot = Bot('42:TEST')
+    return web_server.UpdateQueue(dispatcher or Dispatcher(), bot, queue_size=queue_size, workers=1), bot
+
+
+@pytest.mark.parametrize('secret', ['wrong', None])
+def test_bad_secret_is_rejected(secret):
+    async def scenario():
+        updates, bot = make_queue()
+        server = make_server(updates)
+        try:
+            return server, await post(server, UPDATE, secret=secret)
+        finally:
+            await bot.session.close()
+
+    server, statuses = asyncio.run(scenario())
+    assert statuses == [403]
+    assert server.stats() == {'accepted': 0, 'rejected': 1, 'shed': 0}
+
+
+def test_full_queue_answers_503():
+    async def scenario():
+        # Обработчики не запущены, поэтому второе обновление в очередь уже не помещается
+        updates, bot = make_queue(queue_size=1)
+        server = make_server(updates)
+        try:
+            return server, updates, await post(server, UPDATE, {**UPDATE, 'update_id': 2})
+        finally:
+            await bot.session.close()
+
+    server, updates, statuses = asyncio.run(scenario())
+    assert statuses == [200, 503]
+    assert server.stats() == {'accepted': 1, 'rejected': 0, 'shed': 1}
+    assert updates.stats()['queued'] == 1
+
+
+def test_malformed_body_answers_400():
+    async def scenario():
+        updates, bot = make_queue()
+        server = make_server(updates)
+        try:
+            async with TestClient(TestServer(server.app)) as client:
+                response = await client.post(WEBHOOK_PATH, data=b'not json',
+                                             headers={web_server.SECRET_HEADER: SECRET})
+                return response.status
+        finally:
+            await bot.session.close()
+
+    assert asyncio.run(scenario()) == 400
+
+
+def test_update_reaches_dispatcher():
+    async def scenario():
+        received = asyncio.Queue()
+        dispatcher = Dispatcher()
+
+        async def on_message(message):
+            received.put_nowait((message.chat.id, message.text))
+
+        dispatcher.message.register(on_message)
+        updates, bot = make_queue(dispatcher)
+        updates.start()
+        try:
+            statuses = await post(make_server(updates), UPDATE)
+            return statuses, await asyncio.wait_for(received.get(), 5), updates.stats()
+        finally:
+            await updates.stop()
+            await bot.session.close()
+
+    statuses, message, stats = asyncio.run(scenario())
+    assert statuses == [200]
+    assert message == (7, 'что у меня завтра')
+    assert stats['failed'] == 0
@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import write_coalescer
+from benchmarks.fakes import FakeCalendar, TZ
+from calendar_mirror import CalendarMirror
+
+
+USER_ID = 200004
+
+
+@pytest.fixture
+def calendar(tmp_path, monkeypatch):
+    calendar = FakeCalendar(latency=0, days_back=0, days_ahead=0)
+    mirror = CalendarMirror(str(tmp_path / 'mirror.sqlite3'))
+    monkeypatch.setattr(write_coalescer, 'calendar_mirror', mirror)
+    monkeypatch.setattr(write_coalescer, 'credentials_store', {USER_ID: {'token': 'test'}})
+    monkeypatch.setattr(write_coalescer, 'get_calendar_service', lambda user_id, creds_data: calendar.service(user_id))
+
+    patches = []
+    patch = calendar.patch
+
+    def counted(user_id, eventId, body, headers=None, **params):
+        # Запросы бота идут с заголовками, правки "из веб-интерфейса" (calendar.change) - без
+        if headers is not None:
+            patches.append((eventId, headers.get('If-Match')))
+        return patch(user_id, eventId, body, headers, **params)
+
+    calendar.patch = counted
+    calendar.patches = patches
+    calendar.mirror = mirror
+    return calendar
+
+
+def create_event(calendar):
+    start = datetime.datetime.now(TZ) + datetime.timedelta(days=1)
+    event = calendar.change(USER_ID, {'summary': 'Планерка', 'start': {'dateTime': start.isoformat()},
+                                      'end': {'dateTime': (start + datetime.timedelta(hours=1)).isoformat()}})
+    asyncio.run(calendar.mirror.sync(USER_ID, calendar.service(USER_ID)))
+    return event
+
+
+def test_edits_of_one_turn_are_sent_as_one_patch(calendar):
+    event = create_event(calendar)
+    coalescer = write_coalescer.WriteCoalescer()
+
+    # Название, место и описание меняются в разных шагах агента
+    coalescer.add(USER_ID, event['id'], {'summary': 'Синк'})
+    coalescer.add(USER_ID, event['id'], {'location': 'Переговорка'})
+    coalescer.add(USER_ID, event['id'], {'description': 'Повестка'})
+
+    # До отправки копия уже показывает правки, а Google - еще нет
+    local = calendar.mirror.get_event(USER_ID, event['id'])
+    assert (local['summary'], local['location']) == ('Синк', 'Переговорка')
+    assert calendar.patches == []
+
+    errors = asyncio.run(coalescer.flush(USER_ID))
+    assert errors == []
+    assert calendar.patches == [(event['id'], event['etag'])]
+    stored = calendar._user(USER_ID)['events'][event['id']]
+    assert (stored['summary'], stored['location'], stored['description']) == ('Синк', 'Переговорка', 'Повестка')
+    assert calendar.mirror.get_event(USER_ID, event['id'])['etag'] == stored['etag']
+
+
+def test_conflict_is_reported_without_overwriting(calendar):
+    event = create_event(calendar)
+    coalescer = write_coalescer.WriteCoalescer()
+
+    coalescer.add(USER_ID, event['id'], {'summary': 'Синк'})
+    # Пока ход шел, событие переименовали в веб-интерфейсе
+    calendar.change(USER_ID, {'id': event['id'], 'summary': 'Планерка команды'})
+
+    errors = asyncio.run(coalescer.flush(USER_ID))
+    assert len(errors) == 1 and 'изменено в другом месте' in errors[0]
+    # Правка не повторялась, чужое изменение осталось
+    assert len(calendar.patches) == 1
+    assert calendar._user(USER_ID)['events'][event['id']]['summary'] == 'Планерка команды'
+    # Копия догнала настоящую версию вместе с новым ETag
+    local = calendar.mirror.get_event(USER_ID, event['id'])
+    assert local['summary'] == 'Планерка команды'
+    assert local['etag'] == calendar._user(USER_ID)['events'][event['id']]['etag']
+    assert coalescer.stats()['conflicts'] == 1
+
+
+def test_discarded_edit_is_not_sent(calendar):
+    event = create_event(calendar)
+    coalescer = write_coalescer.WriteCoalescer()
+
+    coalescer.add(USER_ID, event['id'], {'summary': 'Синк'})
+    coalescer.discard(USER_ID, event['id'])
+
+    assert asyncio.run(coalescer.flush(USER_ID)) == []
+    assert calendar.patches == []
@@ -0,0 +1,67 @@
+import time
+
+from calendar_mirror import calendar_mirror
+from config import TOOL_MEMO_TTL
+
+
+class ToolMemo:
+    """Кеш результатов инструментов чтения на время хода агента.
+
+    Агент в одном ходе часто повторяет view/find с теми же
+    аргументами. Результаты живут ttl секунд и только
+    пока не изменилась версия локальной копии календаря пользователя.
+    Любая успешная запись (создание, удаление, правки из write_coalescer)
+    сразу попадает в копию и меняет версию, так что кеш сбрасывается сам.
+    Просмотр кеширует готовые страницы, а не интервалы целиком: сама
+    страница читается из копии запросом с LIMIT.
+    """
+
+    def __init__(self, ttl: float = TOOL_MEMO_TTL):
+        self._ttl = ttl
+        # user_id -> {(инструмент, аргументы): (результат, время, версия)}
+        self._results = {}
+        self._swept_at = time.monotonic()
+
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, user_id, stored_at, revision, now) -> bool:
+        return now - stored_at < self._ttl and revision == calendar_mirror.revision(user_id)
+
+    def get(self, user_id: int, tool: str, args: tuple):
+        entry = self._results.get(user_id, {}).get((tool, args))
+        if entry is not None and self._fresh(user_id, entry[1], entry[2], time.monotonic()):
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, tool: str, args: tuple, result):
+        now = time.monotonic()
+        self._results.setdefault(user_id, {})[(tool, args)] = (result, now, calendar_mirror.revision(user_id))
+        self._sweep(now)
+
+    def _sweep(self, now: float):
+        # Устаревшие записи вычищаем не чаще раза в ttl, чтобы не перебирать кеш на каждом вызове
+        if now - self._swept_at < self._ttl:
+            return
+        self._swept_at = now
+        for user_id in list(self._results):
+            results = {key: entry for key, entry in self._results[user_id].items() if now - entry[1] < self._ttl}
+            if results:
+                self._results[user_id] = results
+            else:
+                del self._results[user_id]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'users': len(self._results),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+tool_memo = ToolMemo()
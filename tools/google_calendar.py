@@ -1,6 +1,15 @@
-from google.oauth2.credentials import Credentials
 from oauthServer import credentials_store
+from google_services import get_calendar_service, aexecute, aexecute_batch
+from calendar_mirror import calendar_mirror
+from calendars import calendar_directory, events_page, WRITE_ROLES
+from event_search import event_search
+from write_coalescer import write_coalescer, patch_request, refresh_conflicts, describe_error
+from tool_memo import tool_memo
+from tracing import tracer
+from config import VIEW_EVENTS_PAGE_SIZE, FREEBUSY_MAX_DAYS, FREEBUSY_MAX_CALENDARS
+import free_slots
 import datetime
+import time
 from pydantic import BaseModel, Field
 
 from langchain_core.tools import tool
@@ -10,58 +19,92 @@ from langchain_core.tools import tool
 class ViewEventsInput(BaseModel):
     time_min: datetime.datetime = Field(description="Начало временного интервала")
     time_max: datetime.datetime = Field(description="Конец временного интервала")
+    page_token: str = Field(default=None, description="Токен продолжения из предыдущего ответа")
+
+
+def format_event(event: dict, calendar: str = None) -> str:
+    start = event["start"].get("dateTime", event["start"].get("date"))
+    end = event["end"].get("dateTime", event["end"].get("date"))
+    summary = event.get("summary", "Без названия")
+    # Календарь указываем только для неосновных
+    suffix = f" [{calendar}]" if calendar else ""
+    return f"• {summary} ({start} - {end}){suffix}"
+
+
+def calendar_label(user_id: int, event: dict):
+    """Название календаря события для ответа, None - для основного"""
+    calendar_id = event.get('calendarId', 'primary')
+    return None if calendar_id == 'primary' else calendar_directory.name(user_id, calendar_id)
+
+
+def describe_unavailable(user_id: int, errors: dict) -> list:
+    return [f"Календарь {calendar_directory.name(user_id, calendar_id)} сейчас недоступен"
+            for calendar_id in errors]
+
+
+async def target_calendar(user_id: int, service, calendar: str = None):
+    """id календаря для записи по названию из запроса; (None, текст ошибки), если такого нет"""
+    if not calendar:
+        return 'primary', None
+    found = await calendar_directory.resolve(user_id, service, calendar, writable=True)
+    if found is None:
+        writable = [item['summary'] for item in await calendar_directory.calendars(user_id, service)
+                    if item['access_role'] in WRITE_ROLES]
+        return None, f"ERROR: календарь '{calendar}' не найден или недоступен для записи. Доступны: {', '.join(writable)}"
+    return found['id'], None
 
 
 # Создаем фабрику для инструмента с привязкой к user_id
 def make_view_google_events_tool(user_id: int):
     @tool("view_google_events", args_schema=ViewEventsInput)
-    async def view_google_events(time_min: datetime.datetime, time_max: datetime.datetime) -> list:
-        """Получает события из Google Calendar для аутентифицированного пользователя"""
-        from googleapiclient.discovery import build
+    @tracer.traced('tool.view_google_events')
+    async def view_google_events(
+            time_min: datetime.datetime,
+            time_max: datetime.datetime,
+            page_token: str = None
+    ) -> str:
+        """Получает события из всех выбранных календарей Google Calendar пользователя.
+        Если событий больше, чем помещается в ответ, возвращает page_token для продолжения"""
         creds_data = credentials_store.get(user_id)
-
         if not creds_data:
             return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
 
         try:
-            # Если хранится словарь - преобразуем в объект Credentials
-            if isinstance(creds_data, dict):
-                credentials = Credentials.from_authorized_user_info(creds_data)
-            else:
-                credentials = creds_data
-
-            service = build("calendar", "v3", credentials=credentials)
+            service = get_calendar_service(user_id, creds_data)
 
             time_min_utc = time_min.astimezone(datetime.timezone.utc) if time_min.tzinfo else time_min.replace(
                 tzinfo=datetime.timezone.utc)
             time_max_utc = time_max.astimezone(datetime.timezone.utc) if time_max.tzinfo else time_max.replace(
                 tzinfo=datetime.timezone.utc)
 
-            events_result = service.events().list(
-                calendarId='primary',
-                timeMin=time_min_utc.isoformat(),
-                timeMax=time_max_utc.isoformat(),
-                maxResults=10,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
+            # Агент часто повторяет просмотр в одном ходе - отдаем прошлую страницу
+            calendar_ids = tuple(await calendar_directory.selected(user_id, service))
+            memo_args = (time_min_utc, time_max_utc, page_token, calendar_ids)
+            response = tool_memo.get(user_id, 'view_google_events', memo_args)
+            if response is not None:
+                return response
 
-            events = events_result.get('items', [])
+            # Страница читается из локальной копии (она при необходимости догоняется по syncToken)
+            errors = {}
+            events, total, offset, next_page_token = await events_page(
+                user_id, service, time_min_utc, time_max_utc, VIEW_EVENTS_PAGE_SIZE, page_token,
+                list(calendar_ids), errors)
+            unavailable = describe_unavailable(user_id, errors)
 
             # Форматирование ответа
-            if isinstance(events, list):
-                if not events:
-                    response = "На этот период событий не найдено"
-                else:
-                    event_texts = []
-                    for event in events:
-                        start = event["start"].get("dateTime", event["start"].get("date"))
-                        end = event["end"].get("dateTime", event["end"].get("date"))
-                        summary = event.get("summary", "Без названия")
-                        event_texts.append(f"• {summary} ({start} - {end})")
-                    response = "\n".join(event_texts)
+            if not events:
+                response = "\n".join(["На этот период событий не найдено"] + unavailable)
             else:
-                response = events  # Готовое текстовое сообщение
+                response = "\n".join([format_event(event, calendar_label(user_id, event)) for event in events]
+                                      + unavailable)
+                if next_page_token or offset:
+                    response += f"\nПоказаны события {offset + 1}–{offset + len(events)} из {total}."
+                if next_page_token:
+                    response += f" Для продолжения вызови view_google_events с page_token={next_page_token}"
+
+            # Неполный результат не кешируем
+            if not errors:
+                tool_memo.put(user_id, 'view_google_events', memo_args, response)
             return response
 
         except Exception as e:
@@ -70,62 +113,76 @@ def make_view_google_events_tool(user_id: int):
     return view_google_events
 
 
+def _event_time(moment: datetime.datetime) -> dict:
+    """Форматирование времени для Google Calendar"""
+    timezone = getattr(moment.tzinfo, 'zone', None) or "UTC"
+    return {
+        'dateTime': moment.astimezone(datetime.timezone.utc).isoformat(),
+        'timeZone': timezone,
+    }
+
+
+def _event_patch(summary=None, start_datetime=None, end_datetime=None, description=None, location=None) -> dict:
+    """Тело запроса только из переданных полей"""
+    patch = {}
+    if summary is not None:
+        patch['summary'] = summary
+    if description is not None:
+        patch['description'] = description
+    if location is not None:
+        patch['location'] = location
+    if start_datetime is not None:
+        patch['start'] = _event_time(start_datetime)
+    if end_datetime is not None:
+        patch['end'] = _event_time(end_datetime)
+    return patch
+
+
+def _as_input(item, model):
+    # Вложенные аргументы могут прийти как модель или как словарь
+    return item if isinstance(item, model) else model(**item)
+
+
 class CreateEventInput(BaseModel):
     summary: str = Field(description="Название события")
     start_datetime: datetime.datetime = Field(description="Дата и время начала события")
     end_datetime: datetime.datetime = Field(description="Дата и время окончания события")
     description: str = Field(default="", description="Описание события")
     location: str = Field(default="", description="Место проведения")
+    calendar: str = Field(default=None, description="Название календаря, если не основной")
 
 
 def make_create_google_event_tool(user_id: int):
     @tool("create_google_event", args_schema=CreateEventInput)
+    @tracer.traced('tool.create_google_event')
     async def create_google_event(
             summary: str,
             start_datetime: datetime.datetime,
             end_datetime: datetime.datetime,
             description: str = "",
-            location: str = ""
+            location: str = "",
+            calendar: str = None
     ) -> str:
-        """Создает новое событие в Google Calendar"""
-        from googleapiclient.discovery import build
-        from google.oauth2.credentials import Credentials
-
+        """Создает новое событие в Google Calendar, по умолчанию в основном календаре"""
         creds_data = credentials_store.get(user_id)
         if not creds_data:
             return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
 
         try:
-            if isinstance(creds_data, dict):
-                credentials = Credentials.from_authorized_user_info(creds_data)
-            else:
-                credentials = creds_data
-
-            service = build("calendar", "v3", credentials=credentials)
-
-            # Форматирование времени для Google Calendar
-            timezone = start_datetime.tzinfo.zone if start_datetime.tzinfo else "UTC"
-            start = start_datetime.astimezone(datetime.timezone.utc).isoformat()
-            end = end_datetime.astimezone(datetime.timezone.utc).isoformat()
-
-            event = {
-                'summary': summary,
-                'description': description,
-                'location': location,
-                'start': {
-                    'dateTime': start,
-                    'timeZone': timezone,
-                },
-                'end': {
-                    'dateTime': end,
-                    'timeZone': timezone,
-                },
-            }
-
-            created_event = service.events().insert(
-                calendarId='primary',
-                body=event
-            ).execute()
+            service = get_calendar_service(user_id, creds_data)
+
+            calendar_id, error = await target_calendar(user_id, service, calendar)
+            if error:
+                return error
+
+            event = _event_patch(summary, start_datetime, end_datetime, description, location)
+
+            created_event = await aexecute(
+                service.events().insert(
+                    calendarId=calendar_id,
+                    body=event
+                ), user_id)
+            calendar_mirror.upsert(user_id, created_event, calendar_id)
 
             return f"Событие создано: {created_event['htmlLink']}"
 
@@ -141,27 +198,24 @@ class DeleteEventInput(BaseModel):
 
 def make_delete_google_event_tool(user_id: int):
     @tool("delete_google_event", args_schema=DeleteEventInput)
+    @tracer.traced('tool.delete_google_event')
     async def delete_google_event(event_id: str) -> str:
         """Удаляет событие из Google Calendar по его ID"""
-        from googleapiclient.discovery import build
-        from google.oauth2.credentials import Credentials
-
         creds_data = credentials_store.get(user_id)
         if not creds_data:
             return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
 
         try:
-            if isinstance(creds_data, dict):
-                credentials = Credentials.from_authorized_user_info(creds_data)
-            else:
-                credentials = creds_data
-
-            service = build("calendar", "v3", credentials=credentials)
+            service = get_calendar_service(user_id, creds_data)
+            calendar_id = calendar_mirror.calendar_of(user_id, event_id)
 
-            service.events().delete(
-                calendarId='primary',
-                eventId=event_id
-            ).execute()
+            await aexecute(
+                service.events().delete(
+                    calendarId=calendar_id,
+                    eventId=event_id
+                ), user_id)
+            calendar_mirror.remove(user_id, event_id, calendar_id)
+            write_coalescer.discard(user_id, event_id)
 
             return f"Событие {event_id} успешно удалено"
 
@@ -172,65 +226,196 @@ def make_delete_google_event_tool(user_id: int):
 
 
 class FindEventInput(BaseModel):
-    summary: str = Field(description="Название события для поиска")
-    date: datetime.date = Field(description="Дата события в формате YYYY-MM-DD")
+    summary: str = Field(description="Название события или его часть, можно с опечатками")
+    date: datetime.date = Field(default=None, description="Дата события в формате YYYY-MM-DD, если известна")
+    date_from: datetime.date = Field(default=None, description="Начало диапазона поиска (YYYY-MM-DD)")
+    date_to: datetime.date = Field(default=None, description="Конец диапазона поиска включительно (YYYY-MM-DD)")
+
+
+def _day_start(date: datetime.date) -> datetime.datetime:
+    return datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
 
 
 def make_find_google_event_tool(user_id: int):
     @tool("find_google_event", args_schema=FindEventInput)
-    async def find_google_event(summary: str, date: datetime.date) -> str:
-        """Ищет событие в Google Calendar по названию и дате, возвращает его ID"""
-        from googleapiclient.discovery import build
-
+    @tracer.traced('tool.find_google_event')
+    async def find_google_event(
+            summary: str,
+            date: datetime.date = None,
+            date_from: datetime.date = None,
+            date_to: datetime.date = None
+    ) -> str:
+        """Ищет события в Google Calendar по названию (с учетом опечаток и падежей),
+        по дате или диапазону дат. Возвращает до 5 наиболее подходящих событий с их ID"""
         creds_data = credentials_store.get(user_id)
         if not creds_data:
             return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
 
         try:
-            # Преобразование учетных данных
-            if isinstance(creds_data, dict):
-                credentials = Credentials.from_authorized_user_info(creds_data)
-            else:
-                credentials = creds_data
+            service = get_calendar_service(user_id, creds_data)
 
-            service = build("calendar", "v3", credentials=credentials)
+            # Конкретная дата сужает диапазон до одного дня
+            if date is not None:
+                date_from = date_to = date
+            time_min = _day_start(date_from) if date_from else None
+            time_max = _day_start(date_to) + datetime.timedelta(days=1) if date_to else None
 
-            # Рассчитываем временной интервал для целого дня
-            time_min = datetime.datetime(date.year, date.month, date.day, 0, 0, 0).isoformat() + 'Z'
-            time_max = datetime.datetime(date.year, date.month, date.day, 23, 59, 59).isoformat() + 'Z'
+            # Агент часто повторяет поиск в одном ходе - отдаем прошлый результат
+            memo_args = (' '.join(summary.lower().split()), time_min, time_max)
+            response = tool_memo.get(user_id, 'find_google_event', memo_args)
+            if response is not None:
+                return response
 
-            # Ищем события по названию в указанный день
-            events_result = service.events().list(
-                calendarId='primary',
-                timeMin=time_min,
-                timeMax=time_max,
-                maxResults=5,
-                singleEvents=True,
-                orderBy='startTime',
-                q=summary  # Поиск по названию
-            ).execute()
+            found = await event_search.search(user_id, service, summary, time_min, time_max, k=5)
 
-            events = events_result.get('items', [])
+            if not found:
+                period = f" на {date}" if date else ""
+                response = f"Событие '{summary}'{period} не найдено"
+            else:
+                lines = []
+                for event, score in found:
+                    start = event['start'].get('dateTime', event['start'].get('date'))
+                    calendar = calendar_label(user_id, event)
+                    suffix = f" [{calendar}]" if calendar else ""
+                    lines.append(f"• id={event['id']}: {event.get('summary', 'Без названия')} ({start}){suffix}")
+                response = "\n".join(lines)
+
+            tool_memo.put(user_id, 'find_google_event', memo_args, response)
+            return response
 
-            if not events:
-                return f"Событие '{summary}' на {date} не найдено"
+        except Exception as e:
+            return f"Ошибка при поиске: {str(e)}"
 
-            # Фильтруем точные совпадения в названии
-            exact_matches = [e for e in events if e.get('summary', '').lower() == summary.lower()]
+    return find_google_event
 
-            if not exact_matches:
-                return f"Точного совпадения для '{summary}' не найдено. Найдены: {', '.join(e.get('summary') for e in events)}"
 
-            if len(exact_matches) > 1:
-                times = [e['start'].get('dateTime', e['start'].get('date')) for e in exact_matches]
-                return f"Найдено несколько событий. Уточните время: {', '.join(times)}"
+class FindFreeSlotsInput(BaseModel):
+    date_from: datetime.date = Field(description="Начало диапазона поиска (YYYY-MM-DD)")
+    date_to: datetime.date = Field(description="Конец диапазона поиска включительно (YYYY-MM-DD)")
+    duration_minutes: int = Field(default=60, description="Длительность встречи в минутах")
+    attendees: list[str] = Field(default=None, description="Email участников, чья занятость тоже учитывается")
+    work_start: int = Field(default=9, description="Начало рабочего дня, час")
+    work_end: int = Field(default=19, description="Конец рабочего дня, час")
+    buffer_minutes: int = Field(default=0, description="Перерыв до и после других встреч в минутах")
+    include_weekends: bool = Field(default=False, description="Искать и в выходные")
+
+
+WEEKDAYS = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+
+def _parse_utc(value: str) -> float:
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+async def query_busy(user_id: int, service, time_min: datetime.datetime, time_max: datetime.datetime,
+                     calendars: list):
+    """Интервалы занятости календарей из freebusy.query.
+
+    Длинный диапазон режется на части по FREEBUSY_MAX_DAYS, календари - по
+    FREEBUSY_MAX_CALENDARS, части запрашиваются одним пакетом. Возвращает
+    список (начало, конец) в timestamp и {календарь: ошибка}.
+    """
+    requests = []
+    chunk_start = time_min
+    while chunk_start < time_max:
+        chunk_end = min(time_max, chunk_start + datetime.timedelta(days=FREEBUSY_MAX_DAYS))
+        for index in range(0, len(calendars), FREEBUSY_MAX_CALENDARS):
+            requests.append(service.freebusy().query(body={
+                'timeMin': chunk_start.isoformat(),
+                'timeMax': chunk_end.isoformat(),
+                'timeZone': 'UTC',
+                'items': [{'id': calendar} for calendar in calendars[index:index + FREEBUSY_MAX_CALENDARS]],
+            }))
+        chunk_start = chunk_end
+
+    if len(requests) == 1:
+        results = [(await aexecute(requests[0], user_id), None)]
+    else:
+        results = await aexecute_batch(service, requests, user_id)
+
+    busy = []
+    errors = {}
+    for response, error in results:
+        if error is not None:
+            raise error
+        for calendar, data in response.get('calendars', {}).items():
+            if data.get('errors'):
+                errors[calendar] = data['errors'][0].get('reason', 'unknown')
+            busy.extend((_parse_utc(period['start']), _parse_utc(period['end'])) for period in data.get('busy', []))
+    return busy, errors
+
+
+def make_find_free_slots_tool(user_id: int):
+    @tool("find_free_slots", args_schema=FindFreeSlotsInput)
+    @tracer.traced('tool.find_free_slots')
+    async def find_free_slots(
+            date_from: datetime.date,
+            date_to: datetime.date,
+            duration_minutes: int = 60,
+            attendees: list = None,
+            work_start: int = 9,
+            work_end: int = 19,
+            buffer_minutes: int = 0,
+            include_weekends: bool = False
+    ) -> str:
+        """Находит свободное время для встречи во всех календарях пользователя и, если указаны,
+        в календарях участников. Учитывает рабочие часы, длительность и перерывы между
+        встречами. Возвращает до 5 вариантов, ранние первыми, не больше двух в день"""
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
+
+        if date_to < date_from:
+            return "Ошибка: date_to раньше date_from"
+        if not 0 <= work_start < work_end <= 24:
+            return "Ошибка: неверные рабочие часы"
+        if duration_minutes <= 0:
+            return "Ошибка: длительность должна быть положительной"
 
-            return exact_matches[0]['id']  # Возвращаем ID события
+        try:
+            service = get_calendar_service(user_id, creds_data)
+            # Рабочие часы - по часам пользователя, с переходами на летнее время внутри диапазона
+            tz = await calendar_directory.timezone(user_id, service)
+            # Занятость во всех выбранных календарях пользователя плюс календари участников
+            own = await calendar_directory.busy_sources(user_id, service)
+            calendars = own + sorted({email.strip().lower() for email in attendees or [] if email.strip()} - set(own))
+
+            memo_args = (date_from, date_to, duration_minutes, tuple(calendars), work_start, work_end,
+                         buffer_minutes, include_weekends)
+            response = tool_memo.get(user_id, 'find_free_slots', memo_args)
+            if response is not None:
+                return response
+
+            time_min = datetime.datetime(date_from.year, date_from.month, date_from.day, tzinfo=tz)
+            time_max = datetime.datetime(date_to.year, date_to.month, date_to.day, tzinfo=tz) \
+                + datetime.timedelta(days=1)
+            busy, errors = await query_busy(user_id, service, time_min, time_max, calendars)
+
+            slots = free_slots.find_free_slots(
+                busy, date_from, date_to, duration_minutes * 60, tz,
+                work_start=work_start, work_end=work_end, buffer=buffer_minutes * 60,
+                weekends=include_weekends, not_before=time.time())
+
+            lines = []
+            for start, end, free_until in slots:
+                start = datetime.datetime.fromtimestamp(start, tz)
+                end = datetime.datetime.fromtimestamp(end, tz)
+                free_until = datetime.datetime.fromtimestamp(free_until, tz)
+                lines.append(f"• {WEEKDAYS[start.weekday()]} {start:%d.%m} {start:%H:%M}–{end:%H:%M} "
+                             f"(свободно до {free_until:%H:%M}), start_datetime={start.isoformat()}")
+            if not lines:
+                lines.append("Свободного времени нужной длительности не найдено")
+            for calendar, reason in errors.items():
+                lines.append(f"Занятость {calendar} недоступна: {reason}")
+
+            response = "\n".join(lines)
+            tool_memo.put(user_id, 'find_free_slots', memo_args, response)
+            return response
 
         except Exception as e:
-            return f"Ошибка при поиске: {str(e)}"
+            return f"Ошибка при поиске свободного времени: {str(e)}"
 
-    return find_google_event
+    return find_free_slots
 
 
 class UpdateEventInput(BaseModel):
@@ -244,6 +429,7 @@ class UpdateEventInput(BaseModel):
 
 def make_update_google_event_tool(user_id: int):
     @tool("update_google_event", args_schema=UpdateEventInput)
+    @tracer.traced('tool.update_google_event')
     async def update_google_event(
             event_id: str,
             summary: str = None,
@@ -253,56 +439,147 @@ def make_update_google_event_tool(user_id: int):
             location: str = None
     ) -> str:
         """Обновляет существующее событие в Google Calendar"""
-        from googleapiclient.discovery import build
-        from google.oauth2.credentials import Credentials
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
+
+        # Обновляем только переданные поля. Правки одного события за ход
+        # склеиваются и уходят одним PATCH в конце ответа
+        patch = _event_patch(summary, start_datetime, end_datetime, description, location)
+        if not patch:
+            return "Нечего обновлять: не передано ни одного поля"
+
+        write_coalescer.add(user_id, event_id, patch)
+        # Копия уже изменена, а если отправка не удастся, ошибка допишется к ответу
+        return f"Событие {event_id} будет обновлено в конце ответа: {', '.join(patch)}"
+
+    return update_google_event
+
 
+class BulkCreateEventsInput(BaseModel):
+    events: list[CreateEventInput] = Field(description="Список создаваемых событий")
+
+
+def make_bulk_create_google_events_tool(user_id: int):
+    @tool("bulk_create_google_events", args_schema=BulkCreateEventsInput)
+    @tracer.traced('tool.bulk_create_google_events')
+    async def bulk_create_google_events(events: list) -> str:
+        """Создает сразу несколько событий в Google Calendar одним запросом"""
         creds_data = credentials_store.get(user_id)
         if not creds_data:
             return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
 
         try:
-            if isinstance(creds_data, dict):
-                credentials = Credentials.from_authorized_user_info(creds_data)
-            else:
-                credentials = creds_data
-
-            service = build("calendar", "v3", credentials=credentials)
-
-            # Получаем текущую версию события
-            event = service.events().get(
-                calendarId='primary',
-                eventId=event_id
-            ).execute()
-
-            # Обновляем только переданные поля
-            if summary is not None:
-                event['summary'] = summary
-            if description is not None:
-                event['description'] = description
-            if location is not None:
-                event['location'] = location
-            if start_datetime is not None:
-                timezone = start_datetime.tzinfo.zone if start_datetime.tzinfo else "UTC"
-                event['start'] = {
-                    'dateTime': start_datetime.astimezone(datetime.timezone.utc).isoformat(),
-                    'timeZone': timezone
-                }
-            if end_datetime is not None:
-                timezone = end_datetime.tzinfo.zone if end_datetime.tzinfo else "UTC"
-                event['end'] = {
-                    'dateTime': end_datetime.astimezone(datetime.timezone.utc).isoformat(),
-                    'timeZone': timezone
-                }
-
-            updated_event = service.events().update(
-                calendarId='primary',
-                eventId=event_id,
-                body=event
-            ).execute()
-
-            return f"Событие обновлено: {updated_event['htmlLink']}"
+            service = get_calendar_service(user_id, creds_data)
+
+            requests = []
+            calendar_ids = []
+            for item in events:
+                item = _as_input(item, CreateEventInput)
+                calendar_id, error = await target_calendar(user_id, service, item.calendar)
+                if error:
+                    return error
+                body = _event_patch(item.summary, item.start_datetime, item.end_datetime,
+                                    item.description, item.location)
+                requests.append(service.events().insert(calendarId=calendar_id, body=body))
+                calendar_ids.append(calendar_id)
+
+            results = await aexecute_batch(service, requests, user_id)
+
+            lines = []
+            for number, (calendar_id, (created_event, error)) in enumerate(zip(calendar_ids, results), 1):
+                if error is not None:
+                    lines.append(f"{number}. ERROR: Ошибка при создании события: {str(error)}")
+                else:
+                    calendar_mirror.upsert(user_id, created_event, calendar_id)
+                    lines.append(f"{number}. Событие создано: {created_event['htmlLink']}")
+            return "\n".join(lines)
 
         except Exception as e:
-            return f"ERROR: Ошибка при обновлении события: {str(e)}"
+            return f"ERROR: Ошибка при создании событий: {str(e)}"
 
-    return update_google_event
+    return bulk_create_google_events
+
+
+class BulkUpdateEventsInput(BaseModel):
+    updates: list[UpdateEventInput] = Field(description="Список изменений, у каждого свой event_id")
+
+
+def make_bulk_update_google_events_tool(user_id: int):
+    @tool("bulk_update_google_events", args_schema=BulkUpdateEventsInput)
+    @tracer.traced('tool.bulk_update_google_events')
+    async def bulk_update_google_events(updates: list) -> str:
+        """Обновляет сразу несколько событий в Google Calendar одним запросом"""
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
+
+        try:
+            service = get_calendar_service(user_id, creds_data)
+
+            requests = []
+            event_ids = []
+            calendar_ids = []
+            for item in updates:
+                item = _as_input(item, UpdateEventInput)
+                body = _event_patch(item.summary, item.start_datetime, item.end_datetime,
+                                    item.description, item.location)
+                calendar_id = calendar_mirror.calendar_of(user_id, item.event_id)
+                # PATCH меняет только переданные поля, поэтому предварительный get не нужен
+                requests.append(patch_request(service, user_id, item.event_id, body, calendar_id))
+                event_ids.append(item.event_id)
+                calendar_ids.append(calendar_id)
+
+            results = await aexecute_batch(service, requests, user_id)
+            await refresh_conflicts(service, user_id, calendar_ids, results)
+
+            lines = []
+            for event_id, calendar_id, (updated_event, error) in zip(event_ids, calendar_ids, results):
+                if error is not None:
+                    lines.append(describe_error(event_id, error))
+                else:
+                    calendar_mirror.upsert(user_id, updated_event, calendar_id)
+                    lines.append(f"{event_id}: Событие обновлено: {updated_event['htmlLink']}")
+            return "\n".join(lines)
+
+        except Exception as e:
+            return f"ERROR: Ошибка при обновлении событий: {str(e)}"
+
+    return bulk_update_google_events
+
+
+class BulkDeleteEventsInput(BaseModel):
+    event_ids: list[str] = Field(description="Список ID событий для удаления")
+
+
+def make_bulk_delete_google_events_tool(user_id: int):
+    @tool("bulk_delete_google_events", args_schema=BulkDeleteEventsInput)
+    @tracer.traced('tool.bulk_delete_google_events')
+    async def bulk_delete_google_events(event_ids: list) -> str:
+        """Удаляет сразу несколько событий из Google Calendar одним запросом"""
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            return "Ошибка: учетные данные не найдены. Пройдите аутентификацию."
+
+        try:
+            service = get_calendar_service(user_id, creds_data)
+
+            calendar_ids = [calendar_mirror.calendar_of(user_id, event_id) for event_id in event_ids]
+            requests = [service.events().delete(calendarId=calendar_id, eventId=event_id)
+                        for event_id, calendar_id in zip(event_ids, calendar_ids)]
+            results = await aexecute_batch(service, requests, user_id)
+
+            lines = []
+            for event_id, calendar_id, (_, error) in zip(event_ids, calendar_ids, results):
+                if error is not None:
+                    lines.append(f"{event_id}: ERROR: Ошибка при удалении события: {str(error)}")
+                else:
+                    calendar_mirror.remove(user_id, event_id, calendar_id)
+                    write_coalescer.discard(user_id, event_id)
+                    lines.append(f"Событие {event_id} успешно удалено")
+            return "\n".join(lines)
+
+        except Exception as e:
+            return f"ERROR: Ошибка при удалении событий: {str(e)}"
+
+    return bulk_delete_google_events
@@ -0,0 +1,245 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass, field
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from config import TRACE_SAMPLE_RATE, TRACE_SLOW_TURN
+
+
+logger = logging.getLogger('trace')
+
+# Границы корзин гистограмм задержек, с
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Больше спанов в одном ходе не запоминаем
+MAX_SPANS = 200
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class Metrics:
+    """Гистограммы и счетчики в формате Prometheus.
+
+    Кроме собственных метрик отдает как gauge числовые значения из stats()
+    зарегистрированных компонентов, чтобы не дублировать их учет.
+    """
+
+    def __init__(self, namespace: str = 'bot'):
+        self._namespace = namespace
+        # (имя, метки) -> Histogram или число
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def register(self, name: str, stats):
+        """stats - функция без аргументов, возвращающая dict, как у компонентов бота"""
+        self._collectors[name] = stats
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            name = f'{self._namespace}_{name}'
+            labels = dict(labels)
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_labels({**labels, "le": le})} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+
+        for (name, labels), value in sorted(self._counters.items()):
+            name = f'{self._namespace}_{name}'
+            declare(name, 'counter')
+            lines.append(f'{name}{_labels(dict(labels))} {value}')
+
+        for component, stats in self._collectors.items():
+            try:
+                values = stats()
+            except Exception:
+                logger.exception(f"Failed to collect stats of {component}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, dict):
+                    # Вложенные словари (например, по моделям) становятся меткой
+                    for nested, nested_value in value.items():
+                        if isinstance(nested_value, (int, float)) and not isinstance(nested_value, bool):
+                            name = f'{self._namespace}_{component}_{nested}'
+                            declare(name, 'gauge')
+                            lines.append(f'{name}{_labels({"key": key})} {nested_value}')
+                elif isinstance(value, list):
+                    # Списки (например, по шардам) - ряд на элемент
+                    name = f'{self._namespace}_{component}_{key}'
+                    declare(name, 'gauge')
+                    lines.extend(f'{name}{_labels({"index": index})} {item}' for index, item in enumerate(value))
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = f'{self._namespace}_{component}_{key}'
+                    declare(name, 'gauge')
+                    lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+@dataclass
+class Trace:
+    """Спаны одного хода пользователя"""
+    turn_id: str
+    user_id: int
+    sampled: bool
+    started: float = field(default_factory=time.perf_counter)
+    # (этап, родитель, начало от старта хода, длительность, ошибка, теги)
+    spans: list = field(default_factory=list)
+
+
+_trace = contextvars.ContextVar('trace', default=None)
+_parent = contextvars.ContextVar('span', default=None)
+
+
+class Tracer:
+    """Замер этапов хода: скачивание и распознавание голоса, быстрый путь,
+    шаги агента, инструменты календаря, запросы к Google и Telegram.
+
+    Длительность каждого этапа всегда попадает в гистограмму stage_seconds
+    с единственной меткой stage, так что число рядов не зависит от числа
+    пользователей. Спаны хода копятся в списке и пишутся в лог одной
+    JSON-строкой только для доли sample_rate ходов и для медленных ходов,
+    поэтому на остальных ходах трассировка стоит пары замеров времени.
+    """
+
+    def __init__(self, metrics: Metrics, sample_rate: float = TRACE_SAMPLE_RATE, slow_turn: float = TRACE_SLOW_TURN):
+        self.metrics = metrics
+        self._sample_rate = sample_rate
+        self._slow_turn = slow_turn
+        self._turn_ids = itertools.count(1)
+        # Воркеров может быть несколько, номер хода уникален вместе с pid
+        self._prefix = f'{os.getpid():x}'
+
+    @contextlib.contextmanager
+    def turn(self, user_id: int, **tags):
+        trace = Trace(
+            turn_id=f'{self._prefix}-{next(self._turn_ids)}',
+            user_id=user_id,
+            sampled=random.random() < self._sample_rate
+        )
+        token = _trace.set(trace)
+        try:
+            with self.span('turn', **tags):
+                yield trace
+        finally:
+            _trace.reset(token)
+            self._finish(trace)
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **tags):
+        started = time.perf_counter()
+        parent = _parent.get()
+        token = _parent.set(stage)
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _parent.reset(token)
+            self._record(stage, parent, started, time.perf_counter() - started, error, tags)
+
+    def record(self, stage: str, duration: float, error: str = None, **tags):
+        """Этап, замеренный вызывающим (например, внутри асинхронного генератора)"""
+        self._record(stage, _parent.get(), time.perf_counter() - duration, duration, error, tags)
+
+    def _record(self, stage, parent, started, duration, error, tags):
+        self.metrics.observe('stage_seconds', duration, stage=stage)
+        if error:
+            self.metrics.inc('stage_errors_total', stage=stage)
+        trace = _trace.get()
+        if trace is not None and len(trace.spans) < MAX_SPANS:
+            trace.spans.append((stage, parent, started - trace.started, duration, error, tags))
+
+    def traced(self, stage: str):
+        """Декоратор для корутин: весь вызов - один спан"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish(self, trace: Trace):
+        duration = time.perf_counter() - trace.started
+        self.metrics.inc('turns_total')
+        if not trace.sampled and duration < self._slow_turn:
+            return
+        logger.info(json.dumps({
+            'turn': trace.turn_id,
+            'user': trace.user_id,
+            'duration': round(duration, 4),
+            'slow': duration >= self._slow_turn,
+            'spans': [
+                {'stage': stage, 'parent': parent, 'start': round(start, 4), 'duration': round(span_duration, 4),
+                 **({'error': error} if error else {}), **tags}
+                for stage, parent, start, span_duration, error, tags in trace.spans
+            ],
+        }, ensure_ascii=False, default=str))
+
+
+class TelegramTracing(BaseRequestMiddleware):
+    """Middleware сессии бота: каждый вызов Bot API - спан telegram.<метод>"""
+
+    async def __call__(self, make_request, bot, method):
+        with tracer.span(f'telegram.{type(method).__name__}'):
+            return await make_request(bot, method)
+
+
+metrics = Metrics()
+tracer = Tracer(metrics)
@@ -0,0 +1,214 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from config import (AGENT_MAX_CONCURRENCY, TURN_QUEUE_MAX, TURN_USER_QUEUE_MAX,
+                    LLM_RATE_LIMIT, LLM_RATE_BURST)
+
+
+logger = logging.getLogger('turnScheduler')
+
+
+class SchedulerOverloaded(Exception):
+    """Очередь переполнена, запрос отклонен без выполнения"""
+
+
+@dataclass
+class Ticket:
+    """Место запроса в очереди пользователя"""
+    user_id: int
+    granted: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    wait: float = 0.0
+
+
+class TokenBucket:
+    """Ограничение частоты: rate разрешений в секунду, до burst подряд"""
+
+    def __init__(self, rate: float = LLM_RATE_LIMIT, burst: int = LLM_RATE_BURST):
+        # Лимит на весь бот; процессу достается его доля (см. share)
+        self._total = (rate, burst)
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = None
+
+        # Метрики
+        self.acquired = 0
+        self.throttled_time = 0.0
+
+    def share(self, shares: int):
+        """Делит лимит между shares процессами, этому процессу остается его доля"""
+        rate, burst = self._total
+        self._rate = rate / shares
+        self._burst = max(1, int(burst / shares))
+        self._tokens = min(self._tokens, self._burst)
+
+    def _refill(self, now: float):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Под замком ждущие получают разрешения по очереди
+        async with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self._rate
+                self.throttled_time += delay
+                await asyncio.sleep(delay)
+                self._refill(time.monotonic())
+            self._tokens -= 1
+            self.acquired += 1
+
+    def stats(self) -> dict:
+        return {
+            'rate': self._rate,
+            'burst': self._burst,
+            'acquired': self.acquired,
+            'throttled_time': self.throttled_time,
+        }
+
+
+class TurnScheduler:
+    """Очередь ходов агента перед get_ai_response.
+
+    Ходы одного пользователя выполняются строго по очереди (FIFO), иначе
+    два сообщения подряд гоняли бы агента по одному thread_id одновременно.
+    Одновременно выполняется не больше max_concurrency ходов, а свободное
+    место получают пользователи по кругу, так что засыпавший сообщениями
+    пользователь не задерживает остальных. При переполнении очереди новые
+    запросы отклоняются сразу (SchedulerOverloaded).
+    """
+
+    def __init__(self, max_concurrency: int = AGENT_MAX_CONCURRENCY,
+                 max_queue: int = TURN_QUEUE_MAX, max_user_queue: int = TURN_USER_QUEUE_MAX):
+        # Лимиты на весь бот; процессу достается его доля (см. share)
+        self._total = (max_concurrency, max_queue)
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._max_user_queue = max_user_queue
+
+        # user_id -> ожидающие билеты пользователя
+        self._queues: dict[int, deque] = {}
+        # Пользователи с ожидающими билетами, которые сейчас ничего не выполняют
+        self._ready = deque()
+        self._running = set()
+        self._waiting = 0
+
+        # Метрики
+        self.admitted = 0
+        self.shed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def share(self, shares: int):
+        """Делит общие лимиты между shares воркерами.
+
+        Пользователи распределены по воркерам равномерно (shard_of), поэтому
+        равные доли дают в сумме настроенные AGENT_MAX_CONCURRENCY и TURN_QUEUE_MAX.
+        """
+        max_concurrency, max_queue = self._total
+        self._max_concurrency = max(1, max_concurrency // shares)
+        self._max_queue = max(1, max_queue // shares)
+
+    @contextlib.asynccontextmanager
+    async def turn(self, user_id: int):
+        """Ждет очереди пользователя и свободного места, отдает билет с временем ожидания"""
+        ticket = self._enqueue(user_id)
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            self._cancel(ticket)
+            raise
+
+        logger.info(f"Turn of {user_id} waited {ticket.wait:.3f}s in queue")
+        try:
+            yield ticket
+        finally:
+            self._release(user_id)
+
+    def _enqueue(self, user_id) -> Ticket:
+        queue = self._queues.get(user_id)
+        if self._waiting >= self._max_queue or (queue and len(queue) >= self._max_user_queue):
+            self.shed += 1
+            raise SchedulerOverloaded(user_id)
+
+        ticket = Ticket(user_id=user_id, granted=asyncio.get_running_loop().create_future())
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            if user_id not in self._running:
+                self._ready.append(user_id)
+        queue.append(ticket)
+        self._waiting += 1
+        self._dispatch()
+        return ticket
+
+    def _cancel(self, ticket: Ticket):
+        if ticket.granted.done() and not ticket.granted.cancelled():
+            # Место уже выдано - возвращаем его
+            self._release(ticket.user_id)
+            return
+
+        queue = self._queues.get(ticket.user_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self._waiting -= 1
+            if not queue:
+                del self._queues[ticket.user_id]
+                if ticket.user_id in self._ready:
+                    self._ready.remove(ticket.user_id)
+
+    def _release(self, user_id):
+        self._running.discard(user_id)
+        if user_id in self._queues:
+            # В конец круга, чтобы другие пользователи успели получить место
+            self._ready.append(user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._ready and len(self._running) < self._max_concurrency:
+            user_id = self._ready.popleft()
+            queue = self._queues[user_id]
+            ticket = queue.popleft()
+            if not queue:
+                del self._queues[user_id]
+            self._waiting -= 1
+
+            if ticket.granted.done():
+                # Запрос отменили, пока он ждал
+                if user_id in self._queues:
+                    self._ready.appendleft(user_id)
+                continue
+
+            self._running.add(user_id)
+            ticket.wait = now - ticket.enqueued_at
+            self.admitted += 1
+            self.wait_total += ticket.wait
+            self.wait_max = max(self.wait_max, ticket.wait)
+            ticket.granted.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self._max_concurrency,
+            'running': len(self._running),
+            'waiting': self._waiting,
+            'waiting_users': len(self._queues),
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'avg_wait': self.wait_total / self.admitted if self.admitted else 0.0,
+            'max_wait': self.wait_max,
+        }
+
+
+turn_scheduler = TurnScheduler()
+# Общее ограничение частоты вызовов GigaChat, включая сводки истории
+llm_rate_limiter = TokenBucket()
@@ -0,0 +1,149 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import time
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import oauthServer
+import calendar_push
+from tracing import metrics
+from config import WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, METRICS_PATH, CALENDAR_PUSH_PATH
+
+
+logger = logging.getLogger('webServer')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateQueue:
+    """Ограниченная очередь сырых обновлений Telegram, которую разбирают несколько задач-обработчиков"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot,
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS):
+        self._dispatcher = dispatcher
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers_count = workers
+        self._workers = []
+
+        # Метрики
+        self.failed = 0
+        self.queue_wait = 0.0
+        self.processed = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self._workers_count)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def offer(self, data: dict) -> bool:
+        """Ставит обновление в очередь, False - если очередь полна"""
+        try:
+            self._queue.put_nowait((data, time.monotonic()))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, data: dict):
+        """Ставит обновление в очередь, дожидаясь места"""
+        await self._queue.put((data, time.monotonic()))
+
+    async def _work(self):
+        while True:
+            data, received = await self._queue.get()
+            self.queue_wait += time.monotonic() - received
+            try:
+                update = Update.model_validate(data, context={"bot": self._bot})
+                await self._dispatcher.feed_update(self._bot, update)
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Failed to process update {data.get('update_id')}")
+            finally:
+                self.processed += 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            'failed': self.failed,
+            'queued': self._queue.qsize(),
+            'avg_queue_wait': self.queue_wait / self.processed if self.processed else 0.0,
+        }
+
+
+class WebServer:
+    """Единый HTTP-сервер в цикле событий бота.
+
+    Обслуживает OAuth callback, уведомления об изменениях календарей и
+    метрики по METRICS_PATH, а в режиме webhook еще и принимает обновления Telegram. Обновление проверяется по секретному токену и
+    отдается в updates (UpdateQueue или ShardRouter), ответ Telegram уходит сразу.
+    Если очередь полна, возвращается 503 и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, updates, secret: str = WEBHOOK_SECRET, callback: bool = True):
+        self._updates = updates
+        # Telegram допускает в токене только A-Z, a-z, 0-9, _ и -
+        self.secret = secret or secrets.token_urlsafe(32)
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_get(METRICS_PATH, self._metrics)
+        # Воркеры отдают только метрики, авторизация и уведомления идут через главный процесс
+        if callback:
+            self.app.router.add_get('/callback', oauthServer.callback)
+            self.app.router.add_post(CALENDAR_PUSH_PATH, calendar_push.receive)
+
+        # Метрики
+        self.accepted = 0
+        self.rejected = 0
+        self.shed = 0
+
+    def enable_webhook(self, path: str):
+        self.app.router.add_post(path, self._handle_update)
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Web server started on http://{host}:{port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _metrics(self, request: web.Request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    async def _handle_update(self, request: web.Request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.rejected += 1
+            logger.warning(f"Rejected webhook request from {request.remote}: bad secret token")
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if not self._updates.offer(data):
+            self.shed += 1
+            logger.warning("Update queue is full, asking Telegram to redeliver")
+            return web.Response(status=503)
+
+        self.accepted += 1
+        return web.Response()
+
+    def stats(self) -> dict:
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'shed': self.shed,
+        }
@@ -0,0 +1,160 @@
+import logging
+from dataclasses import dataclass
+
+from googleapiclient.errors import HttpError
+
+from calendar_mirror import calendar_mirror
+from google_services import get_calendar_service, aexecute, aexecute_batch
+from oauthServer import credentials_store
+from tracing import tracer
+
+
+logger = logging.getLogger('writeCoalescer')
+
+
+def patch_request(service, user_id: int, event_id: str, body: dict, calendar_id: str = 'primary', etag: str = None):
+    """PATCH события с If-Match по ETag (по умолчанию - из локальной копии).
+
+    Если событие успели изменить в другом месте, Google ответит 412,
+    и чужие изменения не будут перезаписаны.
+    """
+    request = service.events().patch(calendarId=calendar_id, eventId=event_id, body=body)
+    if etag is None:
+        event = calendar_mirror.get_event(user_id, event_id, calendar_id)
+        etag = event.get('etag') if event else None
+    if etag:
+        request.headers['If-Match'] = etag
+    return request
+
+
+def _conflict(error) -> bool:
+    return isinstance(error, HttpError) and error.resp.status == 412
+
+
+async def refresh_conflicts(service, user_id: int, calendar_ids: list, results: list) -> int:
+    """Догоняет копии календарей, где PATCH получил 412, возвращает число конфликтов.
+
+    Правка не повторяется: If-Match нужен как раз для того, чтобы не
+    перезаписать чужое изменение. Агент получает ошибку, а следующее
+    чтение уже видит свежую версию события и ее ETag.
+    """
+    stale = {calendar_id for calendar_id, (_, error) in zip(calendar_ids, results) if _conflict(error)}
+    for calendar_id in stale:
+        try:
+            await calendar_mirror.sync(user_id, service, calendar_id, force=True)
+        except Exception as e:
+            logger.warning(f"Failed to refresh calendar {calendar_id} of {user_id} after a conflict: {e}")
+    return sum(_conflict(error) for _, error in results)
+
+
+def describe_error(event_id: str, error: Exception) -> str:
+    if _conflict(error):
+        return f"{event_id}: ERROR: событие было изменено в другом месте, обновите данные и повторите"
+    return f"{event_id}: ERROR: Ошибка при обновлении события: {str(error)}"
+
+
+@dataclass
+class _Edit:
+    calendar_id: str
+    # Версия события до правок хода: ее ETag уходит в If-Match, а при ошибке она возвращается в копию
+    original: dict
+    body: dict
+
+
+class WriteCoalescer:
+    """Собирает правки событий за ход агента и отправляет их в конце одним PATCH на событие.
+
+    Правка сразу ложится в локальную копию, поэтому чтения в том же ходе
+    (просмотр, поиск, кеш инструментов) видят уже измененное событие.
+    Если отправка в конце хода не удалась, в копию возвращается прежняя
+    версия, а ошибка дописывается к ответу пользователю.
+    """
+
+    def __init__(self):
+        # user_id -> {event_id: _Edit}
+        self._pending = {}
+
+        # Метрики
+        self.edits = 0
+        self.requests = 0
+        self.conflicts = 0
+
+    def add(self, user_id: int, event_id: str, patch: dict):
+        """Добавляет правку; более поздние значения полей перекрывают ранние.
+
+        Возвращает событие с правками из копии или None, если события там нет.
+        """
+        edits = self._pending.setdefault(user_id, {})
+        edit = edits.get(event_id)
+        if edit is None:
+            calendar_id = calendar_mirror.calendar_of(user_id, event_id)
+            edit = edits[event_id] = _Edit(calendar_id, calendar_mirror.get_event(user_id, event_id, calendar_id), {})
+        edit.body.update(patch)
+        self.edits += 1
+
+        if edit.original is None:
+            return None
+        event = dict(edit.original, **edit.body)
+        calendar_mirror.upsert(user_id, event, edit.calendar_id)
+        return event
+
+    def discard(self, user_id: int, event_id: str):
+        """Забывает правки события (например, если его удалили в том же ходе)"""
+        self._pending.get(user_id, {}).pop(event_id, None)
+
+    def pending(self, user_id: int) -> dict:
+        return {event_id: edit.body for event_id, edit in self._pending.get(user_id, {}).items()}
+
+    @tracer.traced('write_coalescer.flush')
+    async def flush(self, user_id: int) -> list:
+        """Отправляет накопленные правки пользователя, возвращает описания ошибок"""
+        pending = self._pending.pop(user_id, None)
+        if not pending:
+            return []
+
+        creds_data = credentials_store.get(user_id)
+        if not creds_data:
+            self._rollback(user_id, pending.values())
+            return ["Ошибка: учетные данные не найдены. Пройдите аутентификацию."]
+
+        service = get_calendar_service(user_id, creds_data)
+        event_ids = list(pending)
+        edits = [pending[event_id] for event_id in event_ids]
+        requests = [patch_request(service, user_id, event_id, edit.body, edit.calendar_id,
+                                  etag=edit.original.get('etag') if edit.original else None)
+                    for event_id, edit in zip(event_ids, edits)]
+        self.requests += len(requests)
+
+        try:
+            if len(requests) == 1:
+                results = [(await aexecute(requests[0], user_id), None)]
+            else:
+                results = await aexecute_batch(service, requests, user_id)
+        except Exception as e:
+            results = [(None, e)] * len(requests)
+
+        errors = []
+        failed = []
+        for event_id, edit, (updated_event, error) in zip(event_ids, edits, results):
+            if error is not None:
+                logger.error(f"Failed to update event {event_id} for {user_id}: {error}")
+                errors.append(describe_error(event_id, error))
+                failed.append(edit)
+            else:
+                calendar_mirror.upsert(user_id, updated_event, edit.calendar_id)
+        # Сначала возвращаем прежние версии, потом догоняем конфликтные календари до настоящих
+        self._rollback(user_id, failed)
+        self.conflicts += await refresh_conflicts(service, user_id, [edit.calendar_id for edit in edits], results)
+        return errors
+
+    @staticmethod
+    def _rollback(user_id, edits):
+        for edit in edits:
+            if edit.original is not None:
+                calendar_mirror.upsert(user_id, edit.original, edit.calendar_id)
+
+    def stats(self) -> dict:
+        return {'edits': self.edits, 'requests': self.requests, 'conflicts': self.conflicts}
+
+
+write_coalescer = WriteCoalescer()